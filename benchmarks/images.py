@@ -0,0 +1,61 @@
+__author__ = 'Richard'
+
+# Synthetic images for benchmarking, generated the same way every time so that results can be compared between runs
+
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+# Sizes in pixels (width, height), by name
+SIZES = {
+    "small": (200, 150),
+    "medium": (800, 600),
+    "large": (2000, 1500)
+}
+
+
+def gradient(size):
+    # A smooth left to right ramp from black to white. Every column is a different power, so every pixel is a move
+    width, height = size
+    row = bytearray(255 * col // max(width - 1, 1) for col in xrange(width))
+    return Image.frombytes("L", size, bytes(row * height))
+
+
+def noise(size, seed=1):
+    # Random pixels, the worst case for the number of moves
+    randomness = random.Random(seed)
+    return Image.frombytes("L", size, bytes(bytearray(randomness.getrandbits(8) for _ in xrange(size[0] * size[1]))))
+
+
+def sparse_logo(size):
+    # A few solid shapes on a white background, taking up a small part of the image
+    width, height = size
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+
+    draw.ellipse((width * 0.40, height * 0.40, width * 0.50, height * 0.55), fill=0)
+    draw.rectangle((width * 0.52, height * 0.42, width * 0.60, height * 0.53), fill=60)
+    draw.line((width * 0.40, height * 0.60, width * 0.60, height * 0.60), fill=0, width=max(1, height // 100))
+    return image
+
+
+def photo_like(size, seed=1):
+    # Smooth shading with fine detail and a little grain, like a photograph
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.25, 0.75, 1.25), 60)
+    shading = gradient(size).filter(ImageFilter.GaussianBlur(max(size) / 20.0))
+    image = Image.blend(detail, shading, 0.5).filter(ImageFilter.GaussianBlur(1))
+    return Image.blend(image, noise(size, seed), 0.1)
+
+
+# The images, by name
+IMAGES = {
+    "gradient": gradient,
+    "noise": noise,
+    "sparse_logo": sparse_logo,
+    "photo_like": photo_like
+}
+
+
+def make_image(name, size):
+    # The image in the mode that bitmap-to-laser.py converts its source to
+    return IMAGES[name](size).convert("LA")
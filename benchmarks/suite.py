@@ -0,0 +1,196 @@
+__author__ = 'Richard'
+
+# Runs bitmap_to_laser and the output of the resulting file over a set of synthetic images, and compares the results
+# with a saved baseline
+
+import json
+import multiprocessing
+import platform
+import time
+from datetime import datetime
+
+import PIL
+
+from benchmarks.images import SIZES, IMAGES, make_image
+from gcode.stages import peak_memory_mb
+from machines.machine import BaseMachine
+from machines.marlin import Marlin
+from raster.bitmap import bitmap_to_laser, RasterEngine
+
+MACHINES = {
+    "base": BaseMachine,
+    "marlin": Marlin
+}
+
+# The measurements that can regress, whether bigger is worse, and the time that they are measured over
+METRICS = [
+    ("generation_seconds", True, "generation_seconds"),
+    ("lines_per_second", False, "emission_seconds"),
+    ("peak_memory_mb", True, None),
+    ("output_bytes", True, None)
+]
+
+# Timings shorter than this (in seconds) vary too much from run to run to be compared
+MIN_TIMED_SECONDS = 0.05
+
+# Differences in memory smaller than this (in MB) are noise, however big they are compared to the baseline
+MEMORY_SLACK_MB = 5
+
+
+def run_suite(images=None, sizes=None, engines=None, machines=None, repeat=3):
+    """
+    Run every combination of image, size and engine, outputting each generated file for every machine.
+    Returns the results as a dict that can be saved as JSON.
+    """
+    images = images or sorted(IMAGES.keys())
+    sizes = sizes or ["small", "medium"]
+    engines = engines or RasterEngine.ALL
+    machines = machines or sorted(MACHINES.keys())
+
+    jobs = [(image, size, engine, machines, repeat) for image in images for size in sizes for engine in engines]
+
+    # Each case runs in a new process, so that its peak memory isn't hidden by the cases before it
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = []
+        for case_results in pool.imap(_run_case, jobs):
+            results.extend(case_results)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return {"environment": environment(), "results": results}
+
+
+def environment():
+    # What the results were measured on, as they can only really be compared with others from the same place
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+
+    return {
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "numpy": numpy_version,
+        "pil": getattr(PIL, "__version__", None)
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare results with a baseline from run_suite. Returns a list of (case, metric, baseline value, value,
+    regressed) for each metric of each case in both. A metric has regressed if it is more than tolerance (as a
+    fraction) worse than the baseline.
+    """
+    baseline_cases = dict((_case_key(result), result) for result in baseline["results"])
+
+    comparisons = []
+    for result in results["results"]:
+        key = _case_key(result)
+        if key not in baseline_cases:
+            continue
+
+        for metric, bigger_is_worse, timed_over in METRICS:
+            baseline_value = baseline_cases[key][metric]
+            value = result[metric]
+
+            if timed_over is not None and baseline_cases[key][timed_over] < MIN_TIMED_SECONDS:
+                regressed = False
+            elif metric == "output_bytes":
+                # The output should be exactly the same. Any growth is a regression
+                regressed = value > baseline_value
+            elif bigger_is_worse:
+                slack = MEMORY_SLACK_MB if metric == "peak_memory_mb" else 0
+                regressed = value > baseline_value * (1 + tolerance) + slack
+            else:
+                regressed = value < baseline_value / (1 + tolerance)
+
+            comparisons.append(("/".join(key), metric, baseline_value, value, regressed))
+
+    return comparisons
+
+
+def save_results(results, path):
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def _case_key(result):
+    return result["image"], result["size"], result["engine"], result["machine"]
+
+
+def _run_case(job):
+    image_name, size_name, engine, machine_names, repeat = job
+
+    image = make_image(image_name, SIZES[size_name])
+    memory_before = peak_memory_mb()
+
+    # The best of the repeats is the one least disturbed by anything else running
+    generation_seconds = None
+    for _ in range(repeat):
+        # Let go of the last repeat's program first, so that the peak memory is for one program whatever the repeat
+        gcode_file = None
+        start_time = time.time()
+        gcode_file = bitmap_to_laser(source_image=image, engine=engine)
+        generation_seconds = _best(generation_seconds, time.time() - start_time)
+
+    results = []
+    for machine_name in machine_names:
+        machine = MACHINES[machine_name]()
+
+        emission_seconds = None
+        for _ in range(repeat):
+            output = _CountingOutput()
+            start_time = time.time()
+            gcode_file.write_to(output, machine)
+            emission_seconds = _best(emission_seconds, time.time() - start_time)
+
+        results.append({
+            "image": image_name,
+            "size": size_name,
+            "width": image.size[0],
+            "height": image.size[1],
+            "engine": engine,
+            "machine": machine_name,
+            "generation_seconds": generation_seconds,
+            "lines": output.lines,
+            "emission_seconds": emission_seconds,
+            "lines_per_second": output.lines / emission_seconds if emission_seconds else 0,
+            "output_bytes": output.size
+        })
+
+    # The peak covers generating the file and every output of it
+    for result in results:
+        result["peak_memory_mb"] = peak_memory_mb() - memory_before
+
+    return results
+
+
+def _best(best, seconds):
+    if best is None:
+        return seconds
+    return min(best, seconds)
+
+
+class _CountingOutput(object):
+    # A file object that only counts what is written to it
+
+    def __init__(self):
+        self.size = 0
+        self.lines = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.lines += data.count("\n")
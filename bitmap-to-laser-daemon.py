@@ -0,0 +1,40 @@
+# Script to run bitmap-to-laser.py as a local service, so that conversions don't pay for starting up each time
+
+__author__ = 'Richard'
+
+import sys
+import argparse
+
+from raster.daemon import JobRunner, make_server, DEFAULT_HOST, DEFAULT_PORT
+
+# Setup command line parameters
+parser = argparse.ArgumentParser(description='Convert bitmaps to laser engraving G-Code for local clients over HTTP. '
+                                             'POST a JSON object with the same keys as --json-config to /convert to '
+                                             'get the G-Code back, and GET /metrics for latency and queue depth.')
+parser.add_argument('--host', type=str, dest='host', default=DEFAULT_HOST,
+                    help='The address to listen on. Only local clients should be able to reach it')
+parser.add_argument('--port', type=int, dest='port', default=DEFAULT_PORT, help='The port to listen on')
+parser.add_argument('--socket', type=str, dest='socket_path', default=None,
+                    help='Listen on this unix socket instead of a port')
+parser.add_argument('--workers', type=int, dest='workers', default=None,
+                    help='How many images can be converted at once. Defaults to the number of CPUs')
+parser.add_argument('--spool-dir', type=str, dest='spool_directory', default=None,
+                    help='Where the G-Code is kept until it has been sent. Defaults to a temporary directory')
+
+args = parser.parse_args()
+
+job_runner = JobRunner(args.workers, args.spool_directory)
+server = make_server(job_runner, args.host, args.port, args.socket_path)
+
+if args.socket_path is not None:
+    print >> sys.stderr, "Listening on {} with {} workers".format(args.socket_path, job_runner.workers)
+else:
+    print >> sys.stderr, "Listening on http://{}:{} with {} workers".format(args.host, args.port, job_runner.workers)
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    job_runner.close()
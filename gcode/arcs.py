@@ -0,0 +1,264 @@
+__author__ = 'Richard'
+
+# Replaces runs of short feed moves that follow a circle with arcs. A curve made of many tiny straight moves fills the
+# controller's planner buffer faster than it can be run, so the machine slows down on it. An arc is one line however
+# much of the curve it covers.
+
+import math
+
+from gcode.line import LineType, MoveType, MovementMode, Units, ArcDirection, MoveArc
+from gcode.store import LineStore
+
+MM_PER_INCH = 25.4
+
+# How far (in mm) the arc may stray from the moves it replaces
+DEFAULT_TOLERANCE = 0.01
+
+# The fewest moves worth replacing with an arc
+DEFAULT_MIN_SEGMENTS = 3
+
+# Circles bigger than this (in mm) are as good as straight, and give centres a long way from the moves
+DEFAULT_MAX_RADIUS = 1000.0
+
+
+def fit_arcs(gcode_file, tolerance=DEFAULT_TOLERANCE, min_segments=DEFAULT_MIN_SEGMENTS,
+             max_radius=DEFAULT_MAX_RADIUS):
+    """
+    Replace each run of at least min_segments feed moves whose ends lie on a circle with a single arc, wherever the
+    arc stays within tolerance (in mm, as output) of the moves. Only moves in absolute mode that stay in the XY plane
+    and keep the same feed rate are replaced, and any comments, tool changes or other lines in between end a run.
+    The lines of the file are replaced. Returns the number of arcs made.
+    """
+    transform = gcode_file.transform
+    if not transform.is_similarity():
+        raise ValueError("Arcs can only be transformed by a combination of moves, rotations, mirroring and uniform "
+                         "scaling")
+
+    # The tolerance is for the program as it is output, which the transform scales
+    scale = math.sqrt(abs(transform.a * transform.e - transform.b * transform.d))
+    fitter = _ArcFitter(tolerance / scale, min_segments, max_radius / scale)
+
+    lines = LineStore(precision=gcode_file.lines.precision)
+    for line in fitter.fit(gcode_file.lines):
+        lines.append(line)
+
+    gcode_file.lines = lines
+    return fitter.arcs
+
+
+class _ArcFitter(object):
+    # Follows where the head is through the program, collecting the moves that could be part of an arc
+
+    def __init__(self, tolerance, min_segments, max_radius):
+        self.tolerance = tolerance
+        self.min_segments = min_segments
+        self.max_radius = max_radius
+        self.arcs = 0
+
+        self.units_scale = 1.0
+        self.absolute = True
+        self.x = 0.0
+        self.y = 0.0
+        self.z = None
+        self.feed_rate = None
+
+    def fit(self, lines):
+        # Generate the lines with the runs of moves replaced
+        run_start = (self.x, self.y)
+        run = []
+        points = []
+
+        for line in lines:
+            if self._continues_run(line):
+                run.append(line)
+                points.append(self._move_to(line))
+                continue
+
+            if run:
+                for fitted_line in self._fit_run(run_start, run, points):
+                    yield fitted_line
+                run = []
+                points = []
+
+            self._follow(line)
+            run_start = (self.x, self.y)
+            yield line
+
+        for fitted_line in self._fit_run(run_start, run, points):
+            yield fitted_line
+
+    def _continues_run(self, line):
+        # Whether the line is a move that an arc could be made through, starting from where the head is
+        return (line.type == LineType.MOVE_LINEAR and line.move_type == MoveType.FEED and self.absolute and
+                line.comment is None and (line.x is not None or line.y is not None) and
+                (line.z is None or line.z == self.z) and
+                (line.feed_rate is None or line.feed_rate == self.feed_rate))
+
+    def _move_to(self, line):
+        if line.x is not None:
+            self.x = line.x
+        if line.y is not None:
+            self.y = line.y
+        return self.x, self.y
+
+    def _follow(self, line):
+        # Keep track of the position, units, movement mode and feed rate through any other line
+        if line.type == LineType.MOVE_LINEAR:
+            for axis in ("x", "y", "z"):
+                value = getattr(line, axis)
+                if value is None:
+                    continue
+                if self.absolute:
+                    setattr(self, axis, value)
+                elif getattr(self, axis) is not None:
+                    setattr(self, axis, getattr(self, axis) + value)
+
+            if line.feed_rate is not None:
+                self.feed_rate = line.feed_rate
+        elif line.type == LineType.MOVE_ARC:
+            if self.absolute:
+                self.x = line.end_x
+                self.y = line.end_y
+            else:
+                self.x += line.end_x
+                self.y += line.end_y
+
+            if line.z is not None:
+                if self.absolute:
+                    self.z = line.z
+                elif self.z is not None:
+                    self.z += line.z
+
+            if line.feed_rate is not None:
+                self.feed_rate = line.feed_rate
+        elif line.type == LineType.SET_MOVEMENT_MODE:
+            self.absolute = line.mode == MovementMode.ABSOLUTE
+        elif line.type == LineType.SET_UNITS:
+            self.units_scale = MM_PER_INCH if line.units == Units.INCHES else 1.0
+
+    def _fit_run(self, start, run, points):
+        # Replace as much of the run as possible with arcs, longest first from the start of the run
+        tolerance = self.tolerance / self.units_scale
+        max_radius = self.max_radius / self.units_scale
+
+        index = 0
+        while index < len(run):
+            arc = _longest_arc(start, points, index, self.min_segments, tolerance, max_radius)
+
+            if arc is None:
+                yield run[index]
+                start = points[index]
+                index += 1
+                continue
+
+            end, centre_x, centre_y, direction = arc
+            end_x, end_y = points[end]
+            yield MoveArc(direction, end_x, end_y, centre_x - start[0], centre_y - start[1])
+            self.arcs += 1
+
+            start = points[end]
+            index = end + 1
+
+
+def _longest_arc(start, points, first, min_segments, tolerance, max_radius):
+    # The longest arc from start through points[first:end + 1], as (end, centre x, centre y, direction), or None if
+    # there isn't one of at least min_segments moves. Longer runs are tried by doubling and then narrowed down
+    # by halving, so each run only has to be checked a few times
+    shortest = first + min_segments - 1
+    if shortest >= len(points):
+        return None
+
+    best = _fit_circle(start, points, first, shortest, tolerance, max_radius)
+    if best is None:
+        return None
+    best_end = shortest
+
+    failed_end = None
+    step = min_segments
+    while failed_end is None:
+        end = min(best_end + step, len(points) - 1)
+        if end == best_end:
+            break
+
+        arc = _fit_circle(start, points, first, end, tolerance, max_radius)
+        if arc is None:
+            failed_end = end
+        else:
+            best, best_end = arc, end
+            step *= 2
+
+    while failed_end is not None and failed_end - best_end > 1:
+        end = (best_end + failed_end) // 2
+        arc = _fit_circle(start, points, first, end, tolerance, max_radius)
+        if arc is None:
+            failed_end = end
+        else:
+            best, best_end = arc, end
+
+    centre_x, centre_y, direction = best
+    return best_end, centre_x, centre_y, direction
+
+
+def _fit_circle(start, points, first, end, tolerance, max_radius):
+    # The circle through start, points[end] and a point half way between, if every point from first to end is within
+    # tolerance of it and the moves between them all go the same way round, by less than a full turn. Returns
+    # (centre x, centre y, direction), or None
+    start_x, start_y = start
+    middle_x, middle_y = points[(first + end) // 2]
+    end_x, end_y = points[end]
+
+    # The centre is where the perpendicular bisectors of the chords meet
+    ax = middle_x - start_x
+    ay = middle_y - start_y
+    bx = end_x - start_x
+    by = end_y - start_y
+    determinant = 2.0 * (ax * by - ay * bx)
+    if determinant == 0:
+        return None
+
+    a_squared = ax * ax + ay * ay
+    b_squared = bx * bx + by * by
+    offset_x = (by * a_squared - ay * b_squared) / determinant
+    offset_y = (ax * b_squared - bx * a_squared) / determinant
+    radius = math.hypot(offset_x, offset_y)
+
+    if radius > max_radius:
+        return None
+
+    centre_x = start_x + offset_x
+    centre_y = start_y + offset_y
+
+    # Anti-clockwise turns are positive
+    clockwise = determinant < 0
+    sweep = 0.0
+    previous_angle = math.atan2(start_y - centre_y, start_x - centre_x)
+
+    for index in xrange(first, end + 1):
+        point_x, point_y = points[index]
+        if abs(math.hypot(point_x - centre_x, point_y - centre_y) - radius) > tolerance:
+            return None
+
+        angle = math.atan2(point_y - centre_y, point_x - centre_x)
+        step = angle - previous_angle
+        if step > math.pi:
+            step -= 2 * math.pi
+        elif step <= -math.pi:
+            step += 2 * math.pi
+        previous_angle = angle
+
+        if clockwise:
+            step = -step
+
+        # Every move has to carry on round the same way, and the middle of each straight move has to stay close
+        # enough to the arc
+        if step <= 0 or radius * (1 - math.cos(step / 2)) > tolerance:
+            return None
+
+        sweep += step
+        if sweep >= 2 * math.pi:
+            return None
+
+    if clockwise:
+        return centre_x, centre_y, ArcDirection.CLOCKWISE
+    else:
+        return centre_x, centre_y, ArcDirection.ANTI_CLOCKWISE
@@ -0,0 +1,380 @@
+__author__ = 'Richard'
+
+# Writes a program as a series of chunk files that can each be run on their own, for copying to a machine's SD card or
+# sending over a network a piece at a time. Every chunk after the first starts by setting up everything the lines
+# before it left set, so a job that stopped part way through can be carried on from the start of the chunk it stopped
+# in. A manifest saved with the chunks records the lines, bounding box and checksum of each, to find that chunk and to
+# check that the chunks arrived intact. Chunks can be compressed, which is done in a background thread while the next
+# chunk is being output. Requires numpy.
+
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import Queue
+import threading
+from StringIO import StringIO
+
+import numpy
+
+from gcode import stages
+from gcode.estimate import ProgramState, block_states
+from gcode.file import FileOutput
+from gcode.line import Comment, SetUnits, SetMovementMode, SetToolState, MoveRapid, MoveFeed, Units, MovementMode
+
+# A chunk is ended at the first line of the program after it reaches this many characters
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+MANIFEST_VERSION = 1
+MANIFEST_EXTENSION = ".manifest.json"
+
+# How many chunks can be waiting to be written before output waits for them
+WRITE_QUEUE_SIZE = 2
+
+
+class Compression:
+    GZIP = "gzip"
+    BZ2 = "bz2"
+    ALL = [GZIP, BZ2]
+
+# The file extension of the chunks, for each kind of compression or None for none
+_EXTENSIONS = {None: ".gcode", Compression.GZIP: ".gcode.gz", Compression.BZ2: ".gcode.bz2"}
+
+
+class Chunk(object):
+    """
+    One chunk of a program written by write_chunks, in filename. It has the lines of the program from start_line up to
+    (but not including) end_line, after the lines that set it up, and is output_lines lines and output_bytes characters
+    long before it is compressed. bounding_box is where the head goes while the chunk runs, from where it starts and
+    the ends of its moves. checksum is the SHA-256 of the file as it was written, which is file_bytes long.
+    """
+
+    def __init__(self, index, filename, start_line, end_line, output_lines, output_bytes, bounding_box=None,
+                 checksum=None, file_bytes=None):
+        self.index = index
+        self.filename = filename
+        self.start_line = start_line
+        self.end_line = end_line
+        self.output_lines = output_lines
+        self.output_bytes = output_bytes
+        self.bounding_box = bounding_box
+        self.checksum = checksum
+        self.file_bytes = file_bytes
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "filename": self.filename,
+            "start_line": self.start_line,
+            "end_line": self.end_line,
+            "output_lines": self.output_lines,
+            "output_bytes": self.output_bytes,
+            "bounding_box": self.bounding_box,
+            "checksum": self.checksum,
+            "file_bytes": self.file_bytes
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values["index"], values["filename"], values["start_line"], values["end_line"],
+                   values["output_lines"], values["output_bytes"], values["bounding_box"], values["checksum"],
+                   values["file_bytes"])
+
+    def __repr__(self):
+        return "Chunk({}: lines {}-{}, {})".format(self.index, self.start_line, self.end_line, self.filename)
+
+
+class ChunkManifest(object):
+    """
+    The chunks write_chunks split a program of total_lines lines into, in order, and how they are compressed.
+    """
+
+    def __init__(self, name, total_lines, compression, chunks):
+        self.name = name
+        self.total_lines = total_lines
+        self.compression = compression
+        self.chunks = chunks
+
+    def chunk_for_line(self, line):
+        # The chunk with the given line of the program, which a job that stopped at that line carries on from
+        for chunk in self.chunks:
+            if chunk.start_line <= line < chunk.end_line:
+                return chunk
+
+        raise IndexError("line index out of range")
+
+    def verify(self, directory):
+        # The chunks whose files in directory are missing, or don't match their checksums
+        damaged = []
+        for chunk in self.chunks:
+            try:
+                with open(os.path.join(directory, chunk.filename), "rb") as chunk_file:
+                    checksum = hashlib.sha256(chunk_file.read()).hexdigest()
+            except IOError:
+                checksum = None
+
+            if checksum != chunk.checksum:
+                damaged.append(chunk)
+
+        return damaged
+
+    def to_dict(self):
+        return {
+            "version": MANIFEST_VERSION,
+            "name": self.name,
+            "total_lines": self.total_lines,
+            "compression": self.compression,
+            "chunks": [chunk.to_dict() for chunk in self.chunks]
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        if values.get("version") != MANIFEST_VERSION:
+            raise ValueError("Not a chunk manifest of this version")
+
+        return cls(values["name"], values["total_lines"], values["compression"],
+                   [Chunk.from_dict(chunk) for chunk in values["chunks"]])
+
+
+def save_manifest(manifest, path):
+    with open(path, "w") as manifest_file:
+        json.dump(manifest.to_dict(), manifest_file, indent=2, sort_keys=True)
+
+
+def load_manifest(path):
+    with open(path) as manifest_file:
+        return ChunkManifest.from_dict(json.load(manifest_file))
+
+
+def write_chunks(gcode_file, machine, directory, name="program", max_lines=None, max_bytes=DEFAULT_MAX_BYTES,
+                 compression=None):
+    """
+    Write the program for the machine to chunk files in directory, named name followed by the number of the chunk,
+    with a manifest of them in name + MANIFEST_EXTENSION. A chunk ends at the first line of the program after it has
+    max_lines output lines or max_bytes characters, either of which can be None for no limit. compression is None or
+    one of Compression.ALL. Line numbers carry on from one chunk to the next. Returns the ChunkManifest.
+    """
+    if compression not in _EXTENSIONS:
+        raise ValueError("Unknown compression: {}".format(compression))
+    if (max_lines is not None and max_lines < 1) or (max_bytes is not None and max_bytes < 1):
+        raise ValueError("Chunks need room for at least one line")
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with stages.stage("write_chunks") as stage:
+        writer = _ChunkWriter(directory, compression)
+        writer.start()
+        try:
+            chunker = _Chunker(gcode_file, machine, name, _EXTENSIONS[compression], max_lines, max_bytes, writer)
+            chunks = chunker.write()
+        finally:
+            writer.close()
+
+        _set_bounding_boxes(gcode_file, chunks)
+        manifest = ChunkManifest(name, len(gcode_file.lines), compression, chunks)
+        save_manifest(manifest, os.path.join(directory, name + MANIFEST_EXTENSION))
+
+        stage.lines = chunker.output_lines
+
+    return manifest
+
+
+class _Chunker(object):
+    # Splits the output of a program into chunks as it is generated, starting each chunk after the first with lines
+    # that set up what the program had set at that point
+
+    def __init__(self, gcode_file, machine, name, extension, max_lines, max_bytes, writer):
+        self.file = gcode_file
+        self.file_output = FileOutput(gcode_file, machine, len(gcode_file.lines))
+        self.name = name
+        self.extension = extension
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.writer = writer
+
+        self.states = _iter_line_states(gcode_file)
+        self.state_block = None
+
+        self.chunks = []
+        self.start_line = 0
+        self.parts = []
+        self.lines = 0
+        self.bytes = 0
+        self.output_lines = 0
+
+    def write(self):
+        for line_output in self.file_output.output_lines(self._iter_lines()):
+            self.parts.append(line_output)
+            self.lines += 1
+            self.bytes += len(line_output)
+
+        self._end_chunk(len(self.file.lines))
+        return self.chunks
+
+    def _iter_lines(self):
+        # The lines of the program for output_lines. Each is only asked for once everything output for the line before
+        # it has been added to the chunk, so the chunk can be ended in between
+        for index, line in enumerate(self.file_output.file_commands(self.file)):
+            if self._full():
+                self._end_chunk(index)
+                for start_line in self._start_lines(index):
+                    yield start_line
+
+            yield line
+
+    def _full(self):
+        return ((self.max_lines is not None and self.lines >= self.max_lines) or
+                (self.max_bytes is not None and self.bytes >= self.max_bytes))
+
+    def _end_chunk(self, end_line):
+        filename = "{}-{:04d}{}".format(self.name, len(self.chunks), self.extension)
+        chunk = Chunk(len(self.chunks), filename, self.start_line, end_line, self.lines, self.bytes)
+
+        text = "".join(self.parts)
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        self.writer.write(chunk, text)
+
+        self.chunks.append(chunk)
+        self.output_lines += self.lines
+        self.start_line = end_line
+        self.parts = []
+        self.lines = 0
+        self.bytes = 0
+
+    def _start_lines(self, index):
+        # The lines that set everything up as it was before the line at index, so that a chunk starting there can be
+        # run on its own. The head is moved in absolute mm, as it is tracked, before the units and mode are put back
+        x, y, z, inches, relative, feed_rate, tool_power = self._state_before(index)
+
+        # Nothing can be taken as already set when the chunk is run, so the machine has to output all of it
+        if self.file_output.modal_state is not None:
+            self.file_output.modal_state.reset()
+
+        lines = [Comment("Chunk {} carries on from line {} of the program".format(len(self.chunks), index)),
+                 SetUnits(Units.MM), SetMovementMode(MovementMode.ABSOLUTE), SetToolState(0, "Turn the tool off"),
+                 MoveRapid(x, y, z)]
+
+        if feed_rate == feed_rate:
+            lines.append(MoveFeed(feed_rate=feed_rate))
+        if tool_power != 0:
+            if tool_power.is_integer():
+                tool_power = int(tool_power)
+            lines.append(SetToolState(tool_power))
+        if inches:
+            lines.append(SetUnits(Units.INCHES))
+        if relative:
+            lines.append(SetMovementMode(MovementMode.RELATIVE))
+
+        return lines
+
+    def _state_before(self, index):
+        # What is set after the line before index, from the block of states it is in. index only ever goes up
+        line = index - 1
+        while self.state_block is None or line >= self.state_block[1]:
+            self.state_block = next(self.states)
+
+        start, end, relative, x, y, z, inches, feed_rate, tool_power = self.state_block
+        line -= start
+        return (float(x[line]), float(y[line]), float(z[line]), bool(inches[line]), bool(relative[line]),
+                float(feed_rate[line]), float(tool_power[line]))
+
+
+class _ChunkWriter(threading.Thread):
+    # Compresses and writes chunks in the background, so that the next chunk is being output in the meantime. Both zlib
+    # and bz2 let other threads run while they compress
+
+    def __init__(self, directory, compression):
+        super(_ChunkWriter, self).__init__()
+        self.daemon = True
+        self.directory = directory
+        self.compression = compression
+        self.queue = Queue.Queue(WRITE_QUEUE_SIZE)
+        self.error = None
+
+    def write(self, chunk, text):
+        # Chunks are written in the order they are given. Stops at the first chunk that couldn't be written
+        if self.error is not None:
+            raise self.error
+        self.queue.put((chunk, text))
+
+    def close(self):
+        # Wait for the chunks that are left to be written
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            if self.error is None:
+                try:
+                    self._write_chunk(*item)
+                except Exception as error:
+                    self.error = error
+
+    def _write_chunk(self, chunk, text):
+        if self.compression == Compression.GZIP:
+            # Without a time or name in the header, the same program always gives the same file
+            data = StringIO()
+            with gzip.GzipFile("", "wb", compresslevel=6, fileobj=data, mtime=0) as gzip_file:
+                gzip_file.write(text)
+            text = data.getvalue()
+        elif self.compression == Compression.BZ2:
+            text = bz2.compress(text)
+
+        with open(os.path.join(self.directory, chunk.filename), "wb") as chunk_file:
+            chunk_file.write(text)
+
+        chunk.checksum = hashlib.sha256(text).hexdigest()
+        chunk.file_bytes = len(text)
+
+
+def _iter_line_states(gcode_file, block_size=65536):
+    # What is set after each line of the program, as it is output, a block of lines at a time. Yields (start, end,
+    # relative, x, y, z, inches, feed_rate, tool_power) as arrays of the lines from start up to end, as
+    # gcode.estimate.block_states gives them
+    state = ProgramState()
+    lines = gcode_file.lines
+    for block in lines.iter_column_blocks(gcode_file.transform, block_size):
+        x, y, z, inches, feed_rate, tool_power = block_states(lines, block, state)
+        yield (block[0], block[1], block[3], x, y, z, inches, feed_rate, tool_power)
+
+
+def _set_bounding_boxes(gcode_file, chunks):
+    # Each chunk's box covers where the head is before and after each of its lines, so includes where it starts
+    starts = numpy.array([chunk.start_line for chunk in chunks])
+    minimum = numpy.full((len(chunks), 3), numpy.inf)
+    maximum = numpy.full((len(chunks), 3), -numpy.inf)
+
+    previous = numpy.zeros((1, 3))
+    for start, end, relative, x, y, z, inches, feed_rate, tool_power in _iter_line_states(gcode_file):
+        if start == end:
+            continue
+
+        after = numpy.column_stack((x, y, z))
+        before = numpy.concatenate((previous, after[:-1]))
+        previous = after[-1:]
+
+        # The lines of the block are split into runs in the same chunk
+        chunk_of_line = numpy.searchsorted(starts, numpy.arange(start, end), "right") - 1
+        runs = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(chunk_of_line)) + 1))
+        run_chunks = chunk_of_line[runs]
+
+        for points in (before, after):
+            minimum[run_chunks] = numpy.minimum(minimum[run_chunks], numpy.minimum.reduceat(points, runs))
+            maximum[run_chunks] = numpy.maximum(maximum[run_chunks], numpy.maximum.reduceat(points, runs))
+
+    for chunk, low, high in zip(chunks, minimum.tolist(), maximum.tolist()):
+        if chunk.start_line == chunk.end_line:
+            # Only an empty program has an empty chunk, and it stays where it starts
+            low = high = [0.0, 0.0, 0.0]
+
+        chunk.bounding_box = {"min_x": low[0], "min_y": low[1], "min_z": low[2],
+                              "max_x": high[0], "max_y": high[1], "max_z": high[2]}
@@ -0,0 +1,319 @@
+__author__ = 'Richard'
+
+# Estimates how long a program will take to run, by planning its moves the way a controller such as grbl or Marlin
+# does. Every move accelerates up to its speed and slows down in time for the next one, and corners limit the speed
+# the head can carry through them. The planning is done with numpy over all of the moves at once.
+
+import datetime
+import math
+
+import numpy
+
+from gcode import stages
+from gcode.store import Opcode
+from gcode.transform import axis_positions
+
+MM_PER_INCH = 25.4
+
+# Moves shorter than this (in mm) are far smaller than a step of any machine, so the controller won't make them
+MIN_MOVE_LENGTH = 1e-6
+
+
+class JobEstimate(object):
+    """
+    How long a program is expected to take, in seconds, and how far it moves, in mm. Lasing is any feed move or arc
+    made with the tool on, and travel is everything else.
+    """
+
+    def __init__(self, lasing_time=0.0, travel_time=0.0, lasing_distance=0.0, travel_distance=0.0, moves=0):
+        self.lasing_time = lasing_time
+        self.travel_time = travel_time
+        self.lasing_distance = lasing_distance
+        self.travel_distance = travel_distance
+        self.moves = moves
+
+    @property
+    def total_time(self):
+        return self.lasing_time + self.travel_time
+
+    @property
+    def total_distance(self):
+        return self.lasing_distance + self.travel_distance
+
+    def __str__(self):
+        return ("Estimated time: {total} (lasing {lasing}, travel {travel})\n"
+                "Distance: {total_distance:.1f}mm (lasing {lasing_distance:.1f}mm, travel {travel_distance:.1f}mm) "
+                "in {moves} moves").format(total=_format_time(self.total_time),
+                                           lasing=_format_time(self.lasing_time),
+                                           travel=_format_time(self.travel_time),
+                                           total_distance=self.total_distance,
+                                           lasing_distance=self.lasing_distance,
+                                           travel_distance=self.travel_distance,
+                                           moves=self.moves)
+
+
+def estimate_job(gcode_file, machine, block_size=65536):
+    """
+    Estimate how long the file will take to run on the machine, using its max_feed_rate, rapid_rate, acceleration
+    and junction_deviation. Returns a JobEstimate.
+    """
+    with stages.stage("estimate") as stage:
+        stage.lines = len(gcode_file.lines)
+        return _estimate_job(gcode_file, machine, block_size)
+
+
+def command_density(gcode_file, machine):
+    """
+    Count the commands in the file, and how many of them there are for each mm lased. A controller can only get
+    through so many commands a second, which on dense rasters limits how fast it can go. Returns (commands,
+    commands per mm), with no commands per mm if nothing is lased.
+    """
+    opcodes = gcode_file.lines.opcodes
+    commands = len(opcodes) - opcodes.count(Opcode.BLANK) - opcodes.count(Opcode.COMMENT)
+
+    lasing_distance = estimate_job(gcode_file, machine).lasing_distance
+    if not lasing_distance:
+        return commands, None
+
+    return commands, commands / lasing_distance
+
+
+def _estimate_job(gcode_file, machine, block_size):
+    state = ProgramState()
+    blocks = [_block_moves(gcode_file.lines, block, state)
+              for block in gcode_file.lines.iter_column_blocks(gcode_file.transform, block_size)]
+
+    if not blocks:
+        return JobEstimate()
+
+    lengths, tangents_in, tangents_out, rapid, feed_rate, tool_power = [numpy.concatenate(columns)
+                                                                        for columns in zip(*blocks)]
+
+    # Moves that go nowhere are dropped by the controller, and so don't slow it down
+    moving = lengths >= MIN_MOVE_LENGTH
+    lengths = lengths[moving]
+    tangents_in = tangents_in[moving]
+    tangents_out = tangents_out[moving]
+    rapid = rapid[moving]
+    feed_rate = feed_rate[moving]
+    tool_power = tool_power[moving]
+
+    # Speeds in mm/s. A feed move without any feed rate yet goes at the maximum
+    speeds = numpy.where(rapid, machine.rapid_rate, numpy.fmin(feed_rate, machine.max_feed_rate)) / 60.0
+
+    times = plan_move_times(lengths, tangents_in, tangents_out, speeds, machine.acceleration,
+                            machine.junction_deviation)
+
+    lasing = ~rapid & (tool_power > 0)
+    return JobEstimate(lasing_time=float(times[lasing].sum()), travel_time=float(times[~lasing].sum()),
+                       lasing_distance=float(lengths[lasing].sum()), travel_distance=float(lengths[~lasing].sum()),
+                       moves=len(lengths))
+
+
+def plan_move_times(lengths, tangents_in, tangents_out, speeds, acceleration, junction_deviation):
+    """
+    Work out how long each of a series of moves takes with a trapezoidal speed profile. lengths and speeds (in mm/s)
+    are arrays with an entry per move, and tangents_in and tangents_out the unit direction of each move at its start
+    and end. The head starts and finishes at rest.
+    """
+    if not len(lengths):
+        return numpy.zeros(0)
+
+    two_acceleration = 2.0 * acceleration
+
+    # The fastest each corner can be taken, from the junction deviation as grbl does it. Going straight on is only
+    # limited by the speeds of the moves either side, and turning back on yourself needs a stop
+    cos_theta = numpy.clip(-numpy.sum(tangents_out[:-1] * tangents_in[1:], axis=1), -1.0, 1.0)
+    sin_half_theta = numpy.sqrt(0.5 * (1.0 - cos_theta))
+    with numpy.errstate(divide="ignore"):
+        corner_limits = numpy.where(sin_half_theta < 1.0, acceleration * junction_deviation * sin_half_theta /
+                                    (1.0 - sin_half_theta), numpy.inf)
+    corner_limits = numpy.minimum(corner_limits, numpy.minimum(speeds[:-1], speeds[1:]) ** 2)
+
+    # The limit on the speed squared at the start of each move, and at the end of the last one
+    limits = numpy.concatenate(([0.0], corner_limits, [0.0]))
+    distance = numpy.concatenate(([0.0], numpy.cumsum(lengths)))
+
+    # Accelerating at most a over distance s can only change the speed squared by 2as. So the speed squared at a
+    # junction is at most that at any junction before plus 2a times the distance since, and likewise for any after
+    forward = numpy.minimum.accumulate(limits - two_acceleration * distance) + two_acceleration * distance
+    backward = numpy.minimum.accumulate((limits + two_acceleration * distance)[::-1])[::-1] - \
+        two_acceleration * distance
+    entry_speeds = numpy.sqrt(numpy.maximum(numpy.minimum(limits, numpy.minimum(forward, backward)), 0.0))
+
+    start_speeds = entry_speeds[:-1]
+    end_speeds = entry_speeds[1:]
+
+    # Each move gets up to its speed, cruises and slows down again. Moves too short to reach their speed only get up
+    # to the peak that they can still slow down from
+    accelerate_distance = (speeds ** 2 - start_speeds ** 2) / two_acceleration
+    decelerate_distance = (speeds ** 2 - end_speeds ** 2) / two_acceleration
+    cruise_distance = lengths - accelerate_distance - decelerate_distance
+
+    reaches_speed = cruise_distance >= 0
+    peak_speeds = numpy.where(reaches_speed, speeds,
+                              numpy.sqrt(numpy.maximum(acceleration * lengths +
+                                                       (start_speeds ** 2 + end_speeds ** 2) / 2.0, 0.0)))
+
+    return ((peak_speeds - start_speeds) / acceleration + (peak_speeds - end_speeds) / acceleration +
+            numpy.where(reaches_speed, cruise_distance / speeds, 0.0))
+
+
+class ProgramState(object):
+    # What has to be carried from one block of lines to the next, as a program is replayed
+
+    def __init__(self):
+        self.x = 0.0
+        self.y = 0.0
+        self.z = 0.0
+        self.inches = False
+        self.feed_rate = numpy.nan
+        self.tool_power = 0.0
+
+
+def block_states(lines, block, state):
+    """
+    Replay a block of lines from LineStore.iter_column_blocks, carrying on from the ProgramState left by the block
+    before it, which is updated to the state after the block. Returns arrays of what is set after each of the lines:
+    where the head is in x, y and z (in mm), whether the units are inches, and the feed rate (in mm/min, NaN if there
+    hasn't been one) and tool power.
+    """
+    start, end, opcodes, relative, x, y, z, arc_i, arc_j = block
+
+    is_linear = (opcodes == Opcode.RAPID) | (opcodes == Opcode.FEED)
+    is_arc = (opcodes == Opcode.ARC_CW) | (opcodes == Opcode.ARC_ANTI_CW)
+    positioned = is_linear | is_arc
+    absolute = positioned & ~relative
+    deltas = positioned & relative
+
+    # Everything is worked out in mm
+    is_units = (opcodes == Opcode.UNITS_MM) | (opcodes == Opcode.UNITS_INCHES)
+    inches = _carry_forward(is_units, opcodes == Opcode.UNITS_INCHES, state.inches)
+    scale = numpy.where(inches, MM_PER_INCH, 1.0)
+
+    positions = []
+    for axis, values in (("x", x), ("y", y), ("z", z)):
+        after = axis_positions(values * scale, absolute, deltas, getattr(state, axis))
+        positions.append(after)
+        if len(after):
+            setattr(state, axis, float(after[-1]))
+
+    # The feed rate and tool power stay set until they are changed
+    feed_rate = numpy.frombuffer(lines.feed_rate, dtype=numpy.float64)[start:end] * scale
+    feed_rate = _carry_forward(~numpy.isnan(feed_rate), feed_rate, state.feed_rate)
+    values = numpy.frombuffer(lines.values, dtype=numpy.float64)[start:end]
+    tool_power = _carry_forward(opcodes == Opcode.TOOL_STATE, values, state.tool_power)
+
+    if len(opcodes):
+        state.inches = bool(inches[-1])
+        state.feed_rate = float(feed_rate[-1])
+        state.tool_power = float(tool_power[-1])
+
+    x_after, y_after, z_after = positions
+    return x_after, y_after, z_after, inches, feed_rate, tool_power
+
+
+def block_segments(lines, block, state):
+    """
+    Replay a block of lines from LineStore.iter_column_blocks, carrying on from the ProgramState left by the block
+    before it. Returns arrays for the moves in the block: their start and end points (in mm), opcodes, arc centre
+    offsets (in mm, NaN for linear moves), and the feed rate and tool power they are made with.
+    """
+    opcodes, arc_i, arc_j = block[2], block[7], block[8]
+    first_position = (state.x, state.y, state.z)
+    x_after, y_after, z_after, inches, feed_rate, tool_power = block_states(lines, block, state)
+
+    positioned = ((opcodes == Opcode.RAPID) | (opcodes == Opcode.FEED) | (opcodes == Opcode.ARC_CW) |
+                  (opcodes == Opcode.ARC_ANTI_CW))
+    scale = numpy.where(inches, MM_PER_INCH, 1.0)
+
+    # Only the moves are kept
+    start_points = numpy.column_stack([numpy.concatenate(([first], after[:-1]))[positioned]
+                                       for first, after in zip(first_position, (x_after, y_after, z_after))])
+    end_points = numpy.column_stack([after[positioned] for after in (x_after, y_after, z_after)])
+
+    return (start_points, end_points, opcodes[positioned], arc_i[positioned] * scale[positioned],
+            arc_j[positioned] * scale[positioned], feed_rate[positioned], tool_power[positioned])
+
+
+def arc_sweeps(start_points, end_points, arc_i, arc_j, clockwise):
+    """
+    The centres, radii and angles swept (in radians, negative for clockwise) of arcs. An arc that ends where it
+    starts is a full circle. Moves that aren't arcs have NaN offsets, and so get NaN values.
+    """
+    centre_x = start_points[:, 0] + arc_i
+    centre_y = start_points[:, 1] + arc_j
+    start_x = start_points[:, 0] - centre_x
+    start_y = start_points[:, 1] - centre_y
+    end_x = end_points[:, 0] - centre_x
+    end_y = end_points[:, 1] - centre_y
+    radius = numpy.hypot(start_x, start_y)
+
+    with numpy.errstate(invalid="ignore"):
+        # The angle swept, going the right way round
+        angle = numpy.arctan2(start_x * end_y - start_y * end_x, start_x * end_x + start_y * end_y)
+        angle = numpy.where(clockwise, -angle, angle)
+        angle = numpy.where(angle <= 0, angle + 2 * math.pi, angle)
+
+    return centre_x, centre_y, radius, numpy.where(clockwise, -angle, angle)
+
+
+def _block_moves(lines, block, state):
+    # Find the moves in a block of lines from LineStore.iter_column_blocks. Returns arrays of their lengths,
+    # directions at each end, whether they are rapids, and the feed rate and tool power they are made with
+    start_points, end_points, opcodes, arc_i, arc_j, feed_rate, tool_power = block_segments(lines, block, state)
+
+    chords = end_points - start_points
+    chord_lengths = numpy.sqrt(numpy.sum(chords ** 2, axis=1))
+
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        directions = numpy.nan_to_num(chords / chord_lengths[:, numpy.newaxis])
+
+    lengths = chord_lengths
+    tangents_in = directions
+    tangents_out = directions
+
+    arcs = (opcodes == Opcode.ARC_CW) | (opcodes == Opcode.ARC_ANTI_CW)
+    if arcs.any():
+        lengths, tangents_in, tangents_out = _arc_moves(arcs, start_points, end_points, arc_i, arc_j,
+                                                        opcodes == Opcode.ARC_CW, lengths, tangents_in, tangents_out)
+
+    return lengths, tangents_in, tangents_out, opcodes == Opcode.RAPID, feed_rate, tool_power
+
+
+def _arc_moves(arcs, start_points, end_points, arc_i, arc_j, clockwise, lengths, tangents_in, tangents_out):
+    # Replace the straight line lengths and directions of the arcs with those around the arc. The other moves have
+    # NaN offsets, so give nonsense values that are then ignored
+    centre_x, centre_y, radius, angle = arc_sweeps(start_points, end_points, arc_i, arc_j, clockwise)
+    start_x = start_points[:, 0] - centre_x
+    start_y = start_points[:, 1] - centre_y
+    end_x = end_points[:, 0] - centre_x
+    end_y = end_points[:, 1] - centre_y
+    angle = numpy.abs(angle)
+
+    with numpy.errstate(invalid="ignore"):
+        arcs = arcs & (radius > 0)
+    arc_lengths = numpy.hypot(radius * angle, end_points[:, 2] - start_points[:, 2])
+    lengths = numpy.where(arcs, arc_lengths, lengths)
+
+    # Tangents are at right angles to the radius. Any change in Z over the arc is ignored for these
+    direction = numpy.where(clockwise, -1.0, 1.0)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        arc_tangents_in = numpy.column_stack((-start_y * direction / radius, start_x * direction / radius,
+                                              numpy.zeros(len(radius))))
+        arc_tangents_out = numpy.column_stack((-end_y * direction / radius, end_x * direction / radius,
+                                               numpy.zeros(len(radius))))
+
+    tangents_in = numpy.where(arcs[:, numpy.newaxis], arc_tangents_in, tangents_in)
+    tangents_out = numpy.where(arcs[:, numpy.newaxis], arc_tangents_out, tangents_out)
+    return lengths, tangents_in, tangents_out
+
+
+def _carry_forward(is_set, values, initial):
+    # The value from the last line at or before each line where is_set, or initial if there isn't one
+    last_set = numpy.maximum.accumulate(numpy.where(is_set, numpy.arange(len(is_set)), -1))
+    return numpy.where(last_set >= 0, values[numpy.maximum(last_set, 0)], initial)
+
+
+def _format_time(seconds):
+    return str(datetime.timedelta(seconds=int(round(seconds))))
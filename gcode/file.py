@@ -1,19 +1,30 @@
 __author__ = 'Richard'
 
+from gcode import stages
+from gcode.fixed import snap
 from gcode.line import LineType
+from gcode.store import LineStore
+from gcode.transform import Transform
 import math
 
 class File(object):
-    def __init__(self, line_ending="\n", line_numbers=False, include_comments=True, movement_precision=3):
-        self.lines = []
+    def __init__(self, line_ending="\n", line_numbers=False, include_comments=True, movement_precision=3,
+                 compress_modal_state=False, tool_power_tolerance=0):
+        self.lines = LineStore()
         self.line_index = 1
         self.line_number_digits = 3
-        self.bounding_box = {"min_x": 0, "min_y": 0, "min_z": 0, "max_x": 0, "max_y": 0, "max_z": 0}
+        # The bounding box of the lines as they were added, before the transform is applied
+        self.untransformed_bounding_box = {"min_x": 0, "min_y": 0, "min_z": 0, "max_x": 0, "max_y": 0, "max_z": 0}
+        self.transform = Transform()
         self.output_properties = {
             "line_ending" : line_ending,
             "line_numbers" : line_numbers,
             "include_comments" : include_comments,
-            "movement_precision" : movement_precision
+            "movement_precision" : movement_precision,
+            # Leave out words and lines that only repeat what the controller already has set
+            "compress_modal_state" : compress_modal_state,
+            # With compress_modal_state, changes in tool state no bigger than this are left out
+            "tool_power_tolerance" : tool_power_tolerance
         }
 
     def add_line(self, line, index=None):
@@ -31,9 +42,39 @@ class File(object):
 
                 if value is None:
                     value = 0
+                elif self.lines.precision is not None:
+                    value = snap(value, self.lines.precision)
 
-                self.bounding_box[bounding_min] = min(self.bounding_box[bounding_min], value)
-                self.bounding_box[bounding_max] = max(self.bounding_box[bounding_max], value)
+                self.untransformed_bounding_box[bounding_min] = min(self.untransformed_bounding_box[bounding_min], value)
+                self.untransformed_bounding_box[bounding_max] = max(self.untransformed_bounding_box[bounding_max], value)
+
+    def append_file(self, other):
+        # Add all of the lines from another file to the end of this one
+        if not other.transform.is_identity():
+            raise ValueError("Only a file without a transform can be appended")
+
+        self.lines.extend_store(other.lines)
+
+        for axis in ["x", "y", "z"]:
+            bounding_min = "min_{}".format(axis)
+            bounding_max = "max_{}".format(axis)
+            self.untransformed_bounding_box[bounding_min] = min(self.untransformed_bounding_box[bounding_min],
+                                                                other.untransformed_bounding_box[bounding_min])
+            self.untransformed_bounding_box[bounding_max] = max(self.untransformed_bounding_box[bounding_max],
+                                                                other.untransformed_bounding_box[bounding_max])
+
+    @property
+    def bounding_box(self):
+        # Transforming the corners of the box is exact for moves and quarter turns, and a safe overestimate otherwise
+        return self.transform.apply_bounding_box(self.untransformed_bounding_box)
+
+    @bounding_box.setter
+    def bounding_box(self, bounding_box):
+        self.untransformed_bounding_box = bounding_box
+
+    def iter_lines(self):
+        # The lines with the file's transform applied, as they will be output
+        return self.lines.iter_lines(self.transform)
 
     def set_output_properties(self, properties):
         for prop in self.output_properties.keys():
@@ -50,45 +91,76 @@ class File(object):
             return None
 
     def output(self, machine):
-
-        self.set_output_properties(machine.get_output_properties())
-
-        # Calculate how many digits the line numbers should have so that everything lines up nicely
-        self.line_number_digits = int(math.ceil(math.log10(len(self.lines))))
-
-        output_str = ""
-
-        for line in self.lines:
-            # Use the passed output function to output the line. It may return a string or a list of strings
-            command_output = machine.line_output_function(self, line)
-
-            if type(command_output) is list:
-                for command_output_line in command_output:
-                    output_str += self.__output_line(line, command_output_line)
-            else:
-                output_str += self.__output_line(line, command_output)
-
-        return output_str
-
-    def __output_line(self, line, line_str):
-
-        line_output = ""
-        line_number_str = ""
-
-        if self.get_output_property("line_numbers"):
-            line_number_str = "N{line_number:0{line_number_digits}.0f} ".format(line_number=self.line_index, line_number_digits=self.line_number_digits)
-
-        if self.get_output_property("include_comments"):
-            line_str += " " + line.output_comment()
-
-        if line_str.strip() != "":
-            line_output += line_number_str + line_str.strip() + self.get_output_property("line_ending")
-            self.line_index += 1
-        elif line.type == LineType.BLANK:
-            line_output += self.get_output_property("line_ending")
-
-        return line_output
-
+        with stages.stage("output") as stage:
+            file_output = FileOutput(self, machine, len(self.lines))
+            output = "".join(file_output.output_file(self))
+            stage.lines = file_output.line_index - 1
+
+        return output
+
+    def output_lines(self, machine):
+        # Generate the program one output line at a time, so that it never has to be held in memory in full
+        return FileOutput(self, machine, len(self.lines)).output_file(self)
+
+    def write_to(self, fileobj, machine, buffer_size=1024 * 1024):
+        # Write the program to the given file object, in chunks of roughly buffer_size characters
+        with stages.stage("write") as stage:
+            file_output = FileOutput(self, machine, len(self.lines))
+            file_output.write_file(fileobj, self, buffer_size)
+            stage.lines = file_output.line_index - 1
+
+    def write_chunks(self, directory, machine, name="program", max_lines=None, max_bytes=4 * 1024 * 1024,
+                     compression=None):
+        # Write the program to chunk files that can each be run on their own, with a manifest of them, as for
+        # gcode.chunks.write_chunks. Returns the ChunkManifest. Requires numpy
+        from gcode.chunks import write_chunks
+        return write_chunks(self, machine, directory, name, max_lines, max_bytes, compression)
+
+    def estimate(self, machine):
+        # Estimate how long the program will take to run on the machine, as a JobEstimate. Requires numpy
+        from gcode.estimate import estimate_job
+        return estimate_job(self, machine)
+
+    def render(self, mm_per_pixel=0.1, bounds=None, min_power=0):
+        # Draw what the program burns, as a Rendering with mm_per_pixel sized pixels covering bounds (min_x, min_y,
+        # max_x, max_y), or the area around everything lased by default. Requires numpy
+        from gcode.simulate import render
+        return render(self, mm_per_pixel, bounds, min_power)
+
+    def clip(self, min_x, min_y, max_x, max_y):
+        # A new file with just the moves inside the region, cut at its edges, as for gcode.spatial.clip_file.
+        # Requires numpy
+        from gcode.spatial import clip_file
+        return clip_file(self, min_x, min_y, max_x, max_y)
+
+    def split_tiles(self, tile_width, tile_height=None):
+        # Split the program into tiles that can be run separately, as a list of gcode.spatial.Tile. Requires numpy
+        from gcode.spatial import split_tiles
+        return split_tiles(self, tile_width, tile_height)
+
+    def optimise_travel(self, island_gap=1.0):
+        # Reorder the lased paths of the program to cut down the travel between them, replacing its lines, as for
+        # gcode.travel.optimise_travel. Returns a TravelReport. Requires numpy
+        from gcode.travel import optimise_travel
+        return optimise_travel(self, island_gap)
+
+    def fit_arcs(self, tolerance=0.01):
+        # Replace runs of short feed moves that follow a circle with arcs, staying within tolerance (in mm) of them.
+        # Returns how many arcs were made
+        from gcode.arcs import fit_arcs
+        return fit_arcs(self, tolerance)
+
+    def quantize(self, precision=None):
+        # Store the distances of the lines rounded to the precision they are output at, movement_precision by default,
+        # as whole numbers of units (see gcode.fixed). Lines added later are rounded too, and so are moves of the
+        # whole program, so that moving it around many times doesn't drift
+        if precision is None:
+            precision = self.get_output_property("movement_precision")
+
+        self.lines.set_precision(precision)
+        for key, value in self.untransformed_bounding_box.items():
+            self.untransformed_bounding_box[key] = snap(value, precision)
+        self._snap_translation()
 
     def _format_distance(self, movement):
         return round(movement, self.get_output_property("movement_precision"))
@@ -104,14 +176,167 @@ class File(object):
 
 
 
-    def translate(self, x=0, y=0, z=0):
-        for line in self.lines:
-            if line.type == LineType.MOVE_LINEAR or line.type == LineType.MOVE_ARC:
-                if line.x is not None:
-                    line.x += x
+    # Transforms are only recorded here, and are applied to the lines as the file is output. As a result they apply
+    # to every line of the file, including lines added after the transform, where moving the lines straight away
+    # only moved those that were already there. Add all the lines first to transform just those
 
-                if line.y is not None:
-                    line.y += y
+    def translate(self, x=0, y=0, z=0):
+        """
+        Move the whole program, including any lines added later.
+        """
+        self.add_transform(Transform.translation(x, y, z))
+        self._snap_translation()
+
+    def scale(self, x=1, y=None, z=1):
+        """
+        Scale the whole program about the origin, including any lines added later. y defaults to the same as x, so
+        that the shape is kept.
+        """
+        if y is None:
+            y = x
+        self.add_transform(Transform.scaling(x, y, z))
+
+    def rotate(self, degrees, centre_x=0, centre_y=0):
+        """
+        Rotate the whole program anti-clockwise about the centre, looking down on the XY plane. Lines added later
+        are rotated too.
+        """
+        self.add_transform(Transform.rotation(degrees, centre_x, centre_y))
+
+    def mirror(self, x=False, y=False, centre_x=0, centre_y=0):
+        """
+        Mirror the whole program in X and / or Y about the centre. Lines added later are mirrored too.
+        """
+        self.add_transform(Transform.mirroring(x, y, centre_x, centre_y))
+
+    def add_transform(self, transform):
+        """
+        Follow the transforms already recorded with another Transform, which applies to all of the lines of the file
+        when it is output, whenever they were added.
+        """
+        self.transform = self.transform.then(transform)
+
+    def reset_transform(self):
+        self.transform = Transform()
+
+    def _snap_translation(self):
+        # A quantized program that has only been moved is moved by whole units, which its lines add to exactly
+        transform = self.transform
+        precision = self.lines.precision
+        if precision is not None and (transform.a, transform.b, transform.d, transform.e, transform.z_scale) == \
+                (1, 0, 0, 1, 1):
+            transform.c = snap(transform.c, precision)
+            transform.f = snap(transform.f, precision)
+            transform.z_offset = snap(transform.z_offset, precision)
+
+
+class FileOutput(object):
+    """
+    Outputs lines for a machine with the output properties of a file. The line numbers and the machine's modal state
+    carry on from one call to the next, so the lines of several files can be output one after another as a single
+    program. total_lines is how many lines the whole program has, which sets the width of the line numbers.
+    """
+
+    def __init__(self, gcode_file, machine, total_lines):
+        gcode_file.set_output_properties(machine.get_output_properties())
+        self.file = gcode_file
 
-                if line.z is not None:
-                    line.z += z
+        # Calculate how many digits the line numbers should have so that everything lines up nicely
+        self.line_number_digits = int(math.ceil(math.log10(total_lines))) if total_lines > 0 else 0
+        self.line_index = 1
+        gcode_file.line_number_digits = self.line_number_digits
+
+        # Work out everything that depends on the machine and the output properties once, rather than for every line
+        self.modal_state = machine.create_modal_state(gcode_file)
+        self.emitters = machine.build_emitters(gcode_file, self.modal_state)
+        self.line_ending = gcode_file.get_output_property("line_ending")
+        self.line_numbers = gcode_file.get_output_property("line_numbers")
+        self.include_comments = gcode_file.get_output_property("include_comments")
+
+    def output_file(self, gcode_file):
+        # Generate the output for the lines of a file, with its transform applied, one output line at a time
+        return self.output_lines(self.file_commands(gcode_file))
+
+    def file_commands(self, gcode_file):
+        # The lines of a file, with its transform applied, as output_lines takes them. Moves and tool states are output
+        # a block at a time where their emitters can do that
+        emitters = self.emitters
+        return gcode_file.lines.iter_commands(gcode_file.transform,
+                                              getattr(emitters.get(LineType.MOVE_LINEAR), "emit_columns", None),
+                                              getattr(emitters.get(LineType.TOOL_STATE), "emit_columns", None))
+
+    def output_lines(self, lines):
+        # Generate the output for each of the lines, one output line at a time. Lines already output by an emitter's
+        # emit_columns function are given as a tuple of the commands and the comment, as LineStore.iter_commands
+        # gives them
+        gcode_file = self.file
+        emitters = self.emitters
+        line_ending = self.line_ending
+        line_numbers = self.line_numbers
+        include_comments = self.include_comments
+        line_number_digits = self.line_number_digits
+        line_index = self.line_index
+
+        for line in lines:
+            if type(line) is tuple:
+                command_output, comment = line
+                line = None
+                if include_comments and comment is not None:
+                    comment = " ; " + comment
+                else:
+                    comment = ""
+            else:
+                # The machine's emitter for the type of line gives a string or a list of strings
+                emitter = emitters.get(line.type)
+                if emitter is not None:
+                    command_output = emitter(line)
+                else:
+                    command_output = line.output(gcode_file)
+
+                if include_comments and line.comment is not None:
+                    comment = " " + line.output_comment()
+                else:
+                    comment = ""
+
+            if type(command_output) is not list:
+                command_output = (command_output,)
+
+            for line_str in command_output:
+                line_str = (line_str + comment).strip()
+
+                if line_str:
+                    if line_numbers:
+                        yield "N%0*d %s%s" % (line_number_digits, line_index, line_str, line_ending)
+                    else:
+                        yield line_str + line_ending
+                    line_index += 1
+                elif line is not None and line.type == LineType.BLANK:
+                    yield line_ending
+
+        self.line_index = line_index
+        gcode_file.line_index = line_index
+
+    def write_lines(self, fileobj, lines, buffer_size=1024 * 1024):
+        # Write the output to the given file object, collecting lines into chunks of roughly buffer_size characters
+        # so that the underlying stream sees a few large writes rather than millions of small ones
+        self._write(fileobj, self.output_lines(lines), buffer_size)
+
+    def write_file(self, fileobj, gcode_file, buffer_size=1024 * 1024):
+        # Write the output for the lines of a file, as for write_lines
+        self._write(fileobj, self.output_file(gcode_file), buffer_size)
+
+    def _write(self, fileobj, output, buffer_size):
+        chunk = []
+        chunk_size = 0
+
+        for line_output in output:
+            chunk.append(line_output)
+            chunk_size += len(line_output)
+
+            if chunk_size >= buffer_size:
+                fileobj.write("".join(chunk))
+                chunk = []
+                chunk_size = 0
+
+        if chunk:
+            fileobj.write("".join(chunk))
@@ -0,0 +1,238 @@
+__author__ = 'Richard'
+
+# Fixed-point numbers for output. A distance rounded to the output precision is a whole number of units of
+# 10^-precision mm, which can be added up without drifting and turned into text without going through round() and
+# float formatting. The text is always exactly what str(round(value, precision)) gives, which is what the lines have
+# always been output as, so a program comes out the same whichever way its numbers are formatted.
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Formatted values kept by each formatter before it starts again, which bounds the memory they use
+FORMAT_CACHE_SIZE = 65536
+
+# Scaled values this close to half a unit may have been rounded the wrong way by the scaling, and are worked out the
+# slow way. Scaling is out by far less than this for anything under MAX_FAST_UNITS
+HALF_UNIT_TOLERANCE = 1e-6
+
+# str gives floats to 12 significant digits, so numbers of units with more digits than this are printed with fewer
+MAX_FAST_UNITS = 10 ** 12
+
+# str gives floats from this big up, and smaller than MIN_FIXED_NOTATION, as an exponent
+MAX_FIXED_NOTATION = 1e11
+MIN_FIXED_NOTATION = 1e-4
+
+
+def units_per_mm(precision):
+    return 10.0 ** precision
+
+
+def to_units(value, precision):
+    """
+    The value rounded to the precision, which can't be negative, as a whole number of units of 10^-precision. This
+    is the same as round(value, precision) gives, including rounding halves away from zero, other than -0.0 being 0.
+    """
+    scaled = value * units_per_mm(precision)
+    if scaled >= 0:
+        units = int(scaled + 0.5)
+    else:
+        units = -int(0.5 - scaled)
+
+    if abs(scaled) >= MAX_FAST_UNITS or abs(abs(scaled) % 1 - 0.5) < HALF_UNIT_TOLERANCE:
+        units = _exact_units(value, precision)
+
+    return units
+
+
+def _exact_units(value, precision):
+    # Round the value the slow way, and read the digits of the result, which repr gives exactly for anything with up
+    # to 17 significant digits
+    text = repr(round(value, precision))
+    if "e" in text:
+        return int(round(value, precision) * units_per_mm(precision))
+
+    whole, _, fraction = text.partition(".")
+    return int(whole + fraction.ljust(precision, "0")[:precision])
+
+
+def from_units(units, precision):
+    # The nearest float to the number of units, which is what round gives for the same value
+    return units / units_per_mm(precision)
+
+
+def format_units(units, precision):
+    """
+    A whole number of units of 10^-precision as text, the same as str(from_units(units, precision)).
+    """
+    magnitude = abs(units)
+    value = from_units(magnitude, precision)
+    if magnitude >= MAX_FAST_UNITS or value >= MAX_FIXED_NOTATION or (magnitude and value < MIN_FIXED_NOTATION):
+        return str(from_units(units, precision))
+
+    if units < 0:
+        sign = "-"
+    else:
+        sign = ""
+
+    if precision == 0:
+        return "%s%d.0" % (sign, magnitude)
+
+    digits = "%0*d" % (precision + 1, magnitude)
+    return sign + digits[:-precision] + "." + (digits[-precision:].rstrip("0") or "0")
+
+
+def distance_formatter(precision, cache_size=FORMAT_CACHE_SIZE):
+    """
+    Build a function that gives a distance as text, the same as "%s" % round(distance, precision). Programs use the
+    same few values over and over, so each is only worked out once, up to cache_size of them at a time.
+    """
+    cache = {}
+
+    def format_distance(distance):
+        text = cache.get(distance)
+        if text is not None:
+            return text
+
+        try:
+            units = to_units(distance, precision)
+        except (ValueError, OverflowError):
+            # Not a number, or infinite
+            return "%s" % round(distance, precision)
+
+        if units == 0:
+            # round keeps the sign of values that round to nothing. Zero and negative zero are the same key, so
+            # neither of them is kept
+            return str(math.copysign(0.0, distance))
+
+        if len(cache) >= cache_size:
+            cache.clear()
+
+        text = cache[distance] = format_units(units, precision)
+        return text
+
+    return format_distance
+
+
+def power_table(format_power, max_power=255):
+    """
+    The text for every whole tool power from 0 to max_power, worked out with format_power, for looking up rather than
+    formatting each time. Tool powers only take a few hundred values, however long the program.
+    """
+    return [format_power(power) for power in xrange(max_power + 1)]
+
+
+def power_column_emitter(table, format_power):
+    """
+    Build a function that gives what format_power does for each of a numpy array of tool powers, as an object array.
+    Whole powers are looked up in a table from power_table, and anything else is formatted, with whole powers as ints
+    as the lines have them. Requires numpy.
+    """
+    lookup = numpy.empty(len(table), dtype=object)
+    for power, commands in enumerate(table):
+        lookup[power] = commands
+
+    def emit_powers(powers):
+        with numpy.errstate(invalid="ignore"):
+            whole = (powers == numpy.floor(powers)) & (powers >= 0) & (powers < len(table))
+
+        output = numpy.empty(len(powers), dtype=object)
+        output[whole] = lookup[powers[whole].astype(numpy.intp)]
+
+        for index in numpy.flatnonzero(~whole).tolist():
+            power = float(powers[index])
+            if power.is_integer():
+                power = int(power)
+            output[index] = format_power(power)
+
+        return output
+
+    return emit_powers
+
+
+def column_formatter(prefix, precision, cache_size=FORMAT_CACHE_SIZE):
+    """
+    Build a function that gives the words for a numpy array of distances at once, as an object array of prefix
+    followed by the same text as distance_formatter gives, or "" where the distance is NaN (not used). The distances
+    are turned into units together, and each different number of units is only formatted once. Requires numpy.
+    """
+    scale = units_per_mm(precision)
+    format_distance = distance_formatter(precision, cache_size)
+    words = {}
+    zero = prefix + "0.0"
+    negative_zero = prefix + "-0.0"
+
+    def format_column(distances):
+        scaled = distances * scale
+        magnitude = numpy.abs(scaled)
+        units = numpy.floor(magnitude + 0.5)
+
+        with numpy.errstate(invalid="ignore"):
+            unused = numpy.isnan(distances)
+            rounds_to_zero = units == 0
+            fast = (magnitude < MAX_FAST_UNITS) & (numpy.abs(magnitude % 1 - 0.5) >= HALF_UNIT_TOLERANCE)
+        fast &= ~rounds_to_zero
+
+        output = numpy.empty(len(distances), dtype=object)
+        output[unused] = ""
+        # round keeps the sign of values that round to nothing
+        output[rounds_to_zero & ~numpy.signbit(distances)] = zero
+        output[rounds_to_zero & numpy.signbit(distances)] = negative_zero
+
+        different_units, inverse = numpy.unique(numpy.copysign(units[fast], scaled[fast]).astype(numpy.int64),
+                                                return_inverse=True)
+        if len(words) + len(different_units) > cache_size:
+            words.clear()
+
+        different_words = numpy.empty(len(different_units), dtype=object)
+        for index, units_value in enumerate(different_units.tolist()):
+            word = words.get(units_value)
+            if word is None:
+                word = words[units_value] = prefix + format_units(units_value, precision)
+            different_words[index] = word
+        output[fast] = different_words[inverse]
+
+        # Halves and anything too big or not finite are worked out one at a time
+        for index in numpy.flatnonzero(~(fast | unused | rounds_to_zero)).tolist():
+            output[index] = prefix + format_distance(float(distances[index]))
+
+        return output
+
+    return format_column
+
+
+def snap(value, precision):
+    """
+    The value rounded to the precision, as the float nearest to a whole number of units. Snapped values add up and
+    come out as text without any drift. None is left as it is, and values that round to nothing keep their sign.
+    """
+    if value is None or value != value:
+        return value
+
+    try:
+        units = to_units(value, precision)
+    except OverflowError:
+        # Infinite
+        return value
+
+    return math.copysign(from_units(units, precision), value)
+
+
+def snap_column(values, precision):
+    """
+    A numpy array of values snapped to the precision, as snap gives for each of them. Requires numpy.
+    """
+    scaled = values * units_per_mm(precision)
+    magnitude = numpy.abs(scaled)
+    units = numpy.floor(magnitude + 0.5)
+    with numpy.errstate(invalid="ignore"):
+        slow = ~(magnitude < MAX_FAST_UNITS) | (numpy.abs(magnitude % 1 - 0.5) < HALF_UNIT_TOLERANCE)
+
+    snapped = numpy.copysign(units / units_per_mm(precision), values)
+    for index in numpy.flatnonzero(slow).tolist():
+        snapped[index] = snap(float(values[index]), precision)
+
+    return snapped
@@ -6,6 +6,7 @@ class LineType:
 
 
 class Line(object):
+    __slots__ = ("type", "comment")
 
     def __init__(self, line_type=LineType.UNKNOWN, comment=None):
         self.type = line_type
@@ -21,6 +22,8 @@ class Line(object):
             return ""
 
 class BlankLine(Line):
+    __slots__ = ()
+
     def __init__(self):
         super(BlankLine, self).__init__(LineType.BLANK)
 
@@ -28,6 +31,7 @@ class BlankLine(Line):
         return ""
 
 class Comment(Line):
+    __slots__ = ()
 
     def __init__(self, comment):
         super(Comment, self).__init__(LineType.COMMENT, comment)
@@ -35,10 +39,23 @@ class Comment(Line):
     def output(self, file):
         return ""
 
+class RawLine(Line):
+    # A command that isn't understood, such as one read from an existing file. It is output exactly as given
+    __slots__ = ("text",)
+
+    def __init__(self, text, comment=None):
+        super(RawLine, self).__init__(LineType.UNKNOWN, comment)
+        self.text = text
+
+    def output(self, file):
+        return self.text
+
 
 
 
 class SetMovementMode(Line):
+    __slots__ = ("mode",)
+
     def __init__(self, mode, comment=None):
         super(SetMovementMode, self).__init__(LineType.SET_MOVEMENT_MODE, comment)
         self.mode = mode
@@ -55,6 +72,8 @@ class MovementMode:
 
 
 class SetUnits(Line):
+    __slots__ = ("units",)
+
     def __init__(self, units, comment=None):
         super(SetUnits, self).__init__(LineType.SET_UNITS, comment)
         self.units = units
@@ -72,6 +91,8 @@ class Units:
 
 
 class MoveLinear(Line):
+    __slots__ = ("move_type", "x", "y", "z", "feed_rate")
+
     def __init__(self, move_type, x=None, y=None, z=None, feed_rate=None, comment=None):
         super(MoveLinear, self).__init__(LineType.MOVE_LINEAR, comment)
         self.move_type = move_type
@@ -102,10 +123,14 @@ class MoveLinear(Line):
         return gcode_str
 
 class MoveRapid(MoveLinear):
+    __slots__ = ()
+
     def __init__(self, x=None, y=None, z=None, feed_rate=None, comment=None):
         super(MoveRapid, self).__init__(MoveType.RAPID, x, y, z, feed_rate, comment)
 
 class MoveFeed(MoveLinear):
+    __slots__ = ()
+
     def __init__(self, x=None, y=None, z=None, feed_rate=None, comment=None):
         super(MoveFeed, self).__init__(MoveType.FEED, x, y, z, feed_rate, comment)
 
@@ -114,13 +139,20 @@ class MoveType:
     RAPID, FEED = range(2)
 
 class MoveArc(Line):
-    def __init__(self, direction, end_x, end_y, center_offset_x, center_offset_y, comment=None):
+    __slots__ = ("direction", "end_x", "end_y", "center_offset_x", "center_offset_y", "z", "feed_rate")
+
+    # z and feed_rate come after comment so that arcs made with a comment keep working
+    def __init__(self, direction, end_x, end_y, center_offset_x, center_offset_y, comment=None, z=None,
+                 feed_rate=None):
         super(MoveArc, self).__init__(LineType.MOVE_ARC, comment)
         self.direction = direction
         self.end_x = end_x
         self.end_y = end_y
         self.center_offset_x = center_offset_x
         self.center_offset_y = center_offset_y
+        # A Z move made over the arc, which makes it a helix
+        self.z = z
+        self.feed_rate = feed_rate
 
     def output(self, file):
         if self.direction == ArcDirection.CLOCKWISE:
@@ -128,7 +160,17 @@ class MoveArc(Line):
         else:
             gcode_str = "G3"
 
-        gcode_str += " X{} Y{} I{} J{}".format(self.end_x, self.end_y, self.center_offset_x, self.center_offset_y)
+        gcode_str += " X{} Y{}".format(file._format_distance(self.end_x), file._format_distance(self.end_y))
+
+        if self.z is not None:
+            gcode_str += " Z{}".format(file._format_distance(self.z))
+
+        gcode_str += " I{} J{}".format(file._format_distance(self.center_offset_x),
+                                       file._format_distance(self.center_offset_y))
+
+        if self.feed_rate is not None:
+            gcode_str += " F{}".format(file._format_distance(self.feed_rate))
+
         return gcode_str
 
 class ArcDirection:
@@ -136,6 +178,8 @@ class ArcDirection:
 
 
 class SetToolState(Line):
+    __slots__ = ("tool_state",)
+
     def __init__(self, tool_state, comment=None):
         super(SetToolState, self).__init__(LineType.TOOL_STATE, comment)
         self.tool_state = tool_state
@@ -0,0 +1,558 @@
+__author__ = 'Richard'
+
+import math
+import mmap
+import re
+import warnings
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from gcode.file import File
+from gcode.line import (BlankLine, Comment, RawLine, SetMovementMode, SetUnits, MoveLinear, MoveArc, SetToolState,
+                        MovementMode, Units, MoveType, ArcDirection, ToolState)
+from gcode.store import LineStore, Opcode
+
+# How much of the file is read at once. Memory use is bounded by this rather than the size of the file
+CHUNK_SIZE = 4 * 1024 * 1024
+
+WORD_REGEX = re.compile(r"([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)")
+PAREN_COMMENT_REGEX = re.compile(r"\(([^)]*)\)")
+
+# The commands that set the modal motion mode, and the linear move type they correspond to
+MOTION_COMMANDS = {"G0": 0, "G00": 0, "G1": 1, "G01": 1, "G2": 2, "G02": 2, "G3": 3, "G03": 3}
+LINEAR_MOVE_TYPES = {0: MoveType.RAPID, 1: MoveType.FEED}
+LINEAR_MOTIONS = {Opcode.RAPID: 0, Opcode.FEED: 1}
+
+# Lookup tables used to recognise simple lines a whole chunk at a time
+LETTER_CODE_LOOKUP = {"G": 1, "M": 2, "X": 3, "Y": 4, "Z": 5, "F": 6, "S": 7}
+NUM_LETTER_CODES = 8
+NEWLINE = ord("\n")
+SPACE = ord(" ")
+TAB = ord("\t")
+DOT = ord(".")
+PLUS = ord("+")
+MINUS = ord("-")
+
+if numpy is not None:
+    LETTER_CODES = numpy.zeros(256, dtype=numpy.uint8)
+    for _letter, _code in LETTER_CODE_LOOKUP.items():
+        LETTER_CODES[ord(_letter)] = _code
+
+    NUMBER_CHARACTERS = numpy.zeros(256, dtype=bool)
+    NUMBER_CHARACTERS[[ord(character) for character in "0123456789.-+"]] = True
+
+    DIGITS = numpy.zeros(256, dtype=bool)
+    DIGITS[[ord(character) for character in "0123456789"]] = True
+
+    SIMPLE_CHARACTERS = NUMBER_CHARACTERS | (LETTER_CODES > 0)
+    SIMPLE_CHARACTERS[[ord(character) for character in " \t\r\n"]] = True
+
+    # Keeps the characters of numbers and turns everything else into spaces
+    NUMBER_TEXT = numpy.where(NUMBER_CHARACTERS, numpy.arange(256), SPACE).astype(numpy.uint8)
+
+
+class ParseError(ValueError):
+    pass
+
+
+class ParserState(object):
+    # The modal state carried from one line to the next
+
+    def __init__(self):
+        self.motion = None
+        self.movement_mode = MovementMode.ABSOLUTE
+        self.x = 0.0
+        self.y = 0.0
+
+
+def read_file(path, **file_properties):
+    """
+    Read an existing G-code file into a File. Any File constructor arguments may be passed through.
+    """
+    gcode_file = File(**file_properties)
+    gcode_file.lines = parse_chunks(iter_chunks(path))
+    gcode_file.bounding_box = gcode_file.lines.bounding_box()
+    return gcode_file
+
+
+def read_string(text, **file_properties):
+    gcode_file = File(**file_properties)
+    gcode_file.lines = parse_chunks([text.rstrip("\r\n")])
+    gcode_file.bounding_box = gcode_file.lines.bounding_box()
+    return gcode_file
+
+
+def iter_file(path):
+    """
+    Generate the Line objects in a G-code file one at a time, without ever holding the whole file in memory.
+    """
+    state = ParserState()
+    for chunk in iter_chunks(path):
+        for raw_line in chunk.split("\n"):
+            for line in parse_line(raw_line, state):
+                yield line
+
+
+def iter_chunks(path, chunk_size=CHUNK_SIZE):
+    # Generate blocks of whole lines from a memory mapped file. The final newline of each block is removed
+    with open(path, "rb") as source:
+        # Empty files can't be memory mapped
+        source.seek(0, 2)
+        if source.tell() == 0:
+            return
+
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            remainder = ""
+            position = 0
+            size = mapped.size()
+
+            while position < size:
+                chunk = remainder + mapped[position:position + chunk_size]
+                position += chunk_size
+
+                # The last line may carry on into the next chunk
+                last_newline = chunk.rfind("\n")
+                if last_newline < 0:
+                    remainder = chunk
+                    continue
+
+                remainder = chunk[last_newline + 1:]
+                yield chunk[:last_newline]
+
+            if remainder:
+                yield remainder
+        finally:
+            mapped.close()
+
+
+def parse_chunks(chunks):
+    store = LineStore()
+    state = ParserState()
+
+    for chunk in chunks:
+        if numpy is None:
+            _parse_chunk_by_line(chunk, store, state)
+        else:
+            _parse_chunk_vectorized(chunk, store, state)
+
+    return store
+
+
+def _parse_chunk_by_line(chunk, store, state):
+    for raw_line in chunk.split("\n"):
+        for line in parse_line(raw_line, state):
+            store.append(line)
+
+
+def _parse_chunk_vectorized(chunk, store, state):
+    # Simple lines (plain G0/G1 moves, M106 S power changes and blank lines) are recognised and decoded for the
+    # whole chunk at once with numpy, and go straight into the store's columns. Everything else is handed to
+    # parse_line in order, one line at a time
+    if not chunk:
+        _parse_chunk_by_line(chunk, store, state)
+        return
+
+    data = numpy.frombuffer(chunk, dtype=numpy.uint8)
+    line_starts = numpy.concatenate(([0], numpy.flatnonzero(data == NEWLINE) + 1))
+    line_ends = numpy.concatenate((line_starts[1:] - 1, [len(data)]))
+    num_lines = len(line_starts)
+
+    simple = numpy.ones(num_lines, dtype=bool)
+    simple[_line_numbers(numpy.flatnonzero(~SIMPLE_CHARACTERS[data]), line_starts)] = False
+
+    # Every letter must be immediately followed by a number
+    letter_positions = numpy.flatnonzero(LETTER_CODES[data])
+    letter_lines = _line_numbers(letter_positions, line_starts)
+    _reject(simple, line_starts, letter_positions, ~_is_next(data, letter_positions, NUMBER_CHARACTERS))
+
+    # and every number must be a well formed one that follows a letter
+    _reject(simple, line_starts, line_starts, NUMBER_CHARACTERS[data[numpy.minimum(line_starts, len(data) - 1)]])
+    whitespace = numpy.flatnonzero((data == SPACE) | (data == TAB))
+    _reject(simple, line_starts, whitespace, _is_next(data, whitespace, NUMBER_CHARACTERS))
+
+    signs = numpy.flatnonzero((data == PLUS) | (data == MINUS))
+    _reject(simple, line_starts, signs, ~_is_previous(data, signs, LETTER_CODES > 0))
+    _reject(simple, line_starts, signs, ~_is_next(data, signs, DIGITS | (numpy.arange(256) == DOT)))
+
+    dots = numpy.flatnonzero(data == DOT)
+    _reject(simple, line_starts, dots, ~_is_previous(data, dots, DIGITS) & ~_is_next(data, dots, DIGITS))
+    # Two dots belonging to the same word
+    dot_words = numpy.searchsorted(letter_positions, dots) - 1
+    repeated_dots = numpy.concatenate(([False], dot_words[1:] == dot_words[:-1])) | (dot_words < 0)
+    _reject(simple, line_starts, dots, repeated_dots)
+
+    numbers_text = NUMBER_TEXT[data]
+    numbers, words_on_simple_lines = _parse_numbers(numbers_text, simple, line_starts, line_ends, letter_lines)
+
+    if numbers is None or len(numbers) != words_on_simple_lines.sum():
+        # This shouldn't happen, but if the numbers can't be matched up to their words then be safe
+        _parse_chunk_by_line(chunk, store, state)
+        return
+
+    codes = LETTER_CODES[data[letter_positions[words_on_simple_lines]]].astype(numpy.int64)
+    word_lines = letter_lines[words_on_simple_lines]
+
+    counts = numpy.bincount(word_lines * NUM_LETTER_CODES + codes, minlength=num_lines * NUM_LETTER_CODES)
+    counts = counts.reshape(num_lines, NUM_LETTER_CODES)
+
+    words = {}
+    for letter, code in LETTER_CODE_LOOKUP.items():
+        column = numpy.empty(num_lines)
+        column.fill(numpy.nan)
+        is_letter = codes == code
+        column[word_lines[is_letter]] = numbers[is_letter]
+        words[letter] = column
+
+    word_total = counts.sum(axis=1)
+    no_repeats = (counts <= 1).all(axis=1)
+    moves = (no_repeats & (counts[:, LETTER_CODE_LOOKUP["G"]] == 1) & (counts[:, LETTER_CODE_LOOKUP["M"]] == 0) &
+             (counts[:, LETTER_CODE_LOOKUP["S"]] == 0) & ((words["G"] == 0) | (words["G"] == 1)))
+    tool_states = (no_repeats & (word_total == 2) & (words["M"] == 106) & (counts[:, LETTER_CODE_LOOKUP["S"]] == 1))
+    blanks = word_total == 0
+    # A line without letters may still hold stray numbers
+    for line in numpy.flatnonzero(blanks & simple).tolist():
+        if chunk[line_starts[line]:line_ends[line]].strip():
+            blanks[line] = False
+
+    simple &= moves | tool_states | blanks
+
+    opcodes = numpy.zeros(num_lines, dtype=numpy.uint8)
+    opcodes[blanks] = Opcode.BLANK
+    opcodes[tool_states] = Opcode.TOOL_STATE
+    opcodes[moves & (words["G"] == 0)] = Opcode.RAPID
+    opcodes[moves & (words["G"] == 1)] = Opcode.FEED
+
+    columns = (opcodes, words["X"], words["Y"], words["Z"], words["F"], words["S"])
+
+    position = 0
+    for complex_line in numpy.flatnonzero(~simple).tolist() + [num_lines]:
+        if complex_line > position:
+            _extend_store(store, state, [values[position:complex_line] for values in columns])
+
+        if complex_line < num_lines:
+            raw_line = chunk[line_starts[complex_line]:line_ends[complex_line]]
+            for line in parse_line(raw_line, state):
+                store.append(line)
+
+        position = complex_line + 1
+
+
+def _reject(simple, line_starts, positions, rejected):
+    # Mark the lines holding any rejected positions as needing to be parsed one at a time
+    simple[_line_numbers(positions[rejected], line_starts)] = False
+
+
+def _is_next(data, positions, table):
+    result = numpy.zeros(len(positions), dtype=bool)
+    has_next = positions + 1 < len(data)
+    result[has_next] = table[data[positions[has_next] + 1]]
+    return result
+
+
+def _is_previous(data, positions, table):
+    result = numpy.zeros(len(positions), dtype=bool)
+    has_previous = positions > 0
+    result[has_previous] = table[data[positions[has_previous] - 1]]
+    return result
+
+
+def _line_numbers(positions, line_starts):
+    return numpy.searchsorted(line_starts, positions, "right") - 1
+
+
+def _parse_numbers(numbers_text, simple, line_starts, line_ends, letter_lines):
+    # Only the numbers on simple lines are parsed, the rest of the chunk is blanked out
+    numbers_text = numbers_text.copy()
+    for line in numpy.flatnonzero(~simple).tolist():
+        numbers_text[line_starts[line]:line_ends[line]] = SPACE
+
+    # numpy stops at the first thing it can't read as a number, and warns (or in later versions, raises) about it
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        try:
+            numbers = numpy.fromstring(numbers_text.tostring(), dtype=numpy.float64, sep=" ")
+        except ValueError:
+            numbers = None
+
+    if caught:
+        numbers = None
+
+    return numbers, simple[letter_lines]
+
+
+def _extend_store(store, state, columns):
+    opcodes, x, y, z, feed_rate, tool_state = columns
+
+    # Bring the parser state up to date with the moves that skipped parse_line
+    move_indexes = numpy.flatnonzero((opcodes == Opcode.RAPID) | (opcodes == Opcode.FEED))
+    if len(move_indexes):
+        state.motion = LINEAR_MOTIONS[int(opcodes[move_indexes[-1]])]
+
+        relative = state.movement_mode == MovementMode.RELATIVE
+        for axis, column in (("x", x), ("y", y)):
+            given = numpy.flatnonzero(~numpy.isnan(column))
+            if not len(given):
+                continue
+
+            if relative:
+                # Accumulate in order so the position matches adding the moves up one line at a time
+                steps = numpy.concatenate(([getattr(state, axis)], column[given]))
+                setattr(state, axis, float(numpy.cumsum(steps)[-1]))
+            else:
+                setattr(state, axis, float(column[given[-1]]))
+
+    store.extend_columns(_to_array("B", opcodes), _to_array("d", x), _to_array("d", y), _to_array("d", z),
+                         _to_array("d", feed_rate), _to_array("d", tool_state))
+
+
+def _to_array(typecode, values):
+    column = array(typecode)
+    column.fromstring(numpy.ascontiguousarray(values, dtype=numpy.dtype(typecode)).tostring())
+    return column
+
+
+def parse_line(raw_line, state=None):
+    """
+    Parse a single line of G-code, returning a list of the Line objects it contains.
+    """
+    if state is None:
+        state = ParserState()
+
+    text = raw_line.strip()
+    comments = []
+
+    # Semicolon comments run to the end of the line, bracketed comments can be anywhere
+    semicolon = text.find(";")
+    if semicolon >= 0:
+        comments.append(text[semicolon + 1:].strip())
+        text = text[:semicolon]
+
+    if "(" in text:
+        comments = [comment.strip() for comment in PAREN_COMMENT_REGEX.findall(text)] + comments
+        text = PAREN_COMMENT_REGEX.sub(" ", text)
+
+    comment = "; ".join(comment for comment in comments if comment) or None
+
+    # Checksums are only meaningful for the line as it was sent, so they are dropped
+    asterisk = text.find("*")
+    if asterisk >= 0:
+        text = text[:asterisk]
+
+    text = text.strip()
+
+    if text == "":
+        if comment is not None:
+            return [Comment(comment)]
+        elif raw_line.strip() == "":
+            return [BlankLine()]
+        else:
+            return []
+
+    words = [(letter.upper(), value) for letter, value in WORD_REGEX.findall(text)]
+
+    # Anything that isn't made up of plain words is kept as it is
+    if WORD_REGEX.sub("", text).strip() != "":
+        return [RawLine(text, comment)]
+
+    lines = []
+    parameters = {}
+    unknown_words = []
+    motion = None
+
+    for letter, value in words:
+        if letter == "N":
+            continue
+
+        if letter == "G":
+            code = _code(value)
+            command = "G" + code
+            if command in MOTION_COMMANDS:
+                motion = MOTION_COMMANDS[command]
+            elif code == "20":
+                lines.append(SetUnits(Units.INCHES))
+            elif code == "21":
+                lines.append(SetUnits(Units.MM))
+            elif code == "90":
+                state.movement_mode = MovementMode.ABSOLUTE
+                lines.append(SetMovementMode(MovementMode.ABSOLUTE))
+            elif code == "91":
+                state.movement_mode = MovementMode.RELATIVE
+                lines.append(SetMovementMode(MovementMode.RELATIVE))
+            else:
+                unknown_words.append(letter + value)
+        elif letter == "M":
+            code = _code(value)
+            if code == "106":
+                lines.append(SetToolState(ToolState.ON))
+            elif code == "107":
+                lines.append(SetToolState(ToolState.OFF))
+            else:
+                unknown_words.append(letter + value)
+        elif letter in parameters:
+            raise ParseError("Repeated {} word in line: {}".format(letter, raw_line.strip()))
+        else:
+            parameters[letter] = value
+
+    if unknown_words:
+        if motion is not None:
+            _check_supported(unknown_words, raw_line)
+
+        # Keep the whole line so that nothing in it is lost or reordered
+        return [RawLine(text, comment)]
+
+    # M106 takes its power from the S word
+    if "S" in parameters and lines and isinstance(lines[-1], SetToolState) and lines[-1].tool_state != ToolState.OFF:
+        lines[-1].tool_state = _number(parameters.pop("S"))
+
+    if motion is None and set(parameters) & set("XYZIJRF"):
+        # Coordinates without a G word use the current modal motion command
+        motion = state.motion
+        if motion is None:
+            raise ParseError("Coordinates without a motion command: {}".format(raw_line.strip()))
+
+    if motion is not None:
+        if "S" in parameters:
+            # An S word on a move sets the tool power for the move and those after it, the same as a tool state change
+            # just before it
+            lines.append(SetToolState(_number(parameters.pop("S"))))
+
+        state.motion = motion
+        lines.append(_motion_line(motion, parameters, state, raw_line))
+    elif parameters:
+        return [RawLine(text, comment)]
+
+    if not lines:
+        return [RawLine(text, comment)]
+
+    lines[-1].comment = comment
+    return lines
+
+
+def _motion_line(motion, parameters, state, raw_line):
+    x = _optional_number(parameters.pop("X", None))
+    y = _optional_number(parameters.pop("Y", None))
+    z = _optional_number(parameters.pop("Z", None))
+    feed_rate = _optional_number(parameters.pop("F", None))
+
+    if motion in LINEAR_MOVE_TYPES:
+        _check_supported(sorted(parameters), raw_line)
+
+        if state.movement_mode == MovementMode.ABSOLUTE:
+            if x is not None:
+                state.x = x
+            if y is not None:
+                state.y = y
+        else:
+            if x is not None:
+                state.x += x
+            if y is not None:
+                state.y += y
+
+        return MoveLinear(LINEAR_MOVE_TYPES[motion], x, y, z, feed_rate)
+
+    if motion == 2:
+        direction = ArcDirection.CLOCKWISE
+    else:
+        direction = ArcDirection.ANTI_CLOCKWISE
+
+    start_x = state.x
+    start_y = state.y
+    relative = state.movement_mode == MovementMode.RELATIVE
+
+    if relative:
+        end_x = x if x is not None else 0.0
+        end_y = y if y is not None else 0.0
+    else:
+        end_x = x if x is not None else start_x
+        end_y = y if y is not None else start_y
+
+    radius = _optional_number(parameters.pop("R", None))
+    offset_x = _optional_number(parameters.pop("I", None))
+    offset_y = _optional_number(parameters.pop("J", None))
+
+    _check_supported(sorted(parameters), raw_line)
+
+    if radius is not None:
+        if offset_x is not None or offset_y is not None:
+            raise ParseError("Arc has both a radius and a centre: {}".format(raw_line.strip()))
+
+        if relative:
+            offset_x, offset_y = _arc_centre_from_radius(0.0, 0.0, end_x, end_y, radius, direction, raw_line)
+        else:
+            offset_x, offset_y = _arc_centre_from_radius(start_x, start_y, end_x, end_y, radius, direction, raw_line)
+    else:
+        offset_x = offset_x or 0.0
+        offset_y = offset_y or 0.0
+
+    if relative:
+        state.x += end_x
+        state.y += end_y
+    else:
+        state.x = end_x
+        state.y = end_y
+
+    return MoveArc(direction, end_x, end_y, offset_x, offset_y, z=z, feed_rate=feed_rate)
+
+
+def _check_supported(words, raw_line):
+    # A move with words that it can't hold would be transformed and reordered without them, so it isn't read at all
+    if words:
+        raise ParseError("Unsupported words in move ({}): {}".format(", ".join(words), raw_line.strip()))
+
+
+def _arc_centre_from_radius(start_x, start_y, end_x, end_y, radius, direction, raw_line):
+    # Returns the centre offset from the start point. A negative radius selects the arc longer than a semicircle
+    delta_x = end_x - start_x
+    delta_y = end_y - start_y
+    chord = math.hypot(delta_x, delta_y)
+
+    if chord == 0:
+        raise ParseError("Arc radius given for a zero length arc: {}".format(raw_line.strip()))
+
+    height_squared = 4 * radius * radius - delta_x * delta_x - delta_y * delta_y
+    if height_squared < 0:
+        # Allow for rounding in the source file when the arc is a semicircle
+        if height_squared > -1e-6 * radius * radius:
+            height_squared = 0
+        else:
+            raise ParseError("Arc radius is too small to reach the end point: {}".format(raw_line.strip()))
+
+    height_over_chord = -math.sqrt(height_squared) / chord
+
+    if direction == ArcDirection.ANTI_CLOCKWISE:
+        height_over_chord = -height_over_chord
+
+    if radius < 0:
+        height_over_chord = -height_over_chord
+
+    return (0.5 * (delta_x - delta_y * height_over_chord),
+            0.5 * (delta_y + delta_x * height_over_chord))
+
+
+def _code(value):
+    # "01" and "1" are the same command, but "1.1" is not
+    if "." in value:
+        whole, fraction = value.split(".", 1)
+        fraction = fraction.rstrip("0")
+        if fraction:
+            return str(int(whole)) + "." + fraction
+        value = whole
+    return str(int(value))
+
+
+def _number(value):
+    number = float(value)
+    if number.is_integer():
+        return int(number)
+    return number
+
+
+def _optional_number(value):
+    if value is None:
+        return None
+    return float(value)
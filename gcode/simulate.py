@@ -0,0 +1,230 @@
+__author__ = 'Richard'
+
+# Replays a program the way the machine runs it and draws what the laser burns into an image, so that a program can be
+# looked over before it is run, and checked against the image it was made from. The moves are drawn a batch at a time
+# with numpy, by placing points along them closely enough that every pixel they cross gets at least one.
+
+import math
+
+import numpy
+from PIL import Image
+
+from gcode import stages
+from gcode.estimate import ProgramState, block_segments, arc_sweeps
+from gcode.store import Opcode
+
+DEFAULT_MM_PER_PIXEL = 0.1
+
+# How many points are placed along each pixel's width of a move
+POINTS_PER_PIXEL = 2
+
+# How many points are placed at once, which bounds the memory used for big programs
+MAX_POINTS = 4 * 1024 * 1024
+
+# Moves along the edge between two pixels are drawn in the pixel above or to the right of it, allowing this much (in
+# pixels) for rounding
+EDGE_TOLERANCE = 1e-6
+
+
+class Rendering(object):
+    """
+    What a program burns, as a 2D numpy array of the tool power each pixel is lased with. Pixels that aren't lased
+    are 0, and those lased more than once have the highest power they get, with the lowest in lowest_powers. Row 0 is
+    the top of the image. x and y are the position (in mm) of its bottom left corner, and mm_per_pixel the size of its
+    pixels.
+    """
+
+    def __init__(self, powers, lowest_powers, x, y, mm_per_pixel):
+        self.powers = powers
+        self.lowest_powers = lowest_powers
+        self.x = x
+        self.y = y
+        self.mm_per_pixel = mm_per_pixel
+
+    @property
+    def lased_pixels(self):
+        return int(numpy.count_nonzero(self.powers))
+
+    def to_image(self, power_max=None):
+        """
+        The rendering as a greyscale PIL image, white where nothing is lased and black at power_max, which is the
+        highest power in the rendering by default.
+        """
+        if power_max is None:
+            power_max = self.powers.max() if self.powers.size else 0
+
+        darkness = numpy.zeros(self.powers.shape)
+        if power_max > 0:
+            darkness = numpy.clip(self.powers / float(power_max), 0.0, 1.0)
+
+        return Image.fromarray(numpy.round(255 * (1.0 - darkness)).astype(numpy.uint8), "L")
+
+    def __str__(self):
+        height, width = self.powers.shape
+        return "{} x {} pixels of {}mm from ({}, {}), {} lased".format(width, height, self.mm_per_pixel, self.x,
+                                                                       self.y, self.lased_pixels)
+
+
+def render(gcode_file, mm_per_pixel=DEFAULT_MM_PER_PIXEL, bounds=None, min_power=0, block_size=65536):
+    """
+    Replay the file and draw the moves it makes with the tool on, as seen from above. Rapids are made with the tool
+    off, and moves made at or below min_power are taken to be too. bounds is the area drawn, as (min_x, min_y, max_x,
+    max_y) in mm, which by default is the area around everything lased. Returns a Rendering.
+    """
+    if mm_per_pixel <= 0:
+        raise ValueError("Pixels have to be bigger than nothing")
+
+    if bounds is None:
+        bounds = lased_bounds(gcode_file, min_power, block_size)
+
+    min_x, min_y, max_x, max_y = bounds
+    width = _pixels_across(max_x - min_x, mm_per_pixel)
+    height = _pixels_across(max_y - min_y, mm_per_pixel)
+    powers = numpy.zeros((height, width))
+    lowest_powers = numpy.zeros((height, width))
+
+    with stages.stage("render") as stage:
+        for moves in _iter_lased_moves(gcode_file, min_power, block_size):
+            _draw_moves(powers, lowest_powers, min_x, min_y, mm_per_pixel, *moves)
+
+        stage.lines = len(gcode_file.lines)
+        stage.pixels = width * height
+
+    return Rendering(powers, lowest_powers, min_x, min_y, mm_per_pixel)
+
+
+def lased_bounds(gcode_file, min_power=0, block_size=65536):
+    """
+    The area around the moves the file makes with the tool above min_power, as (min_x, min_y, max_x, max_y) in mm.
+    Arcs are taken to go all the way round their circle. A file that lases nothing has no area, at the origin.
+    """
+    bounds = None
+    for start_points, end_points, opcodes, arc_i, arc_j, tool_power in _iter_lased_moves(gcode_file, min_power,
+                                                                                         block_size):
+        x = numpy.concatenate((start_points[:, 0], end_points[:, 0]))
+        y = numpy.concatenate((start_points[:, 1], end_points[:, 1]))
+
+        arcs = (opcodes == Opcode.ARC_CW) | (opcodes == Opcode.ARC_ANTI_CW)
+        if arcs.any():
+            centre_x = start_points[arcs, 0] + arc_i[arcs]
+            centre_y = start_points[arcs, 1] + arc_j[arcs]
+            radius = numpy.hypot(arc_i[arcs], arc_j[arcs])
+            x = numpy.concatenate((x, centre_x - radius, centre_x + radius))
+            y = numpy.concatenate((y, centre_y - radius, centre_y + radius))
+
+        block_bounds = (x.min(), y.min(), x.max(), y.max())
+        if bounds is None:
+            bounds = block_bounds
+        else:
+            bounds = (min(bounds[0], block_bounds[0]), min(bounds[1], block_bounds[1]),
+                      max(bounds[2], block_bounds[2]), max(bounds[3], block_bounds[3]))
+
+    if bounds is None:
+        return 0.0, 0.0, 0.0, 0.0
+
+    return tuple(float(value) for value in bounds)
+
+
+def _iter_lased_moves(gcode_file, min_power, block_size):
+    # Replay the file a block at a time, generating the start and end points, opcodes, arc offsets and tool power of
+    # each block's moves made with the tool above min_power
+    state = ProgramState()
+    for block in gcode_file.lines.iter_column_blocks(gcode_file.transform, block_size):
+        start_points, end_points, opcodes, arc_i, arc_j, feed_rate, tool_power = block_segments(gcode_file.lines,
+                                                                                                block, state)
+
+        lased = (opcodes != Opcode.RAPID) & (tool_power > min_power)
+        if lased.any():
+            yield (start_points[lased], end_points[lased], opcodes[lased], arc_i[lased], arc_j[lased],
+                   tool_power[lased])
+
+
+def _pixels_across(distance, mm_per_pixel):
+    # How many pixels it takes to cover the distance, without an extra one for rounding
+    return max(int(math.ceil(round(distance / mm_per_pixel, 6))), 0)
+
+
+def _draw_moves(powers, lowest_powers, min_x, min_y, mm_per_pixel, start_points, end_points, opcodes, arc_i, arc_j,
+                tool_power):
+    # Draw lased moves into powers and lowest_powers. Everything from here on is in pixels, from the bottom left
+    # corner of the image
+    starts = numpy.column_stack(((start_points[:, 0] - min_x) / mm_per_pixel,
+                                 (start_points[:, 1] - min_y) / mm_per_pixel))
+    ends = numpy.column_stack(((end_points[:, 0] - min_x) / mm_per_pixel, (end_points[:, 1] - min_y) / mm_per_pixel))
+    lengths = numpy.hypot(ends[:, 0] - starts[:, 0], ends[:, 1] - starts[:, 1])
+
+    # Arcs are followed around their circle, other than those without a radius, which the controller moves straight
+    # along the same as the estimate does
+    centre_x, centre_y, radius, sweep = arc_sweeps(starts, ends, arc_i / mm_per_pixel, arc_j / mm_per_pixel,
+                                                   opcodes == Opcode.ARC_CW)
+    with numpy.errstate(invalid="ignore"):
+        arcs = ((opcodes == Opcode.ARC_CW) | (opcodes == Opcode.ARC_ANTI_CW)) & (radius > 0)
+    start_angle = numpy.arctan2(starts[:, 1] - centre_y, starts[:, 0] - centre_x)
+    lengths = numpy.where(arcs, radius * numpy.abs(sweep), lengths)
+
+    counts = numpy.ceil(lengths * POINTS_PER_PIXEL).astype(numpy.int64)
+    columns = (starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1], arcs, centre_x, centre_y, radius, start_angle,
+               sweep, tool_power)
+
+    # Batches of moves with up to MAX_POINTS between them, other than a single move that needs more by itself
+    totals = numpy.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        limit = totals[first] - counts[first] + MAX_POINTS
+        last = max(int(numpy.searchsorted(totals, limit, side="right")), first + 1)
+        _draw_points(powers, lowest_powers, [column[first:last] for column in columns], counts[first:last])
+        first = last
+
+
+def _draw_points(powers, lowest_powers, columns, counts):
+    # Place counts points along each of a batch of moves, and give each pixel the highest and lowest power of the
+    # points in it
+    start_x, start_y, end_x, end_y, arcs, centre_x, centre_y, radius, start_angle, sweep, tool_power = columns
+    total = int(counts.sum())
+    if total == 0:
+        return
+
+    # Points are in the middle of equal steps along each move, so never on the pixel edges at its ends
+    moves = numpy.repeat(numpy.arange(len(counts)), counts)
+    firsts = numpy.cumsum(counts) - counts
+    fractions = (numpy.arange(total) - firsts[moves] + 0.5) / counts[moves]
+
+    x = start_x[moves] + (end_x - start_x)[moves] * fractions
+    y = start_y[moves] + (end_y - start_y)[moves] * fractions
+
+    on_arc = arcs[moves]
+    if on_arc.any():
+        arc_moves = moves[on_arc]
+        angles = start_angle[arc_moves] + sweep[arc_moves] * fractions[on_arc]
+        x[on_arc] = centre_x[arc_moves] + radius[arc_moves] * numpy.cos(angles)
+        y[on_arc] = centre_y[arc_moves] + radius[arc_moves] * numpy.sin(angles)
+
+    height, width = powers.shape
+    point_columns = numpy.floor(x + EDGE_TOLERANCE).astype(numpy.int64)
+    point_rows = numpy.floor(y + EDGE_TOLERANCE).astype(numpy.int64)
+    inside = (point_columns >= 0) & (point_columns < width) & (point_rows >= 0) & (point_rows < height)
+
+    pixels = ((height - 1 - point_rows) * width + point_columns)[inside]
+    point_powers = tool_power[moves][inside]
+    if not len(pixels):
+        return
+
+    # Neighbouring points mostly land in the same pixel with the same power, and only one of them is needed
+    changed = numpy.concatenate(([True], (pixels[1:] != pixels[:-1]) | (point_powers[1:] != point_powers[:-1])))
+    pixels = pixels[changed]
+    point_powers = point_powers[changed]
+
+    # Sorted by pixel and then power, the first point of each pixel has its lowest power and the last its highest
+    order = numpy.lexsort((point_powers, pixels))
+    pixels = pixels[order]
+    point_powers = point_powers[order]
+    new_pixel = pixels[1:] != pixels[:-1]
+    first = numpy.concatenate(([True], new_pixel))
+    last = numpy.concatenate((new_pixel, [True]))
+
+    flat_powers = powers.reshape(-1)
+    flat_lowest_powers = lowest_powers.reshape(-1)
+    lowest = flat_lowest_powers[pixels[first]]
+    flat_lowest_powers[pixels[first]] = numpy.where(lowest > 0, numpy.minimum(lowest, point_powers[first]),
+                                                    point_powers[first])
+    flat_powers[pixels[last]] = numpy.maximum(flat_powers[pixels[last]], point_powers[last])
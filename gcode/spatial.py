@@ -0,0 +1,343 @@
+__author__ = 'Richard'
+
+# A spatial index over the moves of a program, for finding the moves that pass through a region without looking at
+# every line, and for clipping a program to a region or splitting it into tiles to be run by several heads or
+# machines. The moves are put into a grid of square cells in one go, each in every cell its bounding box covers. Moves
+# that cover too many cells to be worth putting in each of them are kept to one side, and checked by every query.
+# Requires numpy.
+
+import math
+
+import numpy
+
+from gcode.estimate import ProgramState, block_segments, arc_sweeps, MIN_MOVE_LENGTH
+from gcode.file import File
+from gcode.line import SetMovementMode, SetUnits, SetToolState, MovementMode, Units
+from gcode.store import Opcode
+
+# How far (in mm) the chords that arcs are broken into can stray from the arc
+ARC_TOLERANCE = 0.01
+
+# How many moves each cell of the grid has on average, when its size isn't given
+MOVES_PER_CELL = 4
+
+# The most cells along each side of the grid, whatever the number of moves
+MAX_GRID_SIDE = 4096
+
+# Moves whose bounding boxes cover more cells than this are kept out of the grid
+MAX_CELLS_PER_MOVE = 16
+
+
+class SpatialIndex(object):
+    """
+    The moves of a file in a grid of cells, for finding those in a region quickly. The index is of the file as it is
+    when the index is made, in the coordinates it is output in, so with its transform applied. Arcs are broken into
+    chords no more than ARC_TOLERANCE from them. Each move has the index of the line it came from in lines, its start
+    and end points (in mm), whether it is a rapid, and the feed rate and tool power it is made with.
+    cell_size is the size of the cells (in mm), which is chosen from the number of moves by default.
+    """
+
+    def __init__(self, gcode_file, cell_size=None, block_size=65536):
+        self.lines, self.start_points, self.end_points, self.rapid, self.feed_rate, self.tool_power = \
+            read_moves(gcode_file, block_size)
+
+        min_x, min_y, max_x, max_y = self._move_boxes()
+        if len(self):
+            self.bounds = (float(min_x.min()), float(min_y.min()), float(max_x.max()), float(max_y.max()))
+        else:
+            self.bounds = (0.0, 0.0, 0.0, 0.0)
+
+        width = self.bounds[2] - self.bounds[0]
+        height = self.bounds[3] - self.bounds[1]
+        if cell_size is None:
+            cell_size = math.sqrt(width * height * MOVES_PER_CELL / max(len(self), 1))
+        cell_size = max(cell_size, width / MAX_GRID_SIDE, height / MAX_GRID_SIDE, MIN_MOVE_LENGTH)
+
+        self.cell_size = cell_size
+        self.columns = int(width // cell_size) + 1
+        self.rows = int(height // cell_size) + 1
+
+        # Each cell's moves are together in _cell_moves, from _cell_starts[cell] up to _cell_starts[cell + 1]
+        first_column, first_row, last_column, last_row = self._cell_ranges(min_x, min_y, max_x, max_y)
+        spans = last_column - first_column + 1
+        cell_counts = spans * (last_row - first_row + 1)
+
+        large = cell_counts > MAX_CELLS_PER_MOVE
+        self._large_moves = numpy.nonzero(large)[0]
+        cell_counts[large] = 0
+
+        moves = numpy.repeat(numpy.arange(len(self)), cell_counts)
+        steps = numpy.arange(len(moves)) - (numpy.cumsum(cell_counts) - cell_counts)[moves]
+        cells = ((first_row[moves] + steps // spans[moves]) * self.columns + first_column[moves] +
+                 steps % spans[moves])
+
+        order = numpy.argsort(cells, kind="mergesort")
+        self._cell_moves = moves[order]
+        self._cell_starts = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(cells,
+                                                                                minlength=self.columns * self.rows))))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def query_moves(self, min_x, min_y, max_x, max_y):
+        """
+        The indices of the moves whose bounding boxes overlap the region, in the order they are made.
+        """
+        if not len(self) or min_x > max_x or min_y > max_y:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        first_column, first_row, last_column, last_row = [int(value) for value in self._cell_ranges(
+            numpy.array([min_x]), numpy.array([min_y]), numpy.array([max_x]), numpy.array([max_y]))]
+
+        # The cells of each row of the grid are next to each other, so their moves are too
+        candidates = [self._large_moves]
+        for row in range(first_row, last_row + 1):
+            first_cell = row * self.columns + first_column
+            last_cell = row * self.columns + last_column
+            candidates.append(self._cell_moves[self._cell_starts[first_cell]:self._cell_starts[last_cell + 1]])
+        candidates = numpy.unique(numpy.concatenate(candidates))
+
+        # Cells cover more than the region, and the large moves could be anywhere
+        move_min_x, move_min_y, move_max_x, move_max_y = self._move_boxes(candidates)
+        overlaps = (move_min_x <= max_x) & (move_max_x >= min_x) & (move_min_y <= max_y) & (move_max_y >= min_y)
+        return candidates[overlaps]
+
+    def query(self, min_x, min_y, max_x, max_y):
+        """
+        The indices of the lines with moves whose bounding boxes overlap the region, in order.
+        """
+        return numpy.unique(self.lines[self.query_moves(min_x, min_y, max_x, max_y)])
+
+    def _move_boxes(self, moves=slice(None)):
+        # The bounding boxes of the moves, as arrays of min_x, min_y, max_x and max_y
+        start_points = self.start_points[moves]
+        end_points = self.end_points[moves]
+        low = numpy.minimum(start_points, end_points)
+        high = numpy.maximum(start_points, end_points)
+        return low[:, 0], low[:, 1], high[:, 0], high[:, 1]
+
+    def _cell_ranges(self, min_x, min_y, max_x, max_y):
+        # The first and last columns and rows of the cells covered by boxes, kept inside the grid
+        origin_x, origin_y = self.bounds[:2]
+        return (numpy.clip(((min_x - origin_x) // self.cell_size).astype(numpy.int64), 0, self.columns - 1),
+                numpy.clip(((min_y - origin_y) // self.cell_size).astype(numpy.int64), 0, self.rows - 1),
+                numpy.clip(((max_x - origin_x) // self.cell_size).astype(numpy.int64), 0, self.columns - 1),
+                numpy.clip(((max_y - origin_y) // self.cell_size).astype(numpy.int64), 0, self.rows - 1))
+
+
+class Tile(object):
+    """
+    One tile of a program split by split_tiles, at column and row of the tiles from the bottom left. bounds is the
+    region it covers, as (min_x, min_y, max_x, max_y), and gcode_file the program for it.
+    """
+
+    def __init__(self, column, row, bounds, gcode_file):
+        self.column = column
+        self.row = row
+        self.bounds = bounds
+        self.gcode_file = gcode_file
+
+
+def read_moves(gcode_file, block_size=65536):
+    """
+    The moves the file makes, in the coordinates it is output in, as numpy arrays of the index of the line each came
+    from, their start and end points (in mm), whether each is a rapid, and the feed rate and tool power each is made
+    with. Arcs are broken into chords no more than ARC_TOLERANCE from them.
+    """
+    state = ProgramState()
+    blocks = [_block_moves(gcode_file.lines, block, state)
+              for block in gcode_file.lines.iter_column_blocks(gcode_file.transform, block_size)]
+
+    if not blocks:
+        return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, 3)), numpy.zeros((0, 3)), numpy.zeros(0, dtype=bool),
+                numpy.zeros(0), numpy.zeros(0))
+
+    return tuple(numpy.concatenate(column) for column in zip(*blocks))
+
+
+def clip_file(gcode_file, min_x, min_y, max_x, max_y, index=None):
+    """
+    A new file with just the moves of the file inside the region, cut where they cross its edges. The region
+    includes its left and bottom edges but not its right and top ones, so regions that share an edge don't both get
+    the moves along it. The new file is in absolute mm in the coordinates the file is output in, starts with the tool
+    off and leaves it off. Between moves that don't follow on from each other it turns the tool off and rapids to the
+    next one, then sets the tool power each move was made with. Arcs become chords, and lines other than moves and
+    tool changes are left out. index is a SpatialIndex of the file, which is made if not given.
+    """
+    if index is None:
+        index = SpatialIndex(gcode_file)
+
+    moves = index.query_moves(min_x, min_y, max_x, max_y)
+    kept, start_points, end_points = _clip_moves(index.start_points[moves], index.end_points[moves],
+                                                 min_x, min_y, max_x, max_y)
+    moves = moves[kept]
+
+    return moves_file(gcode_file, start_points, end_points, index.rapid[moves], index.feed_rate[moves],
+                       index.tool_power[moves])
+
+
+def split_tiles(gcode_file, tile_width, tile_height=None, index=None):
+    """
+    Split the file into tiles tile_width by tile_height (in mm), the same as tile_width by default, starting from the
+    bottom left of everything it moves through. Each tile is clipped from the file as for clip_file, so the tiles can
+    be run in any order or at the same time. Returns a list of Tiles, in rows from the bottom left, leaving out the
+    tiles where nothing is lased.
+    """
+    if tile_height is None:
+        tile_height = tile_width
+    if tile_width <= 0 or tile_height <= 0:
+        raise ValueError("Tiles have to be bigger than nothing")
+
+    if index is None:
+        index = SpatialIndex(gcode_file)
+
+    # There is always a tile past the top and right of the moves, so that the moves along them are in a tile
+    origin_x, origin_y, max_x, max_y = index.bounds
+    columns = int((max_x - origin_x) // tile_width) + 1
+    rows = int((max_y - origin_y) // tile_height) + 1
+
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            bounds = (origin_x + column * tile_width, origin_y + row * tile_height,
+                      origin_x + (column + 1) * tile_width, origin_y + (row + 1) * tile_height)
+
+            moves = index.query_moves(*bounds)
+            lased = moves[~index.rapid[moves] & (index.tool_power[moves] > 0)]
+            if not _clip_moves(index.start_points[lased], index.end_points[lased], *bounds)[0].any():
+                continue
+
+            tiles.append(Tile(column, row, bounds, clip_file(gcode_file, *bounds, index=index)))
+
+    return tiles
+
+
+def _block_moves(lines, block, state):
+    # The moves in a block of lines from LineStore.iter_column_blocks, with arcs broken into chords. Returns arrays of
+    # the line each came from, their start and end points, whether they are rapids, and their feed rate and tool power
+    start, end, opcodes = block[:3]
+    positioned = ((opcodes == Opcode.RAPID) | (opcodes == Opcode.FEED) | (opcodes == Opcode.ARC_CW) |
+                  (opcodes == Opcode.ARC_ANTI_CW))
+    line_indices = start + numpy.nonzero(positioned)[0]
+
+    start_points, end_points, opcodes, arc_i, arc_j, feed_rate, tool_power = block_segments(lines, block, state)
+    rapid = opcodes == Opcode.RAPID
+
+    clockwise = opcodes == Opcode.ARC_CW
+    centre_x, centre_y, radius, sweep = arc_sweeps(start_points, end_points, arc_i, arc_j, clockwise)
+    with numpy.errstate(invalid="ignore"):
+        # Arcs without a radius are moved straight along, the same as the estimate does
+        arcs = (clockwise | (opcodes == Opcode.ARC_ANTI_CW)) & (radius > 0)
+    if not arcs.any():
+        return line_indices, start_points, end_points, rapid, feed_rate, tool_power
+
+    # Enough chords that the middle of each is no more than ARC_TOLERANCE from the arc
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        chord_angle = 2 * numpy.arccos(numpy.clip(1 - ARC_TOLERANCE / radius, -1.0, 1.0))
+        chords = numpy.where(arcs, numpy.maximum(numpy.ceil(numpy.abs(sweep) / chord_angle), 1), 1)
+    chords = chords.astype(numpy.int64)
+
+    moves = numpy.repeat(numpy.arange(len(chords)), chords)
+    steps = numpy.arange(len(moves)) - (numpy.cumsum(chords) - chords)[moves]
+    start_angle = numpy.arctan2(start_points[:, 1] - centre_y, start_points[:, 0] - centre_x)
+
+    def points_along(fractions):
+        # Points the fractions of the way along the moves, which are exactly their ends at 0 and 1
+        points = start_points[moves] + (end_points - start_points)[moves] * fractions[:, numpy.newaxis]
+        on_arc = arcs[moves]
+        angles = start_angle[moves[on_arc]] + sweep[moves[on_arc]] * fractions[on_arc]
+        points[on_arc, 0] = centre_x[moves[on_arc]] + radius[moves[on_arc]] * numpy.cos(angles)
+        points[on_arc, 1] = centre_y[moves[on_arc]] + radius[moves[on_arc]] * numpy.sin(angles)
+
+        points = numpy.where((fractions == 0)[:, numpy.newaxis], start_points[moves], points)
+        return numpy.where((fractions == 1)[:, numpy.newaxis], end_points[moves], points)
+
+    return (line_indices[moves], points_along(steps / chords[moves].astype(numpy.float64)),
+            points_along((steps + 1) / chords[moves].astype(numpy.float64)), rapid[moves], feed_rate[moves],
+            tool_power[moves])
+
+
+def _clip_moves(start_points, end_points, min_x, min_y, max_x, max_y):
+    # Cut moves to the region, the Liang-Barsky way. Returns which of the moves are left, and the start and end points
+    # of those that are
+    deltas = end_points - start_points
+    enter = numpy.zeros(len(deltas))
+    leave = numpy.ones(len(deltas))
+
+    for axis, low, high in ((0, min_x, max_x), (1, min_y, max_y)):
+        starts = start_points[:, axis]
+        steps = deltas[:, axis]
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            to_low = (low - starts) / steps
+            to_high = (high - starts) / steps
+
+        # Moves that don't go along the axis are either in the region all the way along it or not at all
+        still = steps == 0
+        outside = still & ((starts < low) | (starts > high))
+        enter = numpy.where(still, enter, numpy.maximum(enter, numpy.where(steps > 0, to_low, to_high)))
+        leave = numpy.where(still, numpy.where(outside, -1.0, leave),
+                            numpy.minimum(leave, numpy.where(steps > 0, to_high, to_low)))
+
+    kept = enter < leave
+    enter = enter[kept, numpy.newaxis]
+    leave = leave[kept, numpy.newaxis]
+    starts = start_points[kept]
+    ends = end_points[kept]
+
+    # The ends that aren't cut stay exactly where they were, and those that are stay on the edge
+    clipped_starts = numpy.where(enter > 0, starts + deltas[kept] * enter, starts)
+    clipped_ends = numpy.where(leave < 1, starts + deltas[kept] * leave, ends)
+    for points in (clipped_starts, clipped_ends):
+        points[:, 0] = numpy.clip(points[:, 0], min_x, max_x)
+        points[:, 1] = numpy.clip(points[:, 1], min_y, max_y)
+
+    # Moves along the right and top edges belong to the regions past them, and bits left at corners go nowhere
+    on_far_edge = (((clipped_starts[:, 0] >= max_x) & (clipped_ends[:, 0] >= max_x)) |
+                   ((clipped_starts[:, 1] >= max_y) & (clipped_ends[:, 1] >= max_y)))
+    lengths = numpy.sqrt(numpy.sum((clipped_ends - clipped_starts) ** 2, axis=1))
+    left = ~on_far_edge & (lengths >= MIN_MOVE_LENGTH)
+
+    kept[kept] = left
+    return kept, clipped_starts[left], clipped_ends[left]
+
+
+def moves_file(gcode_file, start_points, end_points, rapid, feed_rate, tool_power):
+    """
+    A new file that makes the moves given by the arrays, in absolute mm, with the output properties of gcode_file.
+    It starts with the tool off and leaves it off. Before a move that doesn't start where the last one ended, the
+    tool is turned off and the head rapids to its start, and the tool power is set before each move it changes for.
+    """
+    new_file = File()
+    new_file.output_properties = dict(gcode_file.output_properties)
+    new_file.lines.set_precision(gcode_file.lines.precision)
+    new_file.add_line(SetMovementMode(MovementMode.ABSOLUTE, "Set movement to absolute"))
+    new_file.add_line(SetUnits(Units.MM, "Set units to mm"))
+    new_file.add_line(SetToolState(0, "Turn the tool off"))
+
+    count = len(rapid)
+    if count:
+        jumps = numpy.ones(count, dtype=bool)
+        jumps[1:] = ~numpy.all(numpy.abs(start_points[1:] - end_points[:-1]) < MIN_MOVE_LENGTH, axis=1)
+
+        previous_power = numpy.concatenate(([0.0], tool_power[:-1]))
+        tool_off = jumps & (previous_power != 0)
+        set_power = tool_power != numpy.where(jumps, 0.0, previous_power)
+
+        nothing = numpy.full(count, numpy.nan)
+        present = numpy.column_stack((tool_off, jumps, set_power, numpy.ones(count, dtype=bool))).ravel()
+        opcodes = numpy.column_stack((numpy.full(count, Opcode.TOOL_STATE), numpy.full(count, Opcode.RAPID),
+                                      numpy.full(count, Opcode.TOOL_STATE),
+                                      numpy.where(rapid, Opcode.RAPID, Opcode.FEED))).astype(numpy.uint8)
+        columns = [numpy.column_stack((nothing, start_points[:, axis], nothing, end_points[:, axis]))
+                   for axis in range(3)]
+        feed_rates = numpy.column_stack((nothing, nothing, nothing, feed_rate))
+        values = numpy.column_stack((numpy.zeros(count), nothing, tool_power, nothing))
+
+        new_file.lines.extend_columns(*[column.ravel()[present] for column in [opcodes] + columns +
+                                        [feed_rates, values]])
+
+        if tool_power[-1] != 0:
+            new_file.add_line(SetToolState(0, "Turn the tool off"))
+
+    new_file.bounding_box = new_file.lines.bounding_box()
+    return new_file
@@ -0,0 +1,85 @@
+__author__ = 'Richard'
+
+# Hooks into the stages of a conversion, such as loading the image, generating the lines and writing them out, so that
+# they can be timed and counted. Any object with stage_started and stage_finished methods can be added as a hook
+
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+_hooks = []
+
+
+class Stage(object):
+    """
+    One run of a stage. The code running the stage fills in how many lines and pixels it dealt with.
+    """
+    __slots__ = ("name", "start_time", "seconds", "lines", "pixels", "peak_memory_mb")
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.seconds = None
+        self.lines = None
+        self.pixels = None
+        self.peak_memory_mb = None
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class StageTimer(object):
+    """
+    A hook that keeps every stage that finishes, for a report of where the time went.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def stage_started(self, stage):
+        pass
+
+    def stage_finished(self, stage):
+        self.stages.append(stage)
+
+    def report(self):
+        return {
+            "stages": [stage.as_dict() for stage in self.stages],
+            "total_seconds": sum(stage.seconds for stage in self.stages),
+            "peak_memory_mb": peak_memory_mb()
+        }
+
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+@contextmanager
+def stage(name):
+    """
+    Run a stage, telling the hooks when it starts and finishes. Gives the Stage, so that its lines and pixels can be
+    filled in.
+    """
+    current_stage = Stage(name)
+    for hook in _hooks:
+        hook.stage_started(current_stage)
+
+    yield current_stage
+
+    current_stage.seconds = time.time() - current_stage.start_time
+    current_stage.peak_memory_mb = peak_memory_mb()
+    for hook in _hooks:
+        hook.stage_finished(current_stage)
+
+
+def peak_memory_mb():
+    # The most memory this process has used so far. Linux gives it in KB, and OS X in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
@@ -0,0 +1,564 @@
+__author__ = 'Richard'
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from gcode.fixed import snap, snap_column
+from gcode.line import (BlankLine, Comment, SetMovementMode, SetUnits, MoveLinear, MoveRapid, MoveFeed, MoveArc,
+                        SetToolState, MovementMode, Units, MoveType, ArcDirection)
+import math
+
+from gcode.transform import TransformState, axis_positions
+
+NaN = float("nan")
+
+
+# The opcodes stored for each line. Anything that can't be represented in columns is kept as an object
+class Opcode:
+    OBJECT, BLANK, COMMENT, UNITS_MM, UNITS_INCHES, ABSOLUTE, RELATIVE, RAPID, FEED, ARC_CW, ARC_ANTI_CW, TOOL_STATE\
+        = range(12)
+
+MOVE_OPCODES = (Opcode.RAPID, Opcode.FEED)
+ARC_OPCODES = (Opcode.ARC_CW, Opcode.ARC_ANTI_CW)
+# Mirroring a program turns its clockwise arcs anti-clockwise, and vice versa
+ARC_REVERSED = {Opcode.ARC_CW: Opcode.ARC_ANTI_CW, Opcode.ARC_ANTI_CW: Opcode.ARC_CW}
+
+
+# The columns that hold distances, which are rounded in a store with a precision
+_DISTANCE_COLUMNS = ("x", "y", "z", "feed_rate", "i", "j")
+
+
+def _to_column(value):
+    if value is None:
+        return NaN
+    return value
+
+
+def _as_array(typecode, values):
+    if isinstance(values, array) and values.typecode == typecode:
+        return values
+    return array(typecode, values)
+
+
+def _arc_extremes(start_x, start_y, end_x, end_y, offset_x, offset_y, clockwise):
+    # The points furthest left, right, down and up on a circle that an arc passes through on its way round. An arc
+    # that ends where it starts is a full circle
+    radius = math.hypot(offset_x, offset_y)
+    if radius == 0 or offset_x != offset_x or offset_y != offset_y:
+        return []
+
+    centre_x = start_x + offset_x
+    centre_y = start_y + offset_y
+    start_angle = math.atan2(-offset_y, -offset_x)
+    end_angle = math.atan2(end_y - centre_y, end_x - centre_x)
+
+    direction = -1 if clockwise else 1
+    sweep = (direction * (end_angle - start_angle)) % (2 * math.pi)
+    if sweep == 0:
+        sweep = 2 * math.pi
+
+    extremes = []
+    for quarter, (point_x, point_y) in enumerate(((centre_x + radius, centre_y), (centre_x, centre_y + radius),
+                                                  (centre_x - radius, centre_y), (centre_x, centre_y - radius))):
+        if (direction * (quarter * math.pi / 2 - start_angle)) % (2 * math.pi) <= sweep:
+            extremes.append((point_x, point_y))
+
+    return extremes
+
+
+def _from_column(value):
+    # NaN is the only value that isn't equal to itself
+    if value != value:
+        return None
+    return value
+
+
+class LineStore(object):
+    """
+    A compact, columnar list of lines.
+    Each line costs a few dozen bytes spread across typed arrays rather than a full Python object. Indexing or
+    iterating creates a fresh Line object for each entry, so changes made to those objects are not stored.
+    With a precision, distances are stored rounded to it, as whole numbers of units of 10^-precision mm (see
+    gcode.fixed), so that they add up without drifting and are quick to output at that precision.
+    """
+
+    def __init__(self, lines=None, precision=None):
+        self.precision = None
+        self.opcodes = array("B")
+        self.x = array("d")
+        self.y = array("d")
+        self.z = array("d")
+        self.feed_rate = array("d")
+        self.i = array("d")
+        self.j = array("d")
+        # The tool power for tool state lines, or the index into objects for lines stored as objects
+        self.values = array("d")
+        self.comments = array("i")
+
+        self.comment_strings = []
+        self.comment_lookup = {}
+        self.objects = []
+
+        if lines is not None:
+            self.extend(lines)
+
+        if precision is not None:
+            self.set_precision(precision)
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __iter__(self):
+        for index in xrange(len(self.opcodes)):
+            yield self._view(index)
+
+    def iter_lines(self, transform=None, block_size=65536):
+        """
+        Iterate over the lines with the given Transform applied to them. Blocks of lines are transformed at once
+        with numpy when it is available.
+        """
+        if transform is None or transform.is_identity():
+            for line in self:
+                yield line
+            return
+
+        self.check_transform(transform)
+
+        if numpy is None:
+            for line in self._iter_transformed_lines(transform):
+                yield line
+            return
+
+        for start, end, opcodes, relative, x, y, z, arc_i, arc_j in self.iter_column_blocks(transform, block_size):
+            x, y, z, arc_i, arc_j = [column.tolist() for column in (x, y, z, arc_i, arc_j)]
+            opcodes = opcodes.tolist()
+
+            feed_rate = self.feed_rate[start:end]
+            values = self.values[start:end]
+            comments = self.comments[start:end]
+            build_line = self._build_line
+
+            for index in xrange(end - start):
+                yield build_line(opcodes[index], x[index], y[index], z[index], feed_rate[index], arc_i[index],
+                                 arc_j[index], values[index], comments[index])
+
+    def iter_commands(self, transform=None, emit_moves=None, emit_tool_states=None, block_size=65536):
+        """
+        Iterate over the lines with the given Transform applied, for output. Moves are given to emit_moves and tool
+        states to emit_tool_states a block at a time, as the emit_columns functions of emitters take them, and come
+        out as a tuple of what the emitter gave for them and their comment. Anything else, or everything when numpy
+        isn't available, comes out as the line itself.
+        """
+        if numpy is None or (emit_moves is None and emit_tool_states is None):
+            for line in self.iter_lines(transform, block_size):
+                yield line
+            return
+
+        if transform is not None and not transform.is_identity():
+            self.check_transform(transform)
+
+        comment_strings = self.comment_strings
+        build_line = self._build_line
+
+        for start, end, opcodes, relative, x, y, z, arc_i, arc_j in self.iter_column_blocks(transform, block_size):
+            commands = numpy.empty(end - start, dtype=object)
+
+            if emit_moves is not None:
+                is_move = (opcodes == Opcode.RAPID) | (opcodes == Opcode.FEED)
+                if is_move.any():
+                    feed_rate = numpy.frombuffer(self.feed_rate, dtype=numpy.float64)[start:end]
+                    commands[is_move] = emit_moves(opcodes[is_move] == Opcode.RAPID, x[is_move], y[is_move],
+                                                   z[is_move], feed_rate[is_move])
+
+            if emit_tool_states is not None:
+                is_tool_state = opcodes == Opcode.TOOL_STATE
+                if is_tool_state.any():
+                    values = numpy.frombuffer(self.values, dtype=numpy.float64)[start:end]
+                    commands[is_tool_state] = emit_tool_states(values[is_tool_state])
+
+            commands = commands.tolist()
+            comments = self.comments[start:end]
+
+            if None in commands:
+                # Some of the lines are output by themselves, so are needed as they would be from iter_lines
+                opcodes, x, y, z, arc_i, arc_j = [column.tolist() for column in (opcodes, x, y, z, arc_i, arc_j)]
+                feed_rate = self.feed_rate[start:end]
+                values = self.values[start:end]
+
+            for index in xrange(end - start):
+                command_output = commands[index]
+                if command_output is None:
+                    yield build_line(opcodes[index], x[index], y[index], z[index], feed_rate[index], arc_i[index],
+                                     arc_j[index], values[index], comments[index])
+                elif comments[index] < 0:
+                    yield command_output, None
+                else:
+                    yield command_output, comment_strings[comments[index]]
+
+    def iter_column_blocks(self, transform=None, block_size=65536):
+        """
+        Iterate over the lines in blocks of numpy arrays, with the given Transform applied. Requires numpy.
+        Yields (start, end, opcodes, relative, x, y, z, arc_i, arc_j) for the lines from start up to end, where
+        relative is whether each line is in relative mode. Unused values are NaN.
+        """
+        if transform is not None and transform.is_identity():
+            transform = None
+
+        state = TransformState()
+        for start in xrange(0, len(self.opcodes), block_size):
+            end = min(start + block_size, len(self.opcodes))
+            opcodes = numpy.frombuffer(self.opcodes, dtype=numpy.uint8)[start:end]
+
+            # Work out whether each line is in relative mode, carrying on from the end of the last block
+            is_mode = (opcodes == Opcode.ABSOLUTE) | (opcodes == Opcode.RELATIVE)
+            last_mode = numpy.maximum.accumulate(numpy.where(is_mode, numpy.arange(len(opcodes)), -1))
+            relative = numpy.where(last_mode >= 0, opcodes[numpy.maximum(last_mode, 0)] == Opcode.RELATIVE,
+                                   state.relative)
+            if len(relative):
+                state.relative = bool(relative[-1])
+
+            columns = [numpy.frombuffer(column, dtype=numpy.float64)[start:end]
+                       for column in (self.x, self.y, self.z, self.i, self.j)]
+
+            if transform is not None:
+                is_move = (opcodes == Opcode.RAPID) | (opcodes == Opcode.FEED)
+                is_arc = (opcodes == Opcode.ARC_CW) | (opcodes == Opcode.ARC_ANTI_CW)
+                columns = transform.apply_columns(*(columns + [relative, is_move, is_arc, state]))
+
+                if transform.is_mirrored():
+                    opcodes = numpy.where(opcodes == Opcode.ARC_CW, Opcode.ARC_ANTI_CW,
+                                          numpy.where(opcodes == Opcode.ARC_ANTI_CW, Opcode.ARC_CW, opcodes))
+
+            x, y, z, arc_i, arc_j = columns
+            yield start, end, opcodes, relative, x, y, z, arc_i, arc_j
+
+    def _iter_transformed_lines(self, transform):
+        state = TransformState()
+        for index in xrange(len(self.opcodes)):
+            opcode = self.opcodes[index]
+
+            if opcode == Opcode.ABSOLUTE:
+                state.relative = False
+            elif opcode == Opcode.RELATIVE:
+                state.relative = True
+
+            if opcode in MOVE_OPCODES or opcode in ARC_OPCODES:
+                x, y, z, arc_i, arc_j = transform.apply_line(
+                    _from_column(self.x[index]), _from_column(self.y[index]), _from_column(self.z[index]),
+                    _from_column(self.i[index]), _from_column(self.j[index]), state.relative,
+                    opcode in ARC_OPCODES, state)
+
+                if transform.is_mirrored():
+                    opcode = ARC_REVERSED.get(opcode, opcode)
+
+                yield self._build_line(opcode, _to_column(x), _to_column(y), _to_column(z), self.feed_rate[index],
+                                       _to_column(arc_i), _to_column(arc_j), self.values[index],
+                                       self.comments[index])
+            else:
+                yield self._view(index)
+
+    def check_transform(self, transform):
+        # Arcs stay arcs only through transforms that keep circles circular
+        if not transform.is_similarity() and self._has_arcs():
+            raise ValueError("Arcs can only be transformed by a combination of moves, rotations, mirroring and "
+                             "uniform scaling")
+
+    def _has_arcs(self):
+        return Opcode.ARC_CW in self.opcodes or Opcode.ARC_ANTI_CW in self.opcodes
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._view(i) for i in xrange(*index.indices(len(self.opcodes)))]
+
+        if index < 0:
+            index += len(self.opcodes)
+
+        if not 0 <= index < len(self.opcodes):
+            raise IndexError("line index out of range")
+
+        return self._view(index)
+
+    def append(self, line):
+        self.insert(None, line)
+
+    def extend(self, lines):
+        for line in lines:
+            self.insert(None, line)
+
+    def extend_columns(self, opcodes, x, y, z, feed_rate, values):
+        # Add many moves and tool states at once from already encoded values, given as arrays or lists
+        count = len(opcodes)
+        if self.precision is not None:
+            x, y, z, feed_rate = [self._snap_values(column) for column in (x, y, z, feed_rate)]
+
+        self.opcodes.extend(_as_array("B", opcodes))
+        self.x.extend(_as_array("d", x))
+        self.y.extend(_as_array("d", y))
+        self.z.extend(_as_array("d", z))
+        self.feed_rate.extend(_as_array("d", feed_rate))
+        self.i.extend(array("d", [NaN]) * count)
+        self.j.extend(array("d", [NaN]) * count)
+        self.values.extend(_as_array("d", values))
+        self.comments.extend(array("i", [-1]) * count)
+
+    def extend_store(self, other):
+        # Add all the lines from another store to the end of this one
+        start = len(self.opcodes)
+        comment_map = [self._comment_index(comment) for comment in other.comment_strings]
+        object_offset = len(self.objects)
+
+        self.opcodes.extend(other.opcodes)
+        self.x.extend(other.x)
+        self.y.extend(other.y)
+        self.z.extend(other.z)
+        self.feed_rate.extend(other.feed_rate)
+        self.i.extend(other.i)
+        self.j.extend(other.j)
+        self.objects.extend(other.objects)
+
+        if other.objects:
+            values = array("d", other.values)
+            for index in xrange(len(other.opcodes)):
+                if other.opcodes[index] == Opcode.OBJECT:
+                    values[index] += object_offset
+            self.values.extend(values)
+        else:
+            self.values.extend(other.values)
+
+        if comment_map != range(len(comment_map)):
+            self.comments.extend(array("i", [comment_map[comment] if comment >= 0 else comment
+                                             for comment in other.comments]))
+        else:
+            self.comments.extend(other.comments)
+
+        if self.precision is not None and other.precision != self.precision:
+            for name in _DISTANCE_COLUMNS:
+                column = getattr(self, name)
+                column[start:] = self._snap_values(column[start:])
+
+    def insert(self, index, line):
+        opcode, x, y, z, feed_rate, i, j, value = self._encode(line)
+        if self.precision is not None:
+            precision = self.precision
+            x, y, z, feed_rate, i, j = [snap(column_value, precision) for column_value in (x, y, z, feed_rate, i, j)]
+        comment = self._comment_index(line.comment)
+
+        if index is None:
+            self.opcodes.append(opcode)
+            self.x.append(x)
+            self.y.append(y)
+            self.z.append(z)
+            self.feed_rate.append(feed_rate)
+            self.i.append(i)
+            self.j.append(j)
+            self.values.append(value)
+            self.comments.append(comment)
+        else:
+            self.opcodes.insert(index, opcode)
+            self.x.insert(index, x)
+            self.y.insert(index, y)
+            self.z.insert(index, z)
+            self.feed_rate.insert(index, feed_rate)
+            self.i.insert(index, i)
+            self.j.insert(index, j)
+            self.values.insert(index, value)
+            self.comments.insert(index, comment)
+
+    def set_precision(self, precision):
+        """
+        Round the distances stored, and any added from now on, to the precision, or stop rounding them for None.
+        """
+        self.precision = precision
+        if precision is None:
+            return
+
+        for name in _DISTANCE_COLUMNS:
+            setattr(self, name, self._snap_values(getattr(self, name)))
+
+    def _snap_values(self, values):
+        # The values rounded to the store's precision, as an array
+        if numpy is not None:
+            return array("d", snap_column(numpy.asarray(values, dtype=numpy.float64), self.precision).tostring())
+        return array("d", [snap(value, self.precision) for value in values])
+
+    def bounding_box(self):
+        """
+        The box around everywhere the head goes, following it from the origin through relative moves and around
+        arcs. Unused axes count as zero, matching the bounding box File builds up as lines are added.
+        """
+        if numpy is not None:
+            points = self._head_points()
+        else:
+            points = self._head_points_by_line()
+
+        bounding_box = {}
+        for axis, values in zip(("x", "y", "z"), points):
+            bounding_box["min_" + axis] = min(0, min(values))
+            bounding_box["max_" + axis] = max(0, max(values))
+
+        return bounding_box
+
+    def _head_points(self):
+        # The x, y and z values of the furthest points the head reaches, a block of lines at a time
+        points = ([0.0], [0.0], [0.0])
+        position = [0.0, 0.0, 0.0]
+
+        for start, end, opcodes, relative, x, y, z, arc_i, arc_j in self.iter_column_blocks():
+            is_arc = (opcodes == Opcode.ARC_CW) | (opcodes == Opcode.ARC_ANTI_CW)
+            positioned = (opcodes == Opcode.RAPID) | (opcodes == Opcode.FEED) | is_arc
+            if not positioned.any():
+                continue
+
+            after = []
+            for axis, values in enumerate((x, y, z)):
+                axis_after = axis_positions(values, positioned & ~relative, positioned & relative, position[axis])
+                points[axis].extend([float(axis_after[positioned].min()), float(axis_after[positioned].max())])
+                after.append(axis_after)
+
+            # Arcs can bulge out past both of their ends
+            for index in numpy.flatnonzero(is_arc).tolist():
+                if index > 0:
+                    start_x, start_y = float(after[0][index - 1]), float(after[1][index - 1])
+                else:
+                    start_x, start_y = position[:2]
+
+                for point_x, point_y in _arc_extremes(start_x, start_y, float(after[0][index]),
+                                                      float(after[1][index]), float(arc_i[index]),
+                                                      float(arc_j[index]), opcodes[index] == Opcode.ARC_CW):
+                    points[0].append(point_x)
+                    points[1].append(point_y)
+
+            position = [float(axis_after[-1]) for axis_after in after]
+
+        return points
+
+    def _head_points_by_line(self):
+        # The same as _head_points, one line at a time
+        points = ([0.0], [0.0], [0.0])
+        position = [0.0, 0.0, 0.0]
+        relative = False
+
+        for index in xrange(len(self.opcodes)):
+            opcode = self.opcodes[index]
+
+            if opcode == Opcode.ABSOLUTE:
+                relative = False
+            elif opcode == Opcode.RELATIVE:
+                relative = True
+            elif opcode in MOVE_OPCODES or opcode in ARC_OPCODES:
+                start_x, start_y = position[:2]
+
+                for axis, column in enumerate((self.x, self.y, self.z)):
+                    value = column[index]
+                    if value == value:
+                        position[axis] = position[axis] + value if relative else value
+                    points[axis].append(position[axis])
+
+                if opcode in ARC_OPCODES:
+                    for point_x, point_y in _arc_extremes(start_x, start_y, position[0], position[1], self.i[index],
+                                                          self.j[index], opcode == Opcode.ARC_CW):
+                        points[0].append(point_x)
+                        points[1].append(point_y)
+
+        return points
+
+    def memory_usage(self):
+        # Approximate number of bytes used by the columns, excluding comment strings and stored objects
+        columns = [self.opcodes, self.x, self.y, self.z, self.feed_rate, self.i, self.j, self.values, self.comments]
+        return sum(len(column) * column.itemsize for column in columns)
+
+    def _comment_index(self, comment):
+        if comment is None:
+            return -1
+
+        try:
+            return self.comment_lookup[comment]
+        except KeyError:
+            self.comment_strings.append(comment)
+            self.comment_lookup[comment] = len(self.comment_strings) - 1
+            return len(self.comment_strings) - 1
+
+    def _encode(self, line):
+        # Only the exact classes are stored in columns, so that subclasses keep their own behaviour
+        line_class = type(line)
+
+        if line_class in (MoveRapid, MoveFeed, MoveLinear):
+            if line.move_type == MoveType.RAPID:
+                opcode = Opcode.RAPID
+            else:
+                opcode = Opcode.FEED
+            return (opcode, _to_column(line.x), _to_column(line.y), _to_column(line.z),
+                    _to_column(line.feed_rate), NaN, NaN, NaN)
+        elif line_class is SetToolState and isinstance(line.tool_state, (int, long, float)):
+            return Opcode.TOOL_STATE, NaN, NaN, NaN, NaN, NaN, NaN, line.tool_state
+        elif line_class is BlankLine:
+            return Opcode.BLANK, NaN, NaN, NaN, NaN, NaN, NaN, NaN
+        elif line_class is Comment:
+            return Opcode.COMMENT, NaN, NaN, NaN, NaN, NaN, NaN, NaN
+        elif line_class is SetUnits and line.units in (Units.MM, Units.INCHES):
+            if line.units == Units.MM:
+                opcode = Opcode.UNITS_MM
+            else:
+                opcode = Opcode.UNITS_INCHES
+            return opcode, NaN, NaN, NaN, NaN, NaN, NaN, NaN
+        elif line_class is SetMovementMode:
+            if line.mode == MovementMode.ABSOLUTE:
+                opcode = Opcode.ABSOLUTE
+            else:
+                opcode = Opcode.RELATIVE
+            return opcode, NaN, NaN, NaN, NaN, NaN, NaN, NaN
+        elif line_class is MoveArc:
+            if line.direction == ArcDirection.CLOCKWISE:
+                opcode = Opcode.ARC_CW
+            else:
+                opcode = Opcode.ARC_ANTI_CW
+            return (opcode, _to_column(line.end_x), _to_column(line.end_y), _to_column(line.z),
+                    _to_column(line.feed_rate), _to_column(line.center_offset_x), _to_column(line.center_offset_y), NaN)
+
+        self.objects.append(line)
+        return Opcode.OBJECT, NaN, NaN, NaN, NaN, NaN, NaN, len(self.objects) - 1
+
+    def _view(self, index):
+        return self._build_line(self.opcodes[index], self.x[index], self.y[index], self.z[index],
+                                self.feed_rate[index], self.i[index], self.j[index], self.values[index],
+                                self.comments[index])
+
+    def _build_line(self, opcode, x, y, z, feed_rate, i, j, value, comment_index):
+        if comment_index < 0:
+            comment = None
+        else:
+            comment = self.comment_strings[comment_index]
+
+        if opcode == Opcode.FEED:
+            return MoveFeed(_from_column(x), _from_column(y), _from_column(z), _from_column(feed_rate), comment)
+        elif opcode == Opcode.TOOL_STATE:
+            if value.is_integer():
+                value = int(value)
+            return SetToolState(value, comment)
+        elif opcode == Opcode.RAPID:
+            return MoveRapid(_from_column(x), _from_column(y), _from_column(z), _from_column(feed_rate), comment)
+        elif opcode == Opcode.BLANK:
+            return BlankLine()
+        elif opcode == Opcode.COMMENT:
+            return Comment(comment)
+        elif opcode == Opcode.UNITS_MM:
+            return SetUnits(Units.MM, comment)
+        elif opcode == Opcode.UNITS_INCHES:
+            return SetUnits(Units.INCHES, comment)
+        elif opcode == Opcode.ABSOLUTE:
+            return SetMovementMode(MovementMode.ABSOLUTE, comment)
+        elif opcode == Opcode.RELATIVE:
+            return SetMovementMode(MovementMode.RELATIVE, comment)
+        elif opcode == Opcode.ARC_CW or opcode == Opcode.ARC_ANTI_CW:
+            if opcode == Opcode.ARC_CW:
+                direction = ArcDirection.CLOCKWISE
+            else:
+                direction = ArcDirection.ANTI_CLOCKWISE
+            return MoveArc(direction, _from_column(x), _from_column(y), _from_column(i), _from_column(j), comment,
+                           _from_column(z), _from_column(feed_rate))
+        else:
+            return self.objects[int(value)]
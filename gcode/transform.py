@@ -0,0 +1,217 @@
+__author__ = 'Richard'
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Transform(object):
+    """
+    An affine transform of the XY plane, plus an independent scale and offset for Z.
+    x' = a * x + b * y + c
+    y' = d * x + e * y + f
+    z' = z_scale * z + z_offset
+    """
+
+    def __init__(self, a=1.0, b=0.0, c=0.0, d=0.0, e=1.0, f=0.0, z_scale=1.0, z_offset=0.0):
+        self.a = a
+        self.b = b
+        self.c = c
+        self.d = d
+        self.e = e
+        self.f = f
+        self.z_scale = z_scale
+        self.z_offset = z_offset
+
+    @classmethod
+    def translation(cls, x=0, y=0, z=0):
+        return cls(c=x, f=y, z_offset=z)
+
+    @classmethod
+    def scaling(cls, x=1, y=1, z=1):
+        return cls(a=x, e=y, z_scale=z)
+
+    @classmethod
+    def rotation(cls, degrees, centre_x=0, centre_y=0):
+        # Anti-clockwise, about the given centre. Quarter turns are kept exact so that the axes stay separate
+        quarter_turns = degrees / 90.0
+        if quarter_turns == int(quarter_turns):
+            cos, sin = [(1, 0), (0, 1), (-1, 0), (0, -1)][int(quarter_turns) % 4]
+        else:
+            cos = math.cos(math.radians(degrees))
+            sin = math.sin(math.radians(degrees))
+
+        rotation = cls(a=cos, b=-sin, d=sin, e=cos)
+        return cls.translation(-centre_x, -centre_y).then(rotation).then(cls.translation(centre_x, centre_y))
+
+    @classmethod
+    def mirroring(cls, x=False, y=False, centre_x=0, centre_y=0):
+        # Mirroring x flips the sign of x coordinates, mirroring y flips y
+        return cls(a=-1 if x else 1, c=2 * centre_x if x else 0, e=-1 if y else 1, f=2 * centre_y if y else 0)
+
+    def then(self, other):
+        """
+        Return the transform that applies this one followed by other.
+        """
+        return Transform(other.a * self.a + other.b * self.d,
+                         other.a * self.b + other.b * self.e,
+                         other.a * self.c + other.b * self.f + other.c,
+                         other.d * self.a + other.e * self.d,
+                         other.d * self.b + other.e * self.e,
+                         other.d * self.c + other.e * self.f + other.f,
+                         other.z_scale * self.z_scale,
+                         other.z_scale * self.z_offset + other.z_offset)
+
+    def is_identity(self):
+        return (self.a, self.b, self.c, self.d, self.e, self.f, self.z_scale, self.z_offset) == (1, 0, 0, 0, 1, 0, 1, 0)
+
+    def mixes_axes(self):
+        # If so, a move that only gives one of x or y still changes both once transformed
+        return self.b != 0 or self.d != 0
+
+    def is_mirrored(self):
+        return self.a * self.e - self.b * self.d < 0
+
+    def is_similarity(self, tolerance=1e-9):
+        # Only a transform that keeps circles circular can be applied to arcs
+        column_1 = self.a * self.a + self.d * self.d
+        column_2 = self.b * self.b + self.e * self.e
+        return (abs(column_1 - column_2) <= tolerance * max(column_1, column_2) and
+                abs(self.a * self.b + self.d * self.e) <= tolerance * max(column_1, column_2))
+
+    def apply_point(self, x, y):
+        return self.a * x + self.b * y + self.c, self.d * x + self.e * y + self.f
+
+    def apply_vector(self, x, y):
+        return self.a * x + self.b * y, self.d * x + self.e * y
+
+    def apply_bounding_box(self, bounding_box):
+        if self.is_identity():
+            return dict(bounding_box)
+
+        corners = [self.apply_point(x, y) for x in (bounding_box["min_x"], bounding_box["max_x"])
+                   for y in (bounding_box["min_y"], bounding_box["max_y"])]
+        z_values = [self.z_scale * bounding_box["min_z"] + self.z_offset,
+                    self.z_scale * bounding_box["max_z"] + self.z_offset]
+
+        return {"min_x": min(x for x, y in corners), "max_x": max(x for x, y in corners),
+                "min_y": min(y for x, y in corners), "max_y": max(y for x, y in corners),
+                "min_z": min(z_values), "max_z": max(z_values)}
+
+    def apply_columns(self, x, y, z, arc_i, arc_j, relative, is_move, is_arc, state):
+        """
+        Transform a block of columns from a LineStore, given as numpy arrays with NaN for unused values.
+        relative, is_move and is_arc are boolean arrays for each line. state carries the position between blocks.
+        Returns new x, y, z, arc_i and arc_j arrays.
+        """
+        positioned = is_move | is_arc
+        absolute = positioned & ~relative
+        deltas = positioned & relative
+
+        translate = numpy.where(absolute, 1.0, 0.0)
+
+        if self.mixes_axes():
+            # Each new axis depends on both old ones, so missing axes have to be filled in from the current position
+            # (or with a zero distance for relative moves)
+            x = _fill_axis(x, absolute, deltas, state, "x")
+            y = _fill_axis(y, absolute, deltas, state, "y")
+
+            new_x = self.a * x + self.b * y + self.c * translate
+            new_y = self.d * x + self.e * y + self.f * translate
+        else:
+            new_x = self.a * x + self.c * translate
+            new_y = self.e * y + self.f * translate
+
+        new_z = self.z_scale * z + self.z_offset * translate
+
+        # Arc centres are always relative to the start of the arc
+        new_i = self.a * arc_i + self.b * arc_j
+        new_j = self.d * arc_i + self.e * arc_j
+
+        return new_x, new_y, new_z, new_i, new_j
+
+    def apply_line(self, x, y, z, arc_i, arc_j, relative, is_arc, state):
+        """
+        The same as apply_columns, for a single line. None is used for unused values.
+        """
+        if self.mixes_axes():
+            if relative:
+                x = x if x is not None else 0.0
+                y = y if y is not None else 0.0
+                state.x += x
+                state.y += y
+            else:
+                x = x if x is not None else state.x
+                y = y if y is not None else state.y
+                state.x = x
+                state.y = y
+
+        if relative:
+            translate = 0
+        else:
+            translate = 1
+
+        if x is not None and y is not None:
+            new_x = self.a * x + self.b * y + self.c * translate
+            new_y = self.d * x + self.e * y + self.f * translate
+        else:
+            new_x = self.a * x + self.c * translate if x is not None else None
+            new_y = self.e * y + self.f * translate if y is not None else None
+
+        if z is not None:
+            z = self.z_scale * z + self.z_offset * translate
+
+        if arc_i is not None and arc_j is not None:
+            arc_i, arc_j = self.apply_vector(arc_i, arc_j)
+
+        return new_x, new_y, z, arc_i, arc_j
+
+
+class TransformState(object):
+    # What has to be carried from one block of lines to the next while transforming them
+
+    def __init__(self):
+        self.relative = False
+        self.x = 0.0
+        self.y = 0.0
+
+
+def axis_positions(values, absolute, deltas, start):
+    """
+    Work out the position on one axis after each line, from a block of values with NaN where the axis isn't given.
+    absolute and deltas are boolean arrays of the lines that position the axis absolutely and relatively, and start
+    is the position before the block.
+    """
+    given = ~numpy.isnan(values)
+    resets = absolute & given
+    moves = deltas & given
+
+    step = numpy.where(moves, values, 0.0)
+    running_total = numpy.cumsum(step)
+
+    # The position after each line is the last absolute value, plus any relative moves since then
+    indexes = numpy.arange(len(values))
+    last_reset = numpy.maximum.accumulate(numpy.where(resets, indexes, -1))
+    has_reset = last_reset >= 0
+    safe_reset = numpy.maximum(last_reset, 0)
+    base = numpy.where(has_reset, values[safe_reset] - running_total[safe_reset], start)
+    return base + running_total
+
+
+def _fill_axis(values, absolute, deltas, state, axis):
+    # Work out the position on one axis before each line, then return the values with any gaps filled in
+    given = ~numpy.isnan(values)
+    position_after = axis_positions(values, absolute, deltas, getattr(state, axis))
+
+    filled = values.copy()
+    missing = ~given
+    position_before = numpy.concatenate(([getattr(state, axis)], position_after[:-1]))
+    filled[missing & absolute] = position_before[missing & absolute]
+    filled[missing & deltas] = 0.0
+
+    if len(values):
+        setattr(state, axis, float(position_after[-1]))
+
+    return filled
@@ -0,0 +1,496 @@
+from __future__ import division
+
+__author__ = 'Richard'
+
+# Reorders the lased parts of a program to cut down the travel between them. Each run of feed moves that follow on
+# from each other with the tool on somewhere along it is a path. Paths close enough together are an island, run in the
+# order they were in, and islands are run in the order and direction that gives the least travel that can be found
+# quickly: each next island is the nearest one left, and then the order is improved by 2-opt, which reverses stretches
+# of it where that shortens the travel. Reversing a stretch runs each of its islands backwards, which for a raster is
+# the same as engraving it from the top down. Points are found near each other with a grid of cells, as the spatial
+# index does. Requires numpy.
+
+import collections
+import math
+import time
+
+import numpy
+
+from gcode import stages
+from gcode.estimate import MIN_MOVE_LENGTH
+from gcode.spatial import read_moves, moves_file, MAX_GRID_SIDE
+
+# Paths whose bounding boxes are closer than this (in mm) are in the same island
+DEFAULT_ISLAND_GAP = 1.0
+
+# How many of the nearest islands to each one are tried by 2-opt
+NEIGHBOURS = 6
+
+# How long (in seconds) 2-opt can keep improving the order for
+DEFAULT_IMPROVE_SECONDS = 10.0
+
+# How many points each cell of the grid has on average
+POINTS_PER_CELL = 2
+
+
+class TravelReport(object):
+    """
+    How much travel was saved by reordering a program. travel_before and travel_after are how far (in mm) the head
+    moves other than along the paths, which are grouped into islands.
+    """
+
+    def __init__(self, paths=0, islands=0, travel_before=0.0, travel_after=0.0, seconds=0.0):
+        self.paths = paths
+        self.islands = islands
+        self.travel_before = travel_before
+        self.travel_after = travel_after
+        self.seconds = seconds
+
+    def __str__(self):
+        return ("{} paths in {} islands, travel {:.1f}mm before and {:.1f}mm after, "
+                "reordered in {:.3f}s").format(self.paths, self.islands, self.travel_before, self.travel_after,
+                                               self.seconds)
+
+
+def optimise_travel(gcode_file, island_gap=DEFAULT_ISLAND_GAP, improve_seconds=DEFAULT_IMPROVE_SECONDS):
+    """
+    Reorder the paths of the file to cut down its travel, replacing its lines. The new lines are in absolute mm with
+    the transform applied, so the transform is reset. Travel moves are replaced by rapids straight from one path to
+    the next with the tool off, arcs by the chords gcode.spatial breaks them into, and lines other than moves and tool
+    changes are left out. island_gap is how close (in mm) paths have to be to be kept together, and improve_seconds
+    limits how long is spent improving the first order found. The file is left alone if the new order wouldn't be
+    shorter. Returns a TravelReport.
+    """
+    with stages.stage("optimise_travel") as stage:
+        stage.lines = len(gcode_file.lines)
+        return _optimise_travel(gcode_file, island_gap, improve_seconds)
+
+
+def _optimise_travel(gcode_file, island_gap, improve_seconds):
+    start_time = time.time()
+    _, start_points, end_points, rapid, feed_rate, tool_power = read_moves(gcode_file)
+    lengths = numpy.sqrt(numpy.sum((end_points - start_points) ** 2, axis=1))
+
+    # Feed moves that start where the one before ended carry on its path
+    feed = ~rapid
+    follows_on = numpy.zeros(len(rapid), dtype=bool)
+    follows_on[1:] = feed[1:] & feed[:-1] & numpy.all(numpy.abs(start_points[1:] - end_points[:-1]) < MIN_MOVE_LENGTH,
+                                                      axis=1)
+    path_ids = numpy.cumsum(~follows_on) - 1
+
+    lased = feed & (tool_power > 0)
+    has_lased = numpy.bincount(path_ids[lased], minlength=path_ids[-1] + 1 if len(path_ids) else 0) > 0
+    in_path = feed & has_lased[path_ids]
+
+    report = TravelReport(travel_before=float(lengths[~in_path].sum()))
+
+    # The paths, each from its first move up to its last
+    path_moves = numpy.nonzero(in_path)[0]
+    if not len(path_moves):
+        report.travel_after = report.travel_before
+        report.seconds = time.time() - start_time
+        return report
+
+    path_starts = numpy.nonzero(numpy.concatenate(([True], numpy.diff(path_ids[path_moves]) != 0)))[0]
+    path_firsts = path_moves[path_starts]
+    path_lasts = path_moves[numpy.concatenate((path_starts[1:] - 1, [len(path_moves) - 1]))]
+    report.paths = len(path_firsts)
+
+    islands = _islands(start_points[path_moves, :2], end_points[path_moves, :2], path_starts, island_gap)
+    report.islands = len(islands)
+
+    # Islands are run from the start of their first path to the end of their last, or the other way round
+    entries = start_points[path_firsts[[paths[0] for paths in islands]], :2]
+    exits = end_points[path_lasts[[paths[-1] for paths in islands]], :2]
+
+    origin = (0.0, 0.0)
+    tour, reversed_islands = _nearest_neighbour_tour(entries, exits, origin)
+    tour, reversed_islands = _two_opt(entries, exits, tour, reversed_islands, origin, time.time() + improve_seconds)
+
+    # The moves in their new order, with those of reversed islands going the other way
+    paths = []
+    paths_backwards = []
+    for island, island_reversed in zip(tour, reversed_islands):
+        paths.extend(islands[island][::-1] if island_reversed else islands[island])
+        paths_backwards.extend([island_reversed] * len(islands[island]))
+    paths = numpy.array(paths)
+
+    counts = path_lasts[paths] - path_firsts[paths] + 1
+    backwards = numpy.repeat(paths_backwards, counts)
+    steps = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    order = numpy.where(backwards, numpy.repeat(path_lasts[paths], counts) - steps,
+                        numpy.repeat(path_firsts[paths], counts) + steps)
+    backwards = backwards[:, numpy.newaxis]
+
+    new_starts = numpy.where(backwards, end_points[order], start_points[order])
+    new_ends = numpy.where(backwards, start_points[order], end_points[order])
+
+    previous_ends = numpy.vstack(([[origin[0], origin[1], 0.0]], new_ends[:-1]))
+    report.travel_after = float(numpy.sum(numpy.sqrt(numpy.sum((new_starts - previous_ends) ** 2, axis=1))))
+
+    if report.travel_after < report.travel_before:
+        new_file = moves_file(gcode_file, new_starts, new_ends, rapid[order], feed_rate[order], tool_power[order])
+        gcode_file.lines = new_file.lines
+        gcode_file.bounding_box = new_file.bounding_box
+        gcode_file.reset_transform()
+    else:
+        report.travel_after = report.travel_before
+
+    report.seconds = time.time() - start_time
+    return report
+
+
+def _islands(start_points, end_points, path_starts, island_gap):
+    # Group the paths, which are the moves from each of path_starts up to the next, into islands, as lists of the
+    # paths in each in their order. Paths are in the same island if there is a chain of paths from one to the other,
+    # each closer than island_gap to the next
+    num_paths = len(path_starts)
+
+    # The bounding box of each path
+    path_low = numpy.minimum.reduceat(numpy.minimum(start_points, end_points), path_starts)
+    path_high = numpy.maximum.reduceat(numpy.maximum(start_points, end_points), path_starts)
+
+    # Paths that could be close enough share a cell of a grid, once their boxes are grown by half the gap
+    grown_low = path_low - island_gap / 2
+    grown_high = path_high + island_gap / 2
+    origin = grown_low.min(axis=0)
+    extent = grown_high.max(axis=0) - origin
+    cell_size = max(island_gap, extent.max() / MAX_GRID_SIDE, MIN_MOVE_LENGTH)
+    columns = int(extent[0] // cell_size) + 1
+
+    first_cells = ((grown_low - origin) // cell_size).astype(numpy.int64)
+    last_cells = ((grown_high - origin) // cell_size).astype(numpy.int64)
+    spans = last_cells[:, 0] - first_cells[:, 0] + 1
+    cell_counts = spans * (last_cells[:, 1] - first_cells[:, 1] + 1)
+
+    paths = numpy.repeat(numpy.arange(num_paths), cell_counts)
+    steps = numpy.arange(len(paths)) - (numpy.cumsum(cell_counts) - cell_counts)[paths]
+    cells = (first_cells[paths, 1] + steps // spans[paths]) * columns + first_cells[paths, 0] + steps % spans[paths]
+
+    order = numpy.argsort(cells, kind="mergesort")
+    cells = cells[order]
+    paths = paths[order]
+
+    # Every pair of paths in each cell
+    cell_ends = numpy.searchsorted(cells, cells, side="right")
+    later = cell_ends - numpy.arange(len(cells)) - 1
+    first_of_pair = numpy.repeat(numpy.arange(len(cells)), later)
+    second_of_pair = numpy.arange(len(first_of_pair)) - (numpy.cumsum(later) - later)[first_of_pair] + \
+        first_of_pair + 1
+    a = paths[first_of_pair]
+    b = paths[second_of_pair]
+
+    gaps = numpy.maximum(numpy.maximum(path_low[a], path_low[b]) - numpy.minimum(path_high[a], path_high[b]), 0)
+    close = numpy.hypot(gaps[:, 0], gaps[:, 1]) <= island_gap
+    labels = _connected_components(num_paths, a[close], b[close])
+
+    # Islands in the order of their first paths, each with its paths in order
+    path_order = numpy.argsort(labels, kind="mergesort")
+    island_firsts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(labels[path_order]))[0] + 1))
+    islands = numpy.split(path_order, island_firsts[1:])
+    islands.sort(key=lambda island: island[0])
+    return [list(island) for island in islands]
+
+
+def _connected_components(count, a, b):
+    # Label each of count nodes with the lowest node it is connected to through the edges from a to b. Each node takes
+    # the lowest label of its neighbours, then follows labels to labels until nothing changes
+    labels = numpy.arange(count)
+    nodes = numpy.concatenate((a, b))
+    neighbours = numpy.concatenate((b, a))
+    order = numpy.argsort(nodes, kind="mergesort")
+    nodes = nodes[order]
+    neighbours = neighbours[order]
+    if not len(nodes):
+        return labels
+
+    firsts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(nodes))[0] + 1))
+    linked = nodes[firsts]
+
+    while True:
+        lowest = numpy.minimum.reduceat(labels[neighbours], firsts)
+        new_labels = labels.copy()
+        new_labels[linked] = numpy.minimum(labels[linked], lowest)
+        # Lower the label of each node's old label too, so that labels spread further than one edge at a time
+        numpy.minimum.at(new_labels, labels[linked], new_labels[linked])
+        while True:
+            followed = new_labels[new_labels]
+            if (followed == new_labels).all():
+                break
+            new_labels = followed
+
+        if (new_labels == labels).all():
+            return labels
+        labels = new_labels
+
+
+class _PointGrid(object):
+    # Points in a grid of cells, for finding the nearest one still left to a position. Points are taken out with
+    # remove. Cells hold lists of their points, which are tidied up as the points in them are removed
+
+    def __init__(self, points):
+        low = points.min(axis=0)
+        extent = points.max(axis=0) - low
+        self.origin = low
+
+        # Points along a line would have cells with no area, so there are never more cells along a side than points
+        self.cell_size = max(math.sqrt(extent[0] * extent[1] * POINTS_PER_CELL / len(points)),
+                             extent.max() * POINTS_PER_CELL / len(points), extent.max() / MAX_GRID_SIDE,
+                             MIN_MOVE_LENGTH)
+        self.columns = int(extent[0] // self.cell_size) + 1
+        self.rows = int(extent[1] // self.cell_size) + 1
+
+        cell_x = numpy.minimum(((points[:, 0] - low[0]) // self.cell_size).astype(numpy.int64), self.columns - 1)
+        cell_y = numpy.minimum(((points[:, 1] - low[1]) // self.cell_size).astype(numpy.int64), self.rows - 1)
+        cells = self.point_cells = cell_y * self.columns + cell_x
+        order = numpy.argsort(cells, kind="mergesort")
+        bounds = numpy.searchsorted(cells[order], numpy.arange(self.columns * self.rows + 1))
+        order = order.tolist()
+        self.cells = [order[bounds[cell]:bounds[cell + 1]] for cell in xrange(self.columns * self.rows)]
+        self.left_in_cell = numpy.diff(bounds).tolist()
+        self.alive = [True] * len(points)
+        self.left = len(points)
+        self.x = points[:, 0].tolist()
+        self.y = points[:, 1].tolist()
+
+    def remove(self, point):
+        if self.alive[point]:
+            self.alive[point] = False
+            self.left -= 1
+            self.left_in_cell[self.point_cells[point]] -= 1
+
+    def nearest(self, x, y):
+        # The nearest point left to (x, y), looking through rings of cells further and further out until the next ring
+        # can't have anything nearer
+        if not self.left:
+            return None
+
+        column = min(max(int((x - self.origin[0]) // self.cell_size), 0), self.columns - 1)
+        row = min(max(int((y - self.origin[1]) // self.cell_size), 0), self.rows - 1)
+        furthest_ring = max(column, self.columns - 1 - column, row, self.rows - 1 - row)
+
+        best = None
+        best_distance = float("inf")
+        for ring in xrange(furthest_ring + 1):
+            if best is not None and best_distance <= (ring - 1) * self.cell_size:
+                break
+
+            for ring_row in xrange(max(row - ring, 0), min(row + ring, self.rows - 1) + 1):
+                if ring_row == row - ring or ring_row == row + ring:
+                    ring_columns = xrange(max(column - ring, 0), min(column + ring, self.columns - 1) + 1)
+                else:
+                    ring_columns = [ring_column for ring_column in (column - ring, column + ring)
+                                    if 0 <= ring_column < self.columns]
+
+                for ring_column in ring_columns:
+                    cell = ring_row * self.columns + ring_column
+                    if not self.left_in_cell[cell]:
+                        continue
+
+                    cell_points = self.cells[cell]
+                    if len(cell_points) > 2 * self.left_in_cell[cell]:
+                        cell_points = self.cells[cell] = [point for point in cell_points if self.alive[point]]
+
+                    for point in cell_points:
+                        if self.alive[point]:
+                            distance = math.hypot(self.x[point] - x, self.y[point] - y)
+                            if distance < best_distance:
+                                best = point
+                                best_distance = distance
+
+        return best
+
+
+def _nearest_neighbour_tour(entries, exits, origin):
+    # Run each next the island with the nearest entry or exit to where the head is, going into it that way. Returns
+    # the islands in order, and whether each is reversed
+    count = len(entries)
+    grid = _PointGrid(numpy.vstack((entries, exits)))
+
+    tour = []
+    reversed_islands = []
+    x, y = origin
+    for _ in xrange(count):
+        point = grid.nearest(x, y)
+        island = point % count
+        island_reversed = point >= count
+        grid.remove(island)
+        grid.remove(island + count)
+
+        tour.append(island)
+        reversed_islands.append(island_reversed)
+        x, y = entries[island] if island_reversed else exits[island]
+
+    return tour, reversed_islands
+
+
+def _island_neighbours(entries, exits):
+    # The NEIGHBOURS islands nearest to each, by the nearest of their entries and exits, as lists of the islands and
+    # how far away they are, nearest first. Only islands in the cells around each end are looked at, which is enough
+    # for 2-opt
+    count = len(entries)
+    points = numpy.vstack((entries, exits))
+    grid = _PointGrid(points)
+    cells = grid.point_cells
+    cell_x = cells % grid.columns
+    cell_y = cells // grid.columns
+
+    order = numpy.argsort(cells, kind="mergesort")
+    cell_counts = numpy.bincount(cells, minlength=grid.columns * grid.rows)
+    cell_starts = numpy.cumsum(cell_counts) - cell_counts
+
+    firsts = []
+    seconds = []
+    for offset_x in (-1, 0, 1):
+        for offset_y in (-1, 0, 1):
+            near_x = cell_x + offset_x
+            near_y = cell_y + offset_y
+            inside = (near_x >= 0) & (near_x < grid.columns) & (near_y >= 0) & (near_y < grid.rows)
+            near_cells = numpy.where(inside, near_y * grid.columns + near_x, 0)
+            starts = cell_starts[near_cells]
+            counts = numpy.where(inside, cell_counts[near_cells], 0)
+
+            point_ids = numpy.repeat(numpy.arange(len(points)), counts)
+            steps = numpy.arange(len(point_ids)) - (numpy.cumsum(counts) - counts)[point_ids]
+            firsts.append(point_ids)
+            seconds.append(order[starts[point_ids] + steps])
+
+    firsts = numpy.concatenate(firsts)
+    seconds = numpy.concatenate(seconds)
+    distances = numpy.hypot(points[firsts, 0] - points[seconds, 0], points[firsts, 1] - points[seconds, 1])
+    a = firsts % count
+    b = seconds % count
+    different = a != b
+    a = a[different]
+    b = b[different]
+    distances = distances[different]
+
+    # The nearest of each pair of islands, then the nearest islands to each. Sorting by island and then distance is
+    # sorting by the distance with the island a long way further on
+    order = numpy.argsort(a * (2 * distances.max() + 1) + distances)
+    a = a[order]
+    b = b[order]
+    nearest = numpy.unique(a * count + b, return_index=True)[1]
+    nearest.sort()
+    a = a[nearest]
+    b = b[nearest]
+    distances = distances[order][nearest]
+    kept = numpy.arange(len(a)) - numpy.searchsorted(a, a) < NEIGHBOURS
+
+    neighbours = [[] for _ in xrange(count)]
+    for island, neighbour, distance in zip(a[kept].tolist(), b[kept].tolist(), distances[kept].tolist()):
+        neighbours[island].append((neighbour, distance))
+    return neighbours
+
+
+def _two_opt(entries, exits, tour, reversed_islands, origin, deadline):
+    # Improve the order by reversing stretches of it, each island in them then being run the other way, for as long as
+    # that shortens the travel or until the deadline. Stretches starting or ending at each island are tried in turn,
+    # and an island is only looked at again once the islands either side of it change
+    count = len(tour)
+    if count < 2 or time.time() >= deadline:
+        return tour, reversed_islands
+
+    neighbours = _island_neighbours(entries, exits)
+
+    # The entry and exit of the island at each position of the order, going the way it is run. Everything is
+    # reversed with numpy, and the way each island is run is worked out from its entry at the end
+    tour = numpy.array(tour)
+    reversed_islands = numpy.array(reversed_islands)[:, numpy.newaxis]
+    ends = numpy.where(reversed_islands, exits[tour], entries[tour])
+    entry_x = ends[:, 0].copy()
+    entry_y = ends[:, 1].copy()
+    ends = numpy.where(reversed_islands, entries[tour], exits[tour])
+    exit_x = ends[:, 0].copy()
+    exit_y = ends[:, 1].copy()
+
+    positions = numpy.zeros(count, dtype=numpy.int64)
+    positions[tour] = numpy.arange(count)
+    hypot = math.hypot
+
+    def gain(first, last):
+        # How much shorter the travel is with the islands from first to last reversed, which joins the island before
+        # first to the old exit of last, and the old entry of first to the island after last
+        if first:
+            before_x, before_y = exit_x[first - 1], exit_y[first - 1]
+        else:
+            before_x, before_y = origin
+        saved = hypot(before_x - entry_x[first], before_y - entry_y[first]) - \
+            hypot(before_x - exit_x[last], before_y - exit_y[last])
+        if last + 1 < count:
+            after_x, after_y = entry_x[last + 1], entry_y[last + 1]
+            saved += hypot(exit_x[last] - after_x, exit_y[last] - after_y) - \
+                hypot(entry_x[first] - after_x, entry_y[first] - after_y)
+        return saved
+
+    waiting = collections.deque(tour.tolist())
+    queued = [True] * count
+    checked = 0
+    while waiting:
+        checked += 1
+        if checked % 256 == 0 and time.time() >= deadline:
+            break
+
+        island = waiting.popleft()
+        queued[island] = False
+        position = int(positions[island])
+
+        # A stretch can only shorten the travel if one of the moves it adds is shorter than the one it takes away
+        # next to it, so only stretches that add a move to a near enough neighbour are tried. Those starting here
+        # take away the move into this island, and join the island before it or this one to a neighbour
+        stretches = [(position, position)]
+        if position:
+            removed = hypot(exit_x[position - 1] - entry_x[position], exit_y[position - 1] - entry_y[position])
+        else:
+            removed = hypot(origin[0] - entry_x[position], origin[1] - entry_y[position])
+        if position:
+            for other, distance in neighbours[tour[position - 1]]:
+                if distance >= removed:
+                    break
+                stretches.append((position, positions[other]))
+        for other, distance in neighbours[island]:
+            if distance >= removed:
+                break
+            stretches.append((position, positions[other] - 1))
+
+        # Those ending here take away the move out of this island, and join this one or the island after it to one
+        if position + 1 < count:
+            removed = hypot(exit_x[position] - entry_x[position + 1], exit_y[position] - entry_y[position + 1])
+            for other, distance in neighbours[island]:
+                if distance >= removed:
+                    break
+                stretches.append((positions[other] + 1, position))
+            for other, distance in neighbours[tour[position + 1]]:
+                if distance >= removed:
+                    break
+                stretches.append((positions[other], position))
+
+        best_gain = MIN_MOVE_LENGTH
+        best_stretch = None
+        for first, last in stretches:
+            if first <= last:
+                stretch_gain = gain(first, last)
+                if stretch_gain > best_gain:
+                    best_gain = stretch_gain
+                    best_stretch = (first, last)
+
+        if best_stretch is None:
+            continue
+
+        first, last = best_stretch
+        end = last + 1
+        entry_x[first:end], exit_x[first:end] = exit_x[first:end][::-1].copy(), entry_x[first:end][::-1].copy()
+        entry_y[first:end], exit_y[first:end] = exit_y[first:end][::-1].copy(), entry_y[first:end][::-1].copy()
+        tour[first:end] = tour[first:end][::-1].copy()
+        positions[tour[first:end]] = numpy.arange(first, end)
+
+        for position in (first - 1, first, last, last + 1):
+            if 0 <= position < count:
+                island = int(tour[position])
+                if not queued[island]:
+                    queued[island] = True
+                    waiting.append(island)
+
+    # Islands that start and end in the same place are the same either way
+    reversed_islands = (entry_x != entries[tour, 0]) | (entry_y != entries[tour, 1])
+    return tour.tolist(), reversed_islands.tolist()
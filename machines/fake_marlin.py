@@ -0,0 +1,162 @@
+__author__ = 'Richard'
+
+# Pretends to be a Marlin controller on a pseudo-terminal, so that sending programs can be tried out and tested
+# without a machine attached. Lines are checked and acknowledged the way Marlin does it, and line noise can be added
+# to see that lines are resent.
+
+import errno
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+from machines.serial_stream import checksum
+
+# Marlin's RX_BUFFER_SIZE
+DEFAULT_RX_BUFFER_SIZE = 128
+
+
+class FakeMarlin(object):
+    """
+    A controller on a pseudo-terminal, running in a thread once started. Connect to its port. The commands it
+    accepts are kept, in order, in commands.
+    rx_buffer_size is the size of its receive buffer. Anything sent while the buffer is full is lost, as it would be
+    by a real controller. command_seconds is how long each command takes to run, and error_rate the chance of each
+    line being garbled on its way in.
+    """
+
+    def __init__(self, rx_buffer_size=DEFAULT_RX_BUFFER_SIZE, command_seconds=0.0, error_rate=0.0, seed=None):
+        self.rx_buffer_size = rx_buffer_size
+        self.command_seconds = command_seconds
+        self.error_rate = error_rate
+
+        self.commands = []
+        self.errors = 0
+        self.overflows = 0
+        self.max_buffered = 0
+
+        self._random = random.Random(seed)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._rx_buffer = ""
+        self._last_line_number = 0
+        self._next_command_time = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        self._write("start\n")
+
+        while not self._stopping.is_set():
+            wait = 0.01
+            if "\n" in self._rx_buffer:
+                wait = max(min(wait, self._next_command_time - time.time()), 0)
+
+            readable, _, _ = select.select([self._master], [], [], wait)
+            if readable:
+                self._receive()
+
+            # Bad lines are thrown away straight away, but each command takes a while to run
+            while "\n" in self._rx_buffer and time.time() >= self._next_command_time:
+                line, self._rx_buffer = self._rx_buffer.split("\n", 1)
+                if self._process(line):
+                    self._next_command_time = time.time() + self.command_seconds
+
+    def _receive(self):
+        try:
+            data = os.read(self._master, 4096)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EIO):
+                return
+            raise
+
+        space = self.rx_buffer_size - len(self._rx_buffer)
+        if len(data) > space:
+            self.overflows += 1
+            data = data[:space]
+
+        self._rx_buffer += data
+        self.max_buffered = max(self.max_buffered, len(self._rx_buffer))
+
+    def _process(self, line):
+        # Returns whether the line was accepted
+        if self.error_rate and " " in line and self._random.random() < self.error_rate:
+            # Garble one character after the line number, where the checksum catches it
+            position = self._random.randrange(line.index(" "), len(line))
+            line = line[:position] + chr(ord(line[position]) ^ 0x20) + line[position + 1:]
+
+        line = line.strip()
+        if not line:
+            return False
+
+        if line.startswith("N"):
+            if "*" not in line:
+                return self._line_error("No Checksum with line number")
+
+            text, line_checksum = line.rsplit("*", 1)
+            try:
+                line_number_word, command = (text.split(" ", 1) + [""])[:2]
+                line_number = int(line_number_word[1:])
+                valid = checksum(text) == int(line_checksum)
+            except ValueError:
+                return self._line_error("checksum mismatch")
+
+            if not valid:
+                return self._line_error("checksum mismatch")
+
+            if command.startswith("M110"):
+                new_line_number = command.split("N", 1)[1] if "N" in command else None
+                self._last_line_number = int(new_line_number) if new_line_number else line_number
+            elif line_number != self._last_line_number + 1:
+                return self._line_error("Line Number is not Last Line Number+1")
+            else:
+                self._last_line_number = line_number
+        else:
+            command = line
+
+        self.commands.append(command)
+        self._write("ok\n")
+        return True
+
+    def _line_error(self, message):
+        # Marlin throws away whatever else it has received and asks for the line after the last good one again
+        self.errors += 1
+        self._rx_buffer = ""
+        self._write("Error:%s, Last Line: %d\nResend: %d\nok\n" % (message, self._last_line_number,
+                                                                   self._last_line_number + 1))
+        return False
+
+    def _write(self, data):
+        while data:
+            try:
+                written = os.write(self._master, data)
+            except OSError as error:
+                if error.errno == errno.EAGAIN:
+                    time.sleep(0.001)
+                    continue
+                raise
+            data = data[written:]
@@ -1,15 +1,36 @@
 __author__ = 'Richard'
 
-from gcode.line import LineType
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from gcode.fixed import distance_formatter, column_formatter, power_table, power_column_emitter
+from gcode.line import LineType, MoveType, ArcDirection, Units, MovementMode
+import modal
 
 class BaseMachine(object):
+    # Whether a move can leave out G0 / G1 when it is the same as the move before. Used when the modal state is
+    # being compressed
+    modal_motion = True
+
+    # Limits on the machine's motion, used to estimate how long a program takes. Rates are in mm/min, as F words are,
+    # acceleration in mm/s^2 and junction deviation (how far the path can cut a corner) in mm, as grbl has them
+    max_feed_rate = 3000
+    rapid_rate = 3000
+    acceleration = 500
+    junction_deviation = 0.01
 
     def __init__(self):
         self.output_properties = {
             "movement_precision": 2,
             "line_endings": "\n",
             "line_numbers": False,
-            "include_comments": True
+            "include_comments": True,
+            "compress_modal_state": False,
+            "tool_power_tolerance": 0
         }
 
     def set_output_property(self, property, value):
@@ -21,51 +42,295 @@ class BaseMachine(object):
     def output(self, gcode_file):
         return gcode_file.output(None)
 
+    def create_modal_state(self, file):
+        # What the controller has already been told, so that it isn't repeated. None unless the file asks for it
+        if not file.get_output_property("compress_modal_state"):
+            return None
+
+        return modal.ModalState(file.get_output_property("movement_precision"), self.modal_motion,
+                                file.get_output_property("tool_power_tolerance"))
+
+    def build_emitters(self, file, modal_state=None):
+        """
+        Build the table of functions used to output each type of line, keyed by line type. Each function takes a line
+        and returns a string or a list of strings. The table is built once for each output of a file, so anything that
+        depends on the file's output properties is worked out here rather than for every line. Line types without an
+        entry are output by the line itself. Machines change how a type of line is output by replacing its entry.
+        If a modal_state is given, the emitters leave out anything that it already has set.
+        """
+        precision = file.get_output_property("movement_precision")
+
+        emitters = {
+            LineType.BLANK: _emit_nothing,
+            LineType.COMMENT: _emit_nothing,
+            LineType.SET_UNITS: _emit_set_units,
+            LineType.SET_MOVEMENT_MODE: _emit_set_movement_mode,
+            LineType.MOVE_LINEAR: _move_linear_emitter(precision),
+            LineType.MOVE_ARC: _move_arc_emitter(precision),
+            LineType.TOOL_STATE: _emit_tool_state
+        }
+
+        if modal_state is not None:
+            emitters = modal.compress_emitters(emitters, file, modal_state)
+
+        return emitters
+
     def line_output_function(self, file, line):
+        # Output a single line. Outputting a whole file uses the table from build_emitters directly
+        emitter = self.build_emitters(file).get(line.type)
 
-        line_type = line.type
-
-        if line_type == LineType.COMMENT:
-            return self._output_line_comment(file, line)
-        elif line_type == LineType.SET_UNITS:
-            return self._output_line_set_units(file, line)
-        elif line_type == LineType.SET_MOVEMENT_MODE:
-            return self._output_line_set_movement_mode(file, line)
-        elif line_type == LineType.MOVE_LINEAR:
-            return self._output_line_move_linear(file, line)
-        elif line_type == LineType.MOVE_ARC:
-            return self._output_line_move_arc(file, line)
-        elif line_type == LineType.DWELL:
-            return self._output_line_move_dwell(file, line)
-        elif line_type == LineType.TOOL_STATE:
-            return self._output_line_tool_state(file, line)
+        if emitter is not None:
+            return emitter(line)
         else:
             return line.output(file)
 
-    def _output_line_comment(self, file, line):
-        return line.output(file)
 
-    def _output_line_set_units(self, file, line):
-        return line.output(file)
+class BaseMachineArcNotationR(BaseMachine):
+    # Arcs are given by their radius rather than the offset to their centre. The radius is negative for an arc of more
+    # than half a turn, which can only be told from where the arc starts, so the head is followed through the moves
 
-    def _output_line_set_movement_mode(self, file, line):
-        return line.output(file)
+    def build_emitters(self, file, modal_state=None):
+        emitters = super(BaseMachineArcNotationR, self).build_emitters(file, modal_state)
 
-    def _output_line_move_linear(self, file, line):
-        return line.output(file)
+        head = _HeadPosition()
+        emitters[LineType.SET_MOVEMENT_MODE] = head.set_movement_mode_emitter(emitters[LineType.SET_MOVEMENT_MODE])
+        emitters[LineType.MOVE_LINEAR] = head.move_linear_emitter(emitters[LineType.MOVE_LINEAR])
+        emit_move_arc = head.move_arc_emitter(_move_arc_r_emitter(file.get_output_property("movement_precision"),
+                                                                  head))
 
-    def _output_line_move_arc(self, file, line):
-        return line.output(file)
+        if modal_state is not None:
+            emitters[LineType.MOVE_ARC] = modal.move_arc_emitter(modal_state, emit_move_arc)
+        else:
+            emitters[LineType.MOVE_ARC] = emit_move_arc
 
-    def _output_line_move_dwell(self, file, line):
-        return line.output(file)
+        return emitters
 
-    def _output_line_tool_state(self, file, line):
-        return line.output(file)
 
+class _HeadPosition(object):
+    # Where the head is in XY, from the moves output so far. Like the parser, the head starts at the origin
 
-class BaseMachineArcNotationR(BaseMachine):
+    def __init__(self):
+        self.absolute = True
+        self.x = 0.0
+        self.y = 0.0
+
+    def set_movement_mode_emitter(self, emit):
+
+        def emit_set_movement_mode(line):
+            self.absolute = line.mode == MovementMode.ABSOLUTE
+            return emit(line)
+
+        return emit_set_movement_mode
+
+    def move_linear_emitter(self, emit):
+
+        def emit_move_linear(line):
+            if self.absolute:
+                if line.x is not None:
+                    self.x = line.x
+                if line.y is not None:
+                    self.y = line.y
+            else:
+                if line.x is not None:
+                    self.x += line.x
+                if line.y is not None:
+                    self.y += line.y
+
+            return emit(line)
+
+        return emit_move_linear
+
+    def move_arc_emitter(self, emit):
+
+        def emit_move_arc(line):
+            # The arc is output before the head moves, as it needs to know where it starts
+            command_output = emit(line)
+
+            if self.absolute:
+                self.x = line.end_x
+                self.y = line.end_y
+            else:
+                self.x += line.end_x
+                self.y += line.end_y
+
+            return command_output
+
+        return emit_move_arc
+
+    def arc_start(self):
+        # In relative mode the end of an arc is given from its start
+        if self.absolute:
+            return self.x, self.y
+        return 0.0, 0.0
+
+
+# The emitters give exactly the same text as the output methods of the lines. Distances are rounded to the precision
+# and then converted with str, which is what formatting them with "{}" does, by a formatter from gcode.fixed that keeps
+# the text of the values it has already seen.
+# An emitter can also have an emit_columns function, which FileOutput uses to output a block of lines of its type at
+# once from numpy arrays of their columns, rather than creating each line. It takes the same columns as the lines are
+# made from and gives an object array of what the emitter would for each line. Emitters that follow or change state as
+# they go don't have one, so wrapping an emitter leaves it out
+
+def _emit_nothing(line):
+    return ""
+
+def _emit_set_units(line):
+    if line.units == Units.MM:
+        return "G21"
+    else:
+        return "G20"
+
+def _emit_set_movement_mode(line):
+    if line.mode == MovementMode.ABSOLUTE:
+        return "G90"
+    else:
+        return "G91"
+
+def _move_linear_emitter(precision):
+    format_distance = distance_formatter(precision)
+
+    def emit_move_linear(line):
+        if line.move_type == MoveType.FEED:
+            gcode_str = "G1"
+        else:
+            gcode_str = "G0"
+
+        if line.x is not None:
+            gcode_str += " X" + format_distance(line.x)
+
+        if line.y is not None:
+            gcode_str += " Y" + format_distance(line.y)
+
+        if line.z is not None:
+            gcode_str += " Z" + format_distance(line.z)
+
+        if line.feed_rate is not None:
+            gcode_str += " F" + format_distance(line.feed_rate)
+
+        return gcode_str
+
+    emit_move_linear.emit_columns = _move_linear_columns_emitter(precision)
+    return emit_move_linear
+
+def _move_linear_columns_emitter(precision):
+    format_x = column_formatter(" X", precision)
+    format_y = column_formatter(" Y", precision)
+    format_z = column_formatter(" Z", precision)
+    format_feed_rate = column_formatter(" F", precision)
+
+    def emit_move_linear_columns(rapid, x, y, z, feed_rate):
+        gcode_str = numpy.empty(len(rapid), dtype=object)
+        gcode_str[:] = "G1"
+        gcode_str[rapid] = "G0"
+
+        return gcode_str + format_x(x) + format_y(y) + format_z(z) + format_feed_rate(feed_rate)
+
+    return emit_move_linear_columns
+
+def _move_arc_emitter(precision):
+    format_distance = distance_formatter(precision)
+
+    def emit_move_arc(line):
+        if line.direction == ArcDirection.CLOCKWISE:
+            gcode_str = "G2"
+        else:
+            gcode_str = "G3"
+
+        gcode_str += " X%s Y%s" % (format_distance(line.end_x), format_distance(line.end_y))
+
+        if line.z is not None:
+            gcode_str += " Z" + format_distance(line.z)
+
+        gcode_str += " I%s J%s" % (format_distance(line.center_offset_x), format_distance(line.center_offset_y))
+
+        if line.feed_rate is not None:
+            gcode_str += " F" + format_distance(line.feed_rate)
+
+        return gcode_str
+
+    return emit_move_arc
+
+def _move_arc_r_emitter(precision, head):
+    format_distance = distance_formatter(precision)
+
+    def emit_move_arc_r(line):
+        if line.direction == ArcDirection.CLOCKWISE:
+            gcode_str = "G2"
+        else:
+            gcode_str = "G3"
+
+        start_x, start_y = head.arc_start()
+        radius = math.hypot(line.center_offset_x, line.center_offset_y)
+
+        # The angle swept, going the right way round from the start to the end
+        from_x = -line.center_offset_x
+        from_y = -line.center_offset_y
+        to_x = line.end_x - start_x - line.center_offset_x
+        to_y = line.end_y - start_y - line.center_offset_y
+        angle = math.atan2(from_x * to_y - from_y * to_x, from_x * to_x + from_y * to_y)
+        if line.direction == ArcDirection.CLOCKWISE:
+            angle = -angle
+
+        if line.feed_rate is not None:
+            feed_rate = " F" + format_distance(line.feed_rate)
+        else:
+            feed_rate = ""
+
+        if round(line.end_x - start_x, precision) == 0 and round(line.end_y - start_y, precision) == 0:
+            # A radius can't say which circle a full turn goes round, so it is made in two halves
+            if head.absolute:
+                half_x = start_x - 2 * from_x
+                half_y = start_y - 2 * from_y
+                end_x = line.end_x
+                end_y = line.end_y
+            else:
+                half_x = -2 * from_x
+                half_y = -2 * from_y
+                end_x = 2 * from_x
+                end_y = 2 * from_y
+
+            # The head is only followed in XY, so an absolute Z is reached over the second half
+            half_z = end_z = ""
+            if line.z is not None:
+                if head.absolute:
+                    end_z = " Z" + format_distance(line.z)
+                else:
+                    half = round(line.z / 2.0, precision)
+                    half_z = " Z" + format_distance(half)
+                    end_z = " Z" + format_distance(line.z - half)
+
+            return [gcode_str + " X%s Y%s%s R%s%s" % (format_distance(half_x), format_distance(half_y), half_z,
+                                                      format_distance(radius), feed_rate),
+                    gcode_str + " X%s Y%s%s R%s" % (format_distance(end_x), format_distance(end_y), end_z,
+                                                    format_distance(radius))]
+
+        if angle < 0:
+            # More than half a turn
+            radius = -radius
+
+        if line.z is not None:
+            z = " Z" + format_distance(line.z)
+        else:
+            z = ""
+
+        return gcode_str + " X%s Y%s%s R%s%s" % (format_distance(line.end_x), format_distance(line.end_y), z,
+                                                 format_distance(radius), feed_rate)
+
+    return emit_move_arc_r
+
+def _format_tool_state(tool_state):
+    return "M106 S%s" % (tool_state,)
+
+_TOOL_STATE_COMMANDS = power_table(_format_tool_state)
+
+def _emit_tool_state(line):
+    # Whole powers are looked up, anything else is formatted
+    tool_state = line.tool_state
+    if type(tool_state) is int and 0 <= tool_state < len(_TOOL_STATE_COMMANDS):
+        return _TOOL_STATE_COMMANDS[tool_state]
 
-    def _output_line_move_arc(self, file, line):
-        return "Do it with Rs"
+    return _format_tool_state(tool_state)
 
+if numpy is not None:
+    _emit_tool_state.emit_columns = power_column_emitter(_TOOL_STATE_COMMANDS, _format_tool_state)
@@ -1,15 +1,76 @@
 __author__ = 'Richard'
 
-from machine import BaseMachine, BaseMachineArcNotationR
+from gcode.fixed import power_table, power_column_emitter
+from gcode.line import LineType, MoveType
+from machine import BaseMachine, BaseMachineArcNotationR, numpy
+import modal
 
 class Marlin(BaseMachine):
+    # Marlin needs a G word on every move
+    modal_motion = False
 
-    def _output_line_tool_state(self, file, line):
-        if line.tool_state > 0:
-            tool = 3
+    # Marlin's default configuration for X and Y
+    max_feed_rate = 18000
+    rapid_rate = 18000
+    acceleration = 3000
+    junction_deviation = 0.013
+
+    def build_emitters(self, file, modal_state=None):
+        emitters = super(Marlin, self).build_emitters(file, modal_state)
+
+        if modal_state is not None:
+            emitters[LineType.TOOL_STATE] = _modal_tool_state_emitter(modal_state)
+            for line_type in (LineType.MOVE_LINEAR, LineType.MOVE_ARC):
+                emitters[line_type] = _modal_move_emitter(modal_state, emitters[line_type])
         else:
-            tool = 5
+            emitters[LineType.TOOL_STATE] = _emit_tool_state
+
+        return emitters
+
+
+def _tool_state_commands(tool_state):
+    if tool_state > 0:
+        tool = 3
+    else:
+        tool = 5
+
+    return ["M0%d" % tool, "G00 Z%.3f" % (float(tool_state) / 100)]
+
+_TOOL_STATE_COMMANDS = power_table(_tool_state_commands)
+
+def _emit_tool_state(line):
+    # Whole powers are looked up, anything else is formatted
+    tool_state = line.tool_state
+    if type(tool_state) is int and 0 <= tool_state < len(_TOOL_STATE_COMMANDS):
+        return _TOOL_STATE_COMMANDS[tool_state]
+
+    return _tool_state_commands(tool_state)
+
+if numpy is not None:
+    _emit_tool_state.emit_columns = power_column_emitter(_TOOL_STATE_COMMANDS, _tool_state_commands)
+
+def _modal_tool_state_emitter(modal_state):
+    emit = modal.tool_state_emitter(modal_state, _emit_tool_state)
+
+    def emit_tool_state(line):
+        commands = emit(line)
+
+        if commands:
+            # The tool state is set by a rapid move in Z
+            modal_state.motion = MoveType.RAPID
+            modal_state.z = None
+
+        return commands
+
+    return emit_tool_state
+
+def _modal_move_emitter(modal_state, emit):
+
+    def emit_move(line):
+        if line.z is not None:
+            # Z is where the tool state is held, so after the move it is no longer known
+            modal_state.tool_state = None
 
-        response = ["M0{tool}".format(tool=tool), "G00 Z{z_pos:.3f}".format(z_pos=float(line.tool_state) / 100)]
-        return response
+        return emit(line)
 
+    return emit_move
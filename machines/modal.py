@@ -0,0 +1,202 @@
+__author__ = 'Richard'
+
+# Output that leaves out anything the controller already has set. G-code words such as the feed rate, the motion
+# mode and the axis positions stay in effect until they are changed, so repeating them only costs space in the file
+# and time on the serial link to the controller.
+
+from gcode.line import LineType, MoveType, MovementMode
+
+
+class ModalState(object):
+    """
+    What the controller will have set after each line that has been output so far. None means that the value is not
+    known, in which case it is always output. Distances are kept as they were written, rounded to the precision.
+    """
+
+    def __init__(self, precision, modal_motion=True, tool_power_tolerance=0):
+        self.precision = precision
+        # Whether a move can leave out its G0 / G1 when it is the same as the move before
+        self.modal_motion = modal_motion
+        # Tool state changes no bigger than this are left out
+        self.tool_power_tolerance = tool_power_tolerance
+        self.reset()
+
+    def reset(self):
+        # Forget everything, for when a line that isn't understood may have changed any of it
+        self.units = None
+        self.movement_mode = None
+        self.motion = None
+        self.feed_rate = None
+        self.tool_state = None
+        self.forget_position()
+
+    def forget_position(self):
+        self.x = None
+        self.y = None
+        self.z = None
+
+    def set_units(self, units):
+        # Returns whether the line is needed
+        if units == self.units:
+            return False
+
+        # The distances that have been kept are in the old units
+        self.units = units
+        self.feed_rate = None
+        self.forget_position()
+        return True
+
+    def set_movement_mode(self, mode):
+        if mode == self.movement_mode:
+            return False
+
+        self.movement_mode = mode
+        return True
+
+    def set_tool_state(self, tool_state):
+        # Turning the tool on or off is never left out, however small the change
+        if (self.tool_state is not None and (tool_state > 0) == (self.tool_state > 0) and
+                abs(tool_state - self.tool_state) <= self.tool_power_tolerance):
+            return False
+
+        self.tool_state = tool_state
+        return True
+
+    def move_axis(self, axis, distance):
+        """
+        Return the rounded distance for an axis of a move, or None if it can be left out, and keep track of where the
+        axis ends up.
+        """
+        distance = round(distance, self.precision)
+
+        if self.movement_mode == MovementMode.ABSOLUTE:
+            if distance == getattr(self, axis):
+                return None
+            setattr(self, axis, distance)
+        elif self.movement_mode == MovementMode.RELATIVE:
+            if distance == 0:
+                return None
+            setattr(self, axis, None)
+        else:
+            setattr(self, axis, None)
+
+        return distance
+
+
+def compress_emitters(emitters, file, modal_state):
+    """
+    Return a copy of a table of emitters from BaseMachine.build_emitters that leaves out whatever modal_state
+    already has set. Moves are output here in full, the other types of line by the emitters they replace.
+    """
+    emitters = dict(emitters)
+    emitters[LineType.UNKNOWN] = unknown_line_emitter(modal_state, file)
+    emitters[LineType.SET_UNITS] = set_units_emitter(modal_state, emitters[LineType.SET_UNITS])
+    emitters[LineType.SET_MOVEMENT_MODE] = set_movement_mode_emitter(modal_state,
+                                                                     emitters[LineType.SET_MOVEMENT_MODE])
+    emitters[LineType.MOVE_LINEAR] = move_linear_emitter(modal_state)
+    emitters[LineType.MOVE_ARC] = move_arc_emitter(modal_state, emitters[LineType.MOVE_ARC])
+    emitters[LineType.TOOL_STATE] = tool_state_emitter(modal_state, emitters[LineType.TOOL_STATE])
+    return emitters
+
+def unknown_line_emitter(modal_state, file):
+
+    def emit_unknown_line(line):
+        # The line could have changed anything
+        modal_state.reset()
+        return line.output(file)
+
+    return emit_unknown_line
+
+def set_units_emitter(modal_state, emit):
+
+    def emit_set_units(line):
+        if not modal_state.set_units(line.units):
+            return ""
+        return emit(line)
+
+    return emit_set_units
+
+def set_movement_mode_emitter(modal_state, emit):
+
+    def emit_set_movement_mode(line):
+        if not modal_state.set_movement_mode(line.mode):
+            return ""
+        return emit(line)
+
+    return emit_set_movement_mode
+
+def move_linear_emitter(modal_state):
+    precision = modal_state.precision
+
+    def emit_move_linear(line):
+        gcode_str = ""
+
+        if line.x is not None:
+            x = modal_state.move_axis("x", line.x)
+            if x is not None:
+                gcode_str += " X%s" % x
+
+        if line.y is not None:
+            y = modal_state.move_axis("y", line.y)
+            if y is not None:
+                gcode_str += " Y%s" % y
+
+        if line.z is not None:
+            z = modal_state.move_axis("z", line.z)
+            if z is not None:
+                gcode_str += " Z%s" % z
+
+        if line.feed_rate is not None:
+            feed_rate = round(line.feed_rate, precision)
+            if feed_rate != modal_state.feed_rate:
+                modal_state.feed_rate = feed_rate
+                gcode_str += " F%s" % feed_rate
+
+        if not gcode_str:
+            # Nothing would change, so the whole line can go
+            return ""
+
+        if modal_state.modal_motion and line.move_type == modal_state.motion:
+            return gcode_str.lstrip()
+
+        modal_state.motion = line.move_type
+
+        if line.move_type == MoveType.FEED:
+            return "G1" + gcode_str
+        else:
+            return "G0" + gcode_str
+
+    return emit_move_linear
+
+def move_arc_emitter(modal_state, emit):
+    precision = modal_state.precision
+
+    def emit_move_arc(line):
+        # Arcs are always given in full, as leaving out the end point would change their meaning
+        modal_state.motion = None
+        if modal_state.movement_mode == MovementMode.ABSOLUTE:
+            modal_state.x = round(line.end_x, precision)
+            modal_state.y = round(line.end_y, precision)
+            if line.z is not None:
+                modal_state.z = round(line.z, precision)
+        else:
+            modal_state.x = None
+            modal_state.y = None
+            if line.z is not None:
+                modal_state.z = None
+
+        if line.feed_rate is not None:
+            modal_state.feed_rate = round(line.feed_rate, precision)
+
+        return emit(line)
+
+    return emit_move_arc
+
+def tool_state_emitter(modal_state, emit):
+
+    def emit_tool_state(line):
+        if not modal_state.set_tool_state(line.tool_state):
+            return ""
+        return emit(line)
+
+    return emit_tool_state
@@ -0,0 +1,369 @@
+__author__ = 'Richard'
+
+# Sends a program straight to a Marlin controller over a serial port. Rather than waiting for each line to be
+# acknowledged before sending the next, lines are sent for as long as they fit in what is left of the controller's
+# receive buffer, counting the characters of every line that hasn't been acknowledged yet. The controller always has
+# the next lines waiting, so its planner never runs dry on dense moves.
+
+import collections
+import errno
+import os
+import re
+import select
+import termios
+import time
+import tty
+
+# Marlin's default RX_BUFFER_SIZE is 128, of which one byte is always left free
+DEFAULT_RX_BUFFER_SIZE = 127
+
+DEFAULT_BAUD_RATE = 115200
+
+# How long (in seconds) the controller can go without saying anything while lines are waiting for it
+DEFAULT_TIMEOUT = 30.0
+
+# How long (in seconds) the controller has to be quiet after asking for a line again before it is resent
+DEFAULT_SETTLE_SECONDS = 0.1
+
+# How many acknowledged lines are kept in case the controller asks for them again
+HISTORY_LINES = 256
+
+RESEND_REGEX = re.compile(r"^(?:Resend:|rs)\s*N?:?\s*(\d+)", re.IGNORECASE)
+LINE_NUMBER_REGEX = re.compile(r"^N\d+\s*")
+
+# The termios speeds for the usual baud rates, where this platform has them
+BAUD_RATES = dict((rate, getattr(termios, "B%d" % rate)) for rate in (9600, 19200, 38400, 57600, 115200, 230400,
+                                                                      250000, 460800, 500000, 921600, 1000000)
+                  if hasattr(termios, "B%d" % rate))
+
+
+class StreamError(Exception):
+    pass
+
+
+def checksum(text):
+    # Marlin's checksum is every character of the line, up to the *, XORed together
+    result = 0
+    for character in text:
+        result ^= ord(character)
+    return result & 0xff
+
+
+def numbered_line(line_number, command):
+    # The line as sent, with its line number and checksum
+    text = "N%d %s" % (line_number, command)
+    return "%s*%d\n" % (text, checksum(text))
+
+
+def program_commands(lines):
+    # The commands in output lines, without comments, their own line numbers or blank lines
+    for line in lines:
+        command = line.split(";", 1)[0].strip()
+        command = LINE_NUMBER_REGEX.sub("", command)
+        if command:
+            yield command
+
+
+def open_port(port, baud_rate=DEFAULT_BAUD_RATE):
+    """
+    Open a serial port (or pseudo-terminal) for raw, non-blocking use. Returns its file descriptor.
+    """
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        tty.setraw(fd)
+        attributes = termios.tcgetattr(fd)
+
+        if baud_rate in BAUD_RATES:
+            attributes[4] = attributes[5] = BAUD_RATES[baud_rate]
+        elif os.isatty(fd) and not os.ttyname(fd).startswith("/dev/pts/"):
+            raise StreamError("Unsupported baud rate: {}".format(baud_rate))
+
+        # Don't reset the controller when the port is closed
+        attributes[2] &= ~termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    except:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+class StreamStats(object):
+    """
+    How a program went to the controller. Latency is from sending a line to it being acknowledged, in seconds.
+    """
+
+    def __init__(self):
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.lines_acknowledged = 0
+        self.resends = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.latencies = []
+        self.max_bytes_in_flight = 0
+
+    @property
+    def lines_per_second(self):
+        return self.lines_acknowledged / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_sent / self.seconds if self.seconds else 0.0
+
+    def latency(self, fraction):
+        # The latency that the given fraction of lines were acknowledged within
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    def as_dict(self):
+        return {
+            "lines_sent": self.lines_sent,
+            "bytes_sent": self.bytes_sent,
+            "lines_acknowledged": self.lines_acknowledged,
+            "resends": self.resends,
+            "errors": self.errors,
+            "seconds": self.seconds,
+            "lines_per_second": self.lines_per_second,
+            "bytes_per_second": self.bytes_per_second,
+            "latency_median": self.latency(0.5),
+            "latency_95": self.latency(0.95),
+            "latency_max": self.latency(1.0),
+            "max_bytes_in_flight": self.max_bytes_in_flight
+        }
+
+    def __str__(self):
+        return ("Sent {lines_acknowledged} lines ({bytes_sent} bytes) in {seconds:.2f}s: {lines_per_second:.0f} "
+                "lines/s, {bytes_per_second:.0f} bytes/s\n"
+                "Latency: median {median:.1f}ms, 95% {p95:.1f}ms, max {max:.1f}ms. {resends} resends, "
+                "{errors} errors").format(median=self.latency(0.5) * 1000, p95=self.latency(0.95) * 1000,
+                                          max=self.latency(1.0) * 1000, **self.as_dict())
+
+
+class MarlinStreamer(object):
+    """
+    Streams commands to a Marlin controller on an open file descriptor, from open_port. Every line is sent with a line
+    number and checksum, and lines the controller asks for again are resent. rx_buffer_size is how many characters
+    can be waiting in the controller at once, and must be no more than its RX_BUFFER_SIZE.
+    When the controller finds a bad line, it throws away everything it has received and asks for that line again.
+    Lines that were already on their way are then thrown away in the same way, each time throwing away anything sent
+    since. So nothing is resent until the controller has been quiet for settle_seconds, which has to be longer than
+    it takes to send rx_buffer_size characters.
+    """
+
+    def __init__(self, fd, rx_buffer_size=DEFAULT_RX_BUFFER_SIZE, timeout=DEFAULT_TIMEOUT,
+                 settle_seconds=DEFAULT_SETTLE_SECONDS, log=None):
+        self.fd = fd
+        self.rx_buffer_size = rx_buffer_size
+        self.timeout = timeout
+        self.settle_seconds = settle_seconds
+        # Called with every line the controller sends that isn't an acknowledgement, if given
+        self.log = log
+
+        self.stats = StreamStats()
+        self.next_line_number = 0
+
+        # Lines sent and not yet acknowledged, oldest first, as [line number, data, time sent]
+        self._unacknowledged = collections.deque()
+        self._bytes_in_flight = 0
+        # Lines to send again before any new ones, as (line number, data)
+        self._resend = collections.deque()
+        # The latest acknowledged lines, as (line number, data)
+        self._history = collections.deque(maxlen=HISTORY_LINES)
+        self._write_buffer = ""
+        self._read_buffer = ""
+        # Each resend request is followed by an ok that isn't for any line
+        self._oks_to_ignore = 0
+        # The line the controller asked for, until it is resent, and when it can be
+        self._resend_from = None
+        self._settled_time = None
+
+    def stream(self, commands):
+        """
+        Send each of the commands, and wait until the controller has acknowledged them all. Returns the StreamStats.
+        """
+        start_time = time.time()
+        commands = iter(commands)
+
+        # Line numbers start again from here
+        self.next_line_number = 0
+        pending = self._number("M110 N0")
+        last_heard = time.time()
+
+        while True:
+            if self._resend_from is not None and time.time() >= self._settled_time:
+                self._rewind()
+
+            # Send as much as fits in what is left of the controller's buffer. Resent lines go first
+            while self._resend_from is None:
+                if self._resend:
+                    line_number, data = self._resend[0]
+                elif pending is None:
+                    command = next(commands, None)
+                    if command is None:
+                        break
+                    pending = self._number(command)
+                    continue
+                else:
+                    line_number, data = pending
+
+                # A line longer than the buffer can only be sent once the buffer is empty
+                if self._bytes_in_flight and self._bytes_in_flight + len(data) > self.rx_buffer_size:
+                    break
+
+                if self._resend:
+                    self._resend.popleft()
+                else:
+                    pending = None
+                self._send(line_number, data)
+
+            if (not self._unacknowledged and pending is None and not self._resend and not self._write_buffer and
+                    self._resend_from is None):
+                break
+
+            wait = 0.5
+            if self._resend_from is not None:
+                wait = max(min(wait, self._settled_time - time.time()), 0)
+
+            writers = [self.fd] if self._write_buffer else []
+            readable, writable, _ = select.select([self.fd], writers, [], wait)
+
+            if writable:
+                self._write()
+
+            if readable:
+                if self._read():
+                    last_heard = time.time()
+            elif time.time() - last_heard > self.timeout and self._resend_from is None:
+                raise StreamError("The controller hasn't responded for {:.0f}s".format(self.timeout))
+
+        self.stats.seconds = time.time() - start_time
+        return self.stats
+
+    def _number(self, command):
+        line_number = self.next_line_number
+        self.next_line_number += 1
+        return line_number, numbered_line(line_number, command)
+
+    def _send(self, line_number, data):
+        self._unacknowledged.append([line_number, data, time.time()])
+        self._bytes_in_flight += len(data)
+        self._write_buffer += data
+        self._write()
+
+        self.stats.lines_sent += 1
+        self.stats.bytes_sent += len(data)
+        self.stats.max_bytes_in_flight = max(self.stats.max_bytes_in_flight, self._bytes_in_flight)
+
+    def _write(self):
+        try:
+            written = os.write(self.fd, self._write_buffer)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self._write_buffer = self._write_buffer[written:]
+
+    def _read(self):
+        # Handle every complete line the controller has sent. Returns whether anything was read
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+
+        if not data:
+            raise StreamError("The controller closed the connection")
+
+        self._read_buffer += data
+        while "\n" in self._read_buffer:
+            response, self._read_buffer = self._read_buffer.split("\n", 1)
+            self._handle(response.strip())
+
+        return True
+
+    def _handle(self, response):
+        if self._resend_from is not None:
+            # The controller isn't quiet yet
+            self._settled_time = time.time() + self.settle_seconds
+
+        if response.startswith("ok"):
+            self._acknowledge()
+            return
+
+        resend = RESEND_REGEX.match(response)
+        if resend:
+            self._request_resend(int(resend.group(1)))
+        elif response.startswith("Error") or response.startswith("!!"):
+            self.stats.errors += 1
+            if response.startswith("!!"):
+                raise StreamError("The controller stopped: {}".format(response))
+
+        if self.log is not None and response:
+            self.log(response)
+
+    def _acknowledge(self):
+        if self._oks_to_ignore:
+            self._oks_to_ignore -= 1
+            return
+
+        if not self._unacknowledged:
+            # Such as the controller saying it's ready after starting up
+            return
+
+        line_number, data, sent_time = self._unacknowledged.popleft()
+        self._bytes_in_flight -= len(data)
+        self._history.append((line_number, data))
+
+        self.stats.lines_acknowledged += 1
+        self.stats.latencies.append(time.time() - sent_time)
+
+    def _request_resend(self, line_number):
+        self._oks_to_ignore += 1
+
+        # Until the controller is quiet, every line it rejects asks for the same one again
+        if self._resend_from is None:
+            self.stats.resends += 1
+        self._resend_from = line_number
+        self._settled_time = time.time() + self.settle_seconds
+
+    def _rewind(self):
+        # Go back to the line the controller asked for. It has thrown away everything after it. A line that was
+        # damaged so badly that it didn't look like a numbered line might have been acknowledged already
+        lines = [(number, data) for number, data in self._history if number >= self._resend_from]
+        lines.extend((number, data) for number, data, _ in self._unacknowledged if number >= self._resend_from)
+        lines.extend(self._resend)
+        if not lines or lines[0][0] != self._resend_from:
+            raise StreamError("The controller asked for line {}, which can't be sent again".format(self._resend_from))
+
+        self._unacknowledged.clear()
+        self._bytes_in_flight = 0
+        self._resend = collections.deque(lines)
+        self._resend_from = None
+
+
+def stream_commands(commands, port, baud_rate=DEFAULT_BAUD_RATE, **streamer_options):
+    """
+    Stream the commands to the controller on the given port, with the options of MarlinStreamer. Returns the
+    StreamStats.
+    """
+    # Long enough to send the whole receive buffer a few times over, at ten bits a character
+    rx_buffer_size = streamer_options.get("rx_buffer_size", DEFAULT_RX_BUFFER_SIZE)
+    streamer_options.setdefault("settle_seconds", max(DEFAULT_SETTLE_SECONDS, 3 * rx_buffer_size * 10.0 / baud_rate))
+
+    fd = open_port(port, baud_rate)
+    try:
+        streamer = MarlinStreamer(fd, **streamer_options)
+        return streamer.stream(commands)
+    finally:
+        os.close(fd)
+
+
+def stream_file(gcode_file, machine, port, baud_rate=DEFAULT_BAUD_RATE, **streamer_options):
+    """
+    Output the file for the machine and stream it to the controller on the given port. Returns the StreamStats.
+    """
+    return stream_commands(program_commands(gcode_file.output_lines(machine)), port, baud_rate, **streamer_options)
@@ -0,0 +1,42 @@
+# Script to reorder the lased parts of a G-Code file, to cut down the travel between them
+
+__author__ = 'Richard'
+
+import sys
+import argparse
+import time
+
+from gcode.parser import read_file
+from gcode.travel import optimise_travel, DEFAULT_ISLAND_GAP, DEFAULT_IMPROVE_SECONDS
+from machines import machine
+
+# Setup command line parameters
+parser = argparse.ArgumentParser(description='Reorder the lased parts of a G-Code file, and the direction each is run '
+                                             'in, to cut down the travel between them. Requires numpy.')
+parser.add_argument('gcode_file', type=str, help='The G-Code file to reorder')
+parser.add_argument('output_file', type=str, nargs='?', default=None,
+                    help='The file to save the reordered program to. Defaults to stdout')
+parser.add_argument('--island-gap', type=float, dest='island_gap', default=DEFAULT_ISLAND_GAP,
+                    help='Parts closer than this (in mm) are kept together, in the order they were in')
+parser.add_argument('--improve-seconds', type=float, dest='improve_seconds', default=DEFAULT_IMPROVE_SECONDS,
+                    help='The longest to spend improving the first order found')
+
+args = parser.parse_args()
+
+start_time = time.time()
+gcode_file = read_file(args.gcode_file)
+lines_read = len(gcode_file.lines)
+read_time = time.time()
+
+print >> sys.stderr, optimise_travel(gcode_file, args.island_gap, args.improve_seconds)
+optimise_time = time.time()
+
+if args.output_file is not None:
+    with open(args.output_file, "w+") as output:
+        gcode_file.write_to(output, machine.BaseMachine())
+else:
+    gcode_file.write_to(sys.stdout, machine.BaseMachine())
+
+print >> sys.stderr, "Reading {} lines took: {:.3f}s".format(lines_read, read_time - start_time)
+print >> sys.stderr, "Reordering took: {:.3f}s".format(optimise_time - read_time)
+print >> sys.stderr, "Writing took: {:.3f}s".format(time.time() - optimise_time)
@@ -0,0 +1,253 @@
+__author__ = 'Richard'
+
+# Converts many images in one run, a pool of processes converting several at once, so that starting Python and
+# loading the modules is only paid for once rather than for every image. Each job has the same options as
+# bitmap-to-laser.py, by the names --json-config uses, and writes its program to its own file. A job that fails is
+# reported in the summary without stopping the others.
+
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from PIL import Image
+
+from machines import machine
+from raster.bitmap import bitmap_to_laser
+from raster.cache import RasterCache, DEFAULT_MAX_BYTES
+from raster.stream import stream_bitmap_to_laser, DEFAULT_STRIP_ROWS
+
+OUTPUT_EXTENSION = ".gcode"
+
+# The options of a job that are paths, which a manifest can give relative to where it is
+PATH_OPTIONS = ["source_image", "output_file", "cache_dir", "chunk_dir"]
+
+
+class JobResult(object):
+    """
+    How a job went. index is where the job was in the batch, and seconds how long it took. If it failed, error
+    says why, and traceback where.
+    """
+
+    def __init__(self, index, source_image, output_file):
+        self.index = index
+        self.source_image = source_image
+        self.output_file = output_file
+        self.seconds = 0.0
+        self.bounding_box = None
+        self.lines = None
+        self.error = None
+        self.traceback = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            "source_image": self.source_image,
+            "output_file": self.output_file,
+            "seconds": self.seconds,
+            "bounding_box": self.bounding_box,
+            "lines": self.lines,
+            "error": self.error,
+            "traceback": self.traceback
+        }
+
+
+def find_images(directory):
+    """
+    The paths of the images in a directory that PIL can open, in name order.
+    """
+    Image.init()
+    extensions = set(extension for extension, image_format in Image.registered_extensions().items()
+                     if image_format in Image.OPEN)
+
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if os.path.splitext(name)[1].lower() in extensions and os.path.isfile(os.path.join(directory, name))]
+
+
+def load_manifest(path):
+    """
+    Read the jobs from a JSON manifest. This is either a list of jobs, or an object with the list as "jobs" and the
+    options shared by every job as "defaults". Paths in the manifest are relative to the manifest itself. Returns a
+    list with the options of each job.
+    """
+    with open(path, "r") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("jobs"), list):
+        raise ValueError("A manifest is a list of jobs, or an object with a list of jobs")
+
+    base_directory = os.path.dirname(os.path.abspath(path))
+
+    jobs = []
+    for job in manifest["jobs"]:
+        options = dict(manifest.get("defaults", {}))
+        options.update(job)
+
+        for option in PATH_OPTIONS:
+            if options.get(option) is not None:
+                options[option] = os.path.join(base_directory, os.path.expanduser(options[option]))
+
+        jobs.append(options)
+
+    return jobs
+
+
+def plan_jobs(jobs, output_directory=None, defaults=None):
+    """
+    Give each job the default options it doesn't set itself, and the file its program is written to. Jobs without
+    an output_file of their own are written to output_directory, named after their image, or fail if there isn't
+    one. Returns the list of jobs.
+    """
+    planned_jobs = []
+    names = set()
+    for job in jobs:
+        options = dict(defaults or {})
+        options.update(job)
+
+        if (options.get("output_file") is None and options.get("source_image") is not None and
+                output_directory is not None):
+            # Images with the same name in different formats keep their extensions apart
+            name = os.path.splitext(os.path.basename(options["source_image"]))[0] + OUTPUT_EXTENSION
+            if name in names:
+                name = os.path.basename(options["source_image"]) + OUTPUT_EXTENSION
+            names.add(name)
+
+            options["output_file"] = os.path.join(output_directory, name)
+
+        planned_jobs.append(options)
+
+    return planned_jobs
+
+
+def run_batch(jobs, workers=1):
+    """
+    Convert each of the jobs, with up to workers of them at once. Generates a JobResult for each job as it finishes,
+    which isn't necessarily in the order of the jobs.
+    """
+    # Two jobs writing to the same file would leave it holding either of their programs, so only the first gets to
+    output_files = set()
+    indexed_jobs = []
+    for index, options in enumerate(jobs):
+        output_file = options.get("output_file")
+        duplicate = output_file is not None and os.path.abspath(output_file) in output_files
+        if output_file is not None:
+            output_files.add(os.path.abspath(output_file))
+
+        indexed_jobs.append((index, options, duplicate))
+
+    if workers <= 1:
+        for job in indexed_jobs:
+            yield _run_job(job)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(_run_job, indexed_jobs):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def batch_summary(results, seconds):
+    """
+    A summary of the batch that can be saved as JSON, with the result of each job in the order of the jobs.
+    """
+    results = sorted(results, key=lambda result: result.index)
+
+    return {
+        "seconds": seconds,
+        "jobs": len(results),
+        "succeeded": sum(1 for result in results if result.succeeded),
+        "failed": sum(1 for result in results if not result.succeeded),
+        "results": [result.as_dict() for result in results]
+    }
+
+
+def convert_job(options):
+    """
+    Convert one image with the options of bitmap-to-laser.py, and write the program to its output_file. Returns the
+    bounding box of the program, and how many lines it has, which isn't known for streamed jobs.
+    """
+    options = dict(options)
+    output_file = options.pop("output_file", None)
+    source_path = options.pop("source_image", None)
+
+    if source_path is None:
+        raise ValueError("No source image")
+    if output_file is None:
+        raise ValueError("No output file")
+    if options.get("workers", 1) > 1:
+        raise ValueError("Each job in a batch is converted by a single process")
+
+    # These are for the output of the program rather than generating it
+    machine_instance = machine.BaseMachine()
+    machine_instance.set_output_property("compress_modal_state", options.pop("compress_modal_state", False))
+    machine_instance.set_output_property("tool_power_tolerance", options.pop("tool_power_tolerance", 0))
+
+    stream = options.pop("stream", False)
+    strip_rows = options.pop("strip_rows", DEFAULT_STRIP_ROWS)
+    cache_dir = options.pop("cache_dir", None)
+    cache_size = options.pop("cache_size", DEFAULT_MAX_BYTES / (1024 * 1024))
+    optimise_travel = options.pop("optimise_travel", False)
+    chunk_dir = options.pop("chunk_dir", None)
+    chunk_lines = options.pop("chunk_lines", None)
+    chunk_size = options.pop("chunk_size", 4)
+    chunk_compression = options.pop("chunk_compression", None)
+
+    if stream:
+        if optimise_travel:
+            raise ValueError("Streamed jobs can't have their travel optimised")
+        if chunk_dir is not None:
+            raise ValueError("Streamed jobs can't be written in chunks")
+        options.pop("workers", None)
+        with open(output_file, "w+") as output:
+            bounding_box = stream_bitmap_to_laser(source_path, output, machine_instance, strip_rows, **options)
+        return bounding_box, None
+
+    options["source_image"] = Image.open(source_path).convert('LA')
+    if cache_dir is not None:
+        options["cache"] = RasterCache(cache_dir, int(cache_size * 1024 * 1024))
+
+    gcode_file = bitmap_to_laser(**options)
+    if optimise_travel:
+        gcode_file.optimise_travel()
+
+    if chunk_dir is not None:
+        # The chunks are named after the output file, so that the jobs can share a directory
+        gcode_file.write_chunks(chunk_dir, machine_instance, os.path.splitext(os.path.basename(output_file))[0],
+                                chunk_lines, int(chunk_size * 1024 * 1024), chunk_compression)
+    else:
+        with open(output_file, "w+") as output:
+            gcode_file.write_to(output, machine_instance)
+
+    return gcode_file.bounding_box, len(gcode_file.lines)
+
+
+def _run_job(job):
+    # Convert a job, in whichever process it was given to, catching anything that goes wrong with it
+    index, options, duplicate = job
+    result = JobResult(index, options.get("source_image"), options.get("output_file"))
+    start_time = time.time()
+
+    try:
+        if duplicate:
+            raise ValueError("Another job already writes to {}".format(result.output_file))
+
+        result.bounding_box, result.lines = convert_job(options)
+    except Exception as error:
+        result.error = "{}: {}".format(type(error).__name__, error)
+        result.traceback = traceback.format_exc()
+
+    result.seconds = time.time() - start_time
+    return result
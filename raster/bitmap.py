@@ -0,0 +1,504 @@
+from __future__ import division
+
+__author__ = 'Richard'
+
+import math
+
+from gcode import stages
+from gcode.file import File as GCodeFile
+from gcode.line import (SetUnits, SetMovementMode, BlankLine, MoveRapid, MoveFeed, SetToolState,
+                        Units, MovementMode, ToolState)
+
+
+def scale(val, src_range, dest_range):
+    """
+    Scale the given value from the scale of src to the scale of dst.
+    """
+    return (float(val - src_range[0]) / (src_range[1]-src_range[0])) * (dest_range[1]-dest_range[0]) + dest_range[0]
+
+
+def bitmap_to_laser(source_image=None, mm_per_pass=0.1, feedrate_lase=1000, feedrate_rapid=None, invert=False,
+                    dimension_width=None, dimension_height=None, rapid_min_distance=20,
+                    laser_power_min=0, laser_power_max=255,
+                    colour_mode_bw=False, bw_threshold=125,
+                    offset_x=0, offset_y=0, offset_z=0,
+                    engine=None, workers=1, trim_passes=False, overscan=0, cache=None,
+                    power_levels=None, min_run_length=1, power_hysteresis=0, dither=None):
+    # cache is a RasterCache to reuse the lines from an earlier conversion of the same image with the same settings.
+    # power_levels, min_run_length and power_hysteresis merge runs of similar power, as for merge_runs. dither is a
+    # DitherMode for black and white mode, which needs numpy
+
+    if engine is None:
+        engine = RasterEngine.PYTHON
+
+    num_pixels_wide = source_image.size[0]
+    num_pixels_high = source_image.size[1]
+
+    raster_settings = get_raster_settings(num_pixels_wide, num_pixels_high, mm_per_pass, feedrate_lase,
+                                          feedrate_rapid, invert, dimension_width, dimension_height,
+                                          rapid_min_distance, laser_power_min, laser_power_max, colour_mode_bw,
+                                          bw_threshold, engine, trim_passes, overscan, power_levels, min_run_length,
+                                          power_hysteresis, dither)
+
+    gcode_file = None
+    if cache is not None:
+        with stages.stage("load_cache") as stage:
+            # The key is for the image as it was given, so a hit doesn't have to dither it first
+            cache_settings = raster_settings
+            if dither is not None:
+                cache_settings = dict(raster_settings, dither=dither)
+
+            cache_key = cache.key(source_image, cache_settings)
+            cached_lines = cache.load(cache_key)
+
+            if cached_lines is not None:
+                gcode_file = GCodeFile()
+                gcode_file.lines = cached_lines
+                gcode_file.bounding_box = cached_lines.bounding_box()
+                stage.lines = len(cached_lines)
+
+            stage.pixels = num_pixels_wide * num_pixels_high
+
+    if gcode_file is None:
+        if dither is not None:
+            # Imported here so that numpy is only required when dithering
+            from raster.dither import Ditherer
+
+            with stages.stage("dither") as stage:
+                source_image = Ditherer(dither, invert).dither_strip(source_image, 0)
+                stage.pixels = num_pixels_wide * num_pixels_high
+
+        gcode_file = start_gcode_file(raster_settings["feedrate_rapid"])
+
+        with stages.stage("generate") as stage:
+            if workers > 1:
+                from raster.parallel import raster_rows_parallel
+                raster_rows_parallel(gcode_file, source_image, engine, workers, raster_settings)
+            else:
+                get_raster_rows_function(engine)(gcode_file, source_image, **raster_settings)
+
+            stage.pixels = num_pixels_wide * num_pixels_high
+            stage.lines = len(gcode_file.lines)
+
+        if cache is not None:
+            with stages.stage("save_cache") as stage:
+                cache.store(cache_key, gcode_file.lines)
+                stage.lines = len(gcode_file.lines)
+
+    # Shift the file to the requested position. This is only applied as the file is output
+    gcode_file.translate(offset_x, offset_y, offset_z)
+
+    return gcode_file
+
+
+def get_raster_settings(num_pixels_wide, num_pixels_high, mm_per_pass, feedrate_lase, feedrate_rapid, invert,
+                        dimension_width, dimension_height, rapid_min_distance, laser_power_min, laser_power_max,
+                        colour_mode_bw, bw_threshold, engine, trim_passes, overscan, power_levels=None,
+                        min_run_length=1, power_hysteresis=0, dither=None):
+    # Check the options for an image of the given size, and work out the settings the raster engines take from them.
+    # Dithering is done to the image before the raster engines see it, so it isn't one of their settings
+
+    if feedrate_rapid is None:
+        feedrate_rapid = feedrate_lase
+
+    if engine not in RasterEngine.ALL:
+        raise ValueError("Unknown raster engine: {}".format(engine))
+
+    if power_levels is not None and power_levels < 2:
+        raise ValueError("At least two power levels are needed")
+
+    if min_run_length < 1:
+        raise ValueError("Runs have to be at least one pixel long")
+
+    if power_hysteresis < 0:
+        raise ValueError("Power hysteresis can't be negative")
+
+    if dither is not None:
+        if dither not in DitherMode.ALL:
+            raise ValueError("Unknown dither mode: {}".format(dither))
+        if not colour_mode_bw:
+            raise ValueError("Dithering is only used in black and white mode")
+
+        # Dithered pixels are either black or white, so any threshold in between splits them
+        bw_threshold = DITHERED_BW_THRESHOLD
+
+    # Check that only one dimension was provided
+    if dimension_width is not None and dimension_height is not None:
+        raise ValueError("Please only provide one dimension")
+
+    if dimension_width:
+        mm_per_pixel = dimension_width / num_pixels_wide
+    elif dimension_height:
+        mm_per_pixel = dimension_height / num_pixels_high
+    else:
+        # Default resolution
+        mm_per_pixel = 0.1
+
+
+    # Calculate how many passes you'd need given the distance between passes and the size of the pixel
+    # Be sure to round up and convert to an integer
+    passes_per_pixel = int(math.ceil(mm_per_pixel / mm_per_pass))
+
+    return {
+        "mm_per_pixel": mm_per_pixel,
+        "passes_per_pixel": passes_per_pixel,
+        "feedrate_lase": feedrate_lase,
+        "feedrate_rapid": feedrate_rapid,
+        "invert": invert,
+        "rapid_min_distance": rapid_min_distance,
+        "laser_power_min": laser_power_min,
+        "laser_power_max": laser_power_max,
+        "colour_mode_bw": colour_mode_bw,
+        "bw_threshold": bw_threshold,
+        "trim_passes": trim_passes,
+        "overscan": overscan,
+        "power_levels": power_levels,
+        "min_run_length": min_run_length,
+        "power_hysteresis": power_hysteresis
+    }
+
+
+def start_gcode_file(feedrate_rapid):
+    # A new file with the lines that start every program, before any of the rows
+    gcode_file = GCodeFile()
+    gcode_file.add_line(SetMovementMode(MovementMode.ABSOLUTE, "Set movement to absolute"))
+    gcode_file.add_line(SetUnits(Units.MM, "Set units to mm"))
+    gcode_file.add_line(MoveRapid(0, 0, 0, feedrate_rapid, "Move to the origin"))
+    gcode_file.add_line(SetToolState(ToolState.OFF))
+    gcode_file.add_line(BlankLine())
+
+    return gcode_file
+
+
+def get_raster_rows_function(engine):
+    if engine == RasterEngine.NUMPY:
+        # Imported here so that numpy is only required when the vectorized engine is used
+        from raster.vectorized import raster_rows
+        return raster_rows
+    else:
+        return _raster_rows
+
+
+def get_row_extents_function(engine):
+    # The function that finds the first and last lased column of each row, for planning trimmed passes
+    if engine == RasterEngine.NUMPY:
+        from raster.vectorized import row_extents
+        return row_extents
+    else:
+        return _row_extents
+
+
+def direction_before_pass(pass_index):
+    # The direction of the pass before the given one. Passes alternate, and the first one goes left to right
+    if pass_index % 2 == 1:
+        return PassDirection.LEFT_TO_RIGHT
+    else:
+        return PassDirection.RIGHT_TO_LEFT
+
+
+def lased_edges(mm_per_pixel, first_col, last_col):
+    # The left and right hand edges of the lased part of a row, from its first and last lased columns
+    return mm_per_pixel * first_col, mm_per_pixel * last_col + mm_per_pixel
+
+
+def plan_trimmed_pass(pass_direction, head_x, left_x, right_x, overscan):
+    """
+    Plan a pass that only covers the lased part of a row, from left_x to right_x, plus the overscan at each end.
+    It starts from whichever end is nearer to where the head is. If both are as near, passes alternate.
+    Returns the new pass direction, the position the pass starts from (where the head gets up to speed), the
+    positions the lasing starts and ends at and the position the pass finishes at.
+    """
+    left_distance = abs(head_x - (left_x - overscan))
+    right_distance = abs(head_x - (right_x + overscan))
+
+    if left_distance < right_distance or (left_distance == right_distance and
+                                          pass_direction == PassDirection.RIGHT_TO_LEFT):
+        return PassDirection.LEFT_TO_RIGHT, left_x - overscan, left_x, right_x, right_x + overscan
+    else:
+        return PassDirection.RIGHT_TO_LEFT, right_x + overscan, right_x, left_x, left_x - overscan
+
+
+def quantize_power(laser_state, power_levels, laser_power_min, laser_power_max):
+    """
+    Round the laser state to the nearest of power_levels powers, spread evenly from laser_power_min to
+    laser_power_max.
+    """
+    if laser_power_max == laser_power_min:
+        return laser_state
+
+    step = (laser_power_max - laser_power_min) / (power_levels - 1)
+    level = min(max(int(round((laser_state - laser_power_min) / step)), 0), power_levels - 1)
+
+    return int(round(laser_power_min + level * step))
+
+
+def merge_runs(starts, ends, states, laser_power_min, min_run_length=1, power_hysteresis=0):
+    """
+    Merge the runs of a row, given left to right as lists of their first columns, the columns after their ends and
+    their laser states, so that the row needs fewer changes of power. A run whose power is within power_hysteresis of
+    the run it follows takes on its power, as long as both are lased. A run shorter than min_run_length pixels is
+    merged into the run before it, or the run after it if it is the first. Returns the new (starts, ends, states).
+    """
+    merged_starts = []
+    merged_ends = []
+    merged_states = []
+
+    for start, end, laser_state in zip(starts, ends, states):
+        if merged_states:
+            previous_state = merged_states[-1]
+            similar = (laser_state != laser_power_min and previous_state != laser_power_min and
+                       abs(laser_state - previous_state) <= power_hysteresis)
+
+            if laser_state == previous_state or similar or end - start < min_run_length:
+                merged_ends[-1] = end
+                continue
+
+        merged_starts.append(start)
+        merged_ends.append(end)
+        merged_states.append(laser_state)
+
+    if len(merged_states) > 1 and merged_ends[0] - merged_starts[0] < min_run_length:
+        merged_starts[1] = merged_starts[0]
+        del merged_starts[0], merged_ends[0], merged_states[0]
+
+    return merged_starts, merged_ends, merged_states
+
+
+def merge_row_states(row_states, laser_power_min, min_run_length, power_hysteresis):
+    # The laser state of each pixel in a row, with its runs merged by merge_runs
+    starts = [col for col in range(len(row_states)) if col == 0 or row_states[col] != row_states[col - 1]]
+    ends = starts[1:] + [len(row_states)]
+    states = [row_states[col] for col in starts]
+
+    merged_row_states = []
+    for start, end, laser_state in zip(*merge_runs(starts, ends, states, laser_power_min, min_run_length,
+                                                   power_hysteresis)):
+        merged_row_states.extend([laser_state] * (end - start))
+
+    return merged_row_states
+
+
+def runs_merged(min_run_length, power_hysteresis):
+    # Whether the settings merge any runs
+    return min_run_length > 1 or power_hysteresis > 0
+
+
+def _row_laser_states(pixels, row, num_pixels_wide, invert, colour_mode_bw, bw_threshold, laser_power_min,
+                      laser_power_max, power_levels=None, min_run_length=1, power_hysteresis=0):
+    # The laser state for each pixel in a row of the image
+    row_states = []
+
+    for col in range(num_pixels_wide):
+        laser_state = pixels[col, row][0]
+
+        if not invert:
+            laser_state = LaserState.ON - laser_state
+
+        # Check whether we're doing black and white only mode
+        if colour_mode_bw:
+            if laser_state >= bw_threshold:
+                laser_state = laser_power_max
+            else:
+                laser_state = laser_power_min
+
+        laser_state = int(scale(laser_state, [0, 255], [laser_power_min, laser_power_max]))
+        if power_levels is not None:
+            laser_state = quantize_power(laser_state, power_levels, laser_power_min, laser_power_max)
+
+        row_states.append(laser_state)
+
+    if runs_merged(min_run_length, power_hysteresis):
+        row_states = merge_row_states(row_states, laser_power_min, min_run_length, power_hysteresis)
+
+    return row_states
+
+
+def _lased_extent(row_states, laser_power_min):
+    # The first and last columns of a row that are lased, or None if none of them are
+    lased_columns = [col for col, laser_state in enumerate(row_states) if laser_state != laser_power_min]
+
+    if not lased_columns:
+        return None
+
+    return lased_columns[0], lased_columns[-1]
+
+
+def _row_extents(source_image, row_range, invert, colour_mode_bw, bw_threshold, laser_power_min, laser_power_max,
+                 power_levels=None, min_run_length=1, power_hysteresis=0):
+    # The lased extent of each row in row_range, as from _lased_extent
+    pixels = source_image.load()
+    num_pixels_wide = source_image.size[0]
+
+    return [_lased_extent(_row_laser_states(pixels, row, num_pixels_wide, invert, colour_mode_bw, bw_threshold,
+                                            laser_power_min, laser_power_max, power_levels, min_run_length,
+                                            power_hysteresis), laser_power_min)
+            for row in range(*row_range)]
+
+
+def _raster_rows(gcode_file, source_image, mm_per_pixel, passes_per_pixel, feedrate_lase, feedrate_rapid, invert,
+                 rapid_min_distance, laser_power_min, laser_power_max, colour_mode_bw, bw_threshold,
+                 trim_passes=False, overscan=0, power_levels=None, min_run_length=1, power_hysteresis=0,
+                 row_range=None, pass_direction=None, head_x=None, image_height=None):
+    # row_range limits the output to the image rows from start up to (but not including) end. pass_direction is
+    # the direction of the pass before the first one, as it is switched before each pass. head_x is where the head
+    # is before the first pass, which trimmed passes start from the nearer end to. If image_height is given,
+    # source_image is only a strip of an image that high, holding just the rows in row_range.
+    # Returns the direction of the last pass and where the head was left, to carry on from
+
+    pixels = source_image.load()
+    num_pixels_wide = source_image.size[0]
+    num_pixels_high = source_image.size[1]
+
+    output_width_mm = num_pixels_wide * mm_per_pixel
+
+    if row_range is None:
+        row_range = (0, num_pixels_high)
+
+    # The row of source_image that the first row of the image is in
+    first_image_row = 0
+    if image_height is not None:
+        first_image_row = -row_range[0]
+        num_pixels_high = image_height
+
+    if pass_direction is None:
+        pass_direction = PassDirection.RIGHT_TO_LEFT
+
+    if head_x is None:
+        head_x = 0
+
+    # Image rows go from top left, we want to go from bottom left
+    rows = range(*row_range)
+    columns = range(num_pixels_wide)
+    rows.reverse()
+    # Columns are reversed before each pass, so start them in the opposite order to the first pass
+    if pass_direction == PassDirection.RIGHT_TO_LEFT:
+        columns.reverse()
+
+    # Iterate over each row
+    for row in rows:
+        row_states = _row_laser_states(pixels, row + first_image_row, num_pixels_wide, invert, colour_mode_bw,
+                                       bw_threshold, laser_power_min, laser_power_max, power_levels, min_run_length,
+                                       power_hysteresis)
+
+        if trim_passes:
+            # Rows with nothing to lase are skipped completely, and the others only cover their lased part
+            lased_extent = _lased_extent(row_states, laser_power_min)
+            if lased_extent is None:
+                continue
+
+            first_col, last_col = lased_extent
+            left_x, right_x = lased_edges(mm_per_pixel, first_col, last_col)
+
+        gcode_file.add_line(BlankLine())
+        gcode_file.add_line(BlankLine())
+
+        row_y_pos = (num_pixels_high - (row + 1)) * mm_per_pixel
+
+        # Generate moves for each pass
+        for laser_pass in range(passes_per_pixel):
+            # Reset the laser state
+            previous_laser_state = LaserState.OFF
+
+            # Set the Y position
+            pass_y_offset = (float(laser_pass) / passes_per_pixel) * mm_per_pixel
+            pass_y_pos = row_y_pos + pass_y_offset
+
+            if trim_passes:
+                pass_direction, pass_start_pos, laser_last_x_pos, pass_end_pos, pass_finish_pos = \
+                    plan_trimmed_pass(pass_direction, head_x, left_x, right_x, overscan)
+
+                pass_columns = range(first_col, last_col + 1)
+                if pass_direction == PassDirection.RIGHT_TO_LEFT:
+                    pass_columns.reverse()
+
+                # Go straight to the start of the pass, leaving room to get up to speed before the first lased pixel
+                gcode_file.add_line(MoveRapid(pass_start_pos, pass_y_pos, None, feedrate_rapid))
+            else:
+                gcode_file.add_line(MoveRapid(None, pass_y_pos, None, feedrate_rapid))
+
+                # Reverse the direction of passes
+                columns.reverse()
+                pass_columns = columns
+                if pass_direction == PassDirection.LEFT_TO_RIGHT:
+                    pass_direction = PassDirection.RIGHT_TO_LEFT
+                    laser_last_x_pos = output_width_mm
+                else:
+                    pass_direction = PassDirection.LEFT_TO_RIGHT
+                    laser_last_x_pos = 0
+
+            laser_state = laser_power_min
+
+            # Iterate over each column
+            for col in pass_columns:
+                # Check if the pixel grayscale has changed - if so, move to the end of the pixel.
+                #                                            if not, move onto the next pixel.
+                laser_state = row_states[col]
+
+                # Generate the physical position of each pixel
+                pixel_start_x_pos = mm_per_pixel * col
+                if pass_direction == PassDirection.RIGHT_TO_LEFT:
+                    pixel_start_x_pos += mm_per_pixel
+
+                if previous_laser_state != laser_state:
+
+                    # If the laser was off and the distance travelled with it off is greater than rapid_min_distance
+                    move_distance = abs(pixel_start_x_pos - laser_last_x_pos)
+                    if previous_laser_state == laser_power_min and move_distance > rapid_min_distance:
+                        gcode_file.add_line(MoveRapid(pixel_start_x_pos, None, None, feedrate_rapid))
+                    else:
+                        gcode_file.add_line(MoveFeed(pixel_start_x_pos, None, None, feedrate_lase))
+
+                    laser_last_x_pos = pixel_start_x_pos
+
+                    # Enable or disable the laser, depending on the pixel colour and whether we're inverting
+                    gcode_file.add_line(SetToolState(laser_state))
+
+                    previous_laser_state = laser_state
+
+            if trim_passes:
+                # The last column is always lased, so the tool is turned off at the end of the pass. Then slow down
+                # over the overscan
+                gcode_file.add_line(MoveFeed(pass_end_pos, None, None, feedrate_lase))
+                gcode_file.add_line(SetToolState(ToolState.OFF))
+                if overscan:
+                    gcode_file.add_line(MoveFeed(pass_finish_pos, None, None, feedrate_lase))
+
+                head_x = pass_finish_pos
+                continue
+
+            if pass_direction == PassDirection.LEFT_TO_RIGHT:
+                pass_end_pos = pixel_start_x_pos + mm_per_pixel
+            else:
+                pass_end_pos = pixel_start_x_pos - mm_per_pixel
+
+            # Turn off the tool at the end of each pass
+            if laser_state != laser_power_min:
+                gcode_file.add_line(MoveFeed(pass_end_pos, None, None, feedrate_lase))
+                gcode_file.add_line(SetToolState(ToolState.OFF))
+
+    return pass_direction, head_x
+
+
+class PassDirection:
+    LEFT_TO_RIGHT, RIGHT_TO_LEFT = range(2)
+
+
+class LaserState:
+    OFF = 0
+    ON = 255
+
+
+class RasterEngine:
+    PYTHON = "python"
+    NUMPY = "numpy"
+    ALL = [PYTHON, NUMPY]
+
+
+class DitherMode:
+    ORDERED = "ordered"
+    ERROR_DIFFUSION = "error-diffusion"
+    ALL = [ORDERED, ERROR_DIFFUSION]
+
+
+# The black and white threshold used for dithered images
+DITHERED_BW_THRESHOLD = 128
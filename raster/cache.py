@@ -0,0 +1,185 @@
+__author__ = 'Richard'
+
+# An on-disk cache of generated raster programs, so that converting the same image with the same settings again only
+# has to read the lines back. Entries are keyed by a hash of the image's pixels and the settings that the lines
+# depend on. Offsets and the machine aren't part of the key, as they are only applied when the program is output.
+
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+
+from gcode.store import LineStore
+
+# Changed whenever the format of the entries or the lines generated for the same settings change
+FORMAT_VERSION = 1
+
+MAGIC = "GCRC"
+ENTRY_EXTENSION = ".gcrc"
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# How many rows of the image are hashed at a time, to avoid a copy of the whole image
+HASH_ROWS = 256
+
+_HEADER = struct.Struct("<4sB")
+_COUNTS = struct.Struct("<II")
+
+# The columns of a LineStore, in the order they are saved
+_COLUMNS = ["opcodes", "x", "y", "z", "feed_rate", "i", "j", "values", "comments"]
+
+
+class RasterCache(object):
+    """
+    A directory of cached programs, holding at most max_bytes of them. Once it is full, the entries used least
+    recently are removed to make room for new ones.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, source_image, raster_settings):
+        # The key for the lines generated from source_image with the given settings for the raster engines
+        key_hash = hashlib.sha1()
+        key_hash.update(json.dumps({"version": FORMAT_VERSION, "mode": source_image.mode,
+                                    "size": source_image.size, "settings": raster_settings}, sort_keys=True))
+
+        num_pixels_wide, num_pixels_high = source_image.size
+        for start in range(0, num_pixels_high, HASH_ROWS):
+            end = min(start + HASH_ROWS, num_pixels_high)
+            key_hash.update(source_image.crop((0, start, num_pixels_wide, end)).tobytes())
+
+        return key_hash.hexdigest()
+
+    def load(self, key):
+        # The LineStore saved under the key, or None if there isn't one. Entries that can't be read are removed
+        path = self._path(key)
+
+        try:
+            with open(path, "rb") as entry_file:
+                data = entry_file.read()
+        except IOError:
+            return None
+
+        try:
+            lines = _decode(data)
+        except (ValueError, struct.error, zlib.error):
+            _remove(path)
+            return None
+
+        # Entries are removed in the order they were last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return lines
+
+    def store(self, key, lines):
+        # Save the lines under the key. Returns whether they were saved, as lines holding arbitrary objects can't be
+        if lines.objects:
+            return False
+
+        data = _encode(lines)
+        if len(data) > self.max_bytes:
+            return False
+
+        # Written to one side and then moved into place, so that no other process ever sees half of an entry
+        file_descriptor, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as entry_file:
+                entry_file.write(data)
+            os.rename(temp_path, self._path(key))
+        except:
+            _remove(temp_path)
+            raise
+
+        self.evict()
+        return True
+
+    def evict(self):
+        # Remove the least recently used entries until the cache is no bigger than max_bytes
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_EXTENSION):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            _remove(path)
+            total_bytes -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+
+def _encode(lines):
+    # The columns are saved little endian, one after another, followed by the comment strings
+    comments = "\0".join(comment.encode("utf-8") if isinstance(comment, unicode) else comment
+                         for comment in lines.comment_strings)
+
+    parts = [_COUNTS.pack(len(lines.opcodes), len(lines.comment_strings))]
+    for name in _COLUMNS:
+        column = getattr(lines, name)
+        if sys.byteorder != "little":
+            column = array(column.typecode, column)
+            column.byteswap()
+        parts.append(column.tostring())
+    parts.append(comments)
+
+    return _HEADER.pack(MAGIC, FORMAT_VERSION) + zlib.compress("".join(parts), 1)
+
+
+def _decode(data):
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("Not a cache entry of this version")
+
+    # zlib checks that what it decompresses is what was compressed
+    data = zlib.decompress(data[_HEADER.size:])
+    count, comment_count = _COUNTS.unpack_from(data)
+    offset = _COUNTS.size
+
+    lines = LineStore()
+    for name in _COLUMNS:
+        column = getattr(lines, name)
+        end = offset + count * column.itemsize
+        if end > len(data):
+            raise ValueError("Cache entry is too short")
+
+        column.fromstring(data[offset:end])
+        if sys.byteorder != "little":
+            column.byteswap()
+        offset = end
+
+    if comment_count:
+        lines.comment_strings = data[offset:].split("\0")
+        if len(lines.comment_strings) != comment_count:
+            raise ValueError("Cache entry is damaged")
+        lines.comment_lookup = dict((comment, index) for index, comment in enumerate(lines.comment_strings))
+
+    return lines
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
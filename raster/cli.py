@@ -0,0 +1,402 @@
+from __future__ import division
+
+__author__ = 'Richard'
+
+# The command line of bitmap-to-laser.py, as functions that can be imported and run again, so that other tools such as
+# the daemon can run conversions without starting a new interpreter each time
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+from gcode import stages
+from raster.bitmap import bitmap_to_laser, RasterEngine, DitherMode
+from raster.stream import stream_bitmap_to_laser, DEFAULT_STRIP_ROWS
+from raster.cache import RasterCache, DEFAULT_MAX_BYTES
+
+from machines import machine, marlin
+
+
+def build_parser():
+    """
+    The parser for the command line options of bitmap-to-laser.py.
+    """
+    # Setup command line parameters
+    parser = argparse.ArgumentParser(prog='bitmap-to-laser.py',
+                                     description='Generate laser engraving G-Code from a bitmap image.')
+    parser.add_argument('--src', type=str, dest='source_image', help='The source image')
+    parser.add_argument('--out', type=str, dest='output_file', help='The output file. Leave blank to write to console')
+    parser.add_argument('--feedrate-lase', type=int, dest='feedrate_lase', default=1000,
+                        help='Feedrate when lasing')
+    parser.add_argument('--feedrate-rapid', type=int, dest='feedrate_rapid', default=2000,
+                        help='Feedrate when moving between lased areas')
+    parser.add_argument('--rapid-min-distance', type=int, dest='rapid_min_distance', default=0,
+                        help='Minimum distance moved that will generate a rapid. Otherwise a normal speed move is '
+                             'used.')
+    parser.add_argument('--dimension-width', type=int, dest='dimension_width', default=None,
+                        help='The desired output width in mm. Output will have same aspect ratio as input image')
+    parser.add_argument('--dimension-height', type=int, dest='dimension_height', default=None,
+                        help='The desired output height in mm. Output will have same aspect ratio as input image')
+    parser.add_argument('--mm-per-pass', type=int, dest='mm_per_pass', default=0.1,
+                        help='The distance between each pass (in mm)')
+    parser.add_argument('--invert', dest='invert', default=False, action="store_true",
+                        help='The output file. Leave blank to write to console')
+    parser.add_argument('--laser-power-min', type=int, dest='laser_power_min', default=100,
+                        help='Minimum laser power')
+    parser.add_argument('--laser-power-max', type=int, dest='laser_power_max', default=255,
+                        help='Maximum laser power')
+    parser.add_argument('--colour-mode-bw', dest='colour_mode_bw', default=False, action="store_true",
+                        help='Use Black or white mode, rather than grayscale')
+    parser.add_argument('--colour-mode-bw-threshold', type=int, dest='bw_threshold', default=125,
+                        help='Grayscale threshold for black or white lasing')
+    parser.add_argument('--offset-x', type=float, dest='offset_x', default=0,
+                        help='How far from the origin should the lasing start (x distance)')
+    parser.add_argument('--offset-y', type=float, dest='offset_y', default=0,
+                        help='How far from the origin should the lasing start (y distance)')
+    parser.add_argument('--offset-z', type=float, dest='offset_z', default=0,
+                        help='How far from the origin should the lasing start (z distance)')
+    parser.add_argument('--engine', type=str, dest='engine', default=RasterEngine.PYTHON, choices=RasterEngine.ALL,
+                        help='The raster engine used to generate the moves. numpy is much faster on large images')
+    parser.add_argument('--workers', type=int, dest='workers', default=1,
+                        help='Number of processes used to generate the moves')
+    parser.add_argument('--trim-passes', dest='trim_passes', default=False, action="store_true",
+                        help='Skip rows with nothing to lase, and only cover the lased part of the others')
+    parser.add_argument('--overscan', type=float, dest='overscan', default=0,
+                        help='With --trim-passes, the distance (in mm) to get up to speed before and slow down after '
+                             'each pass')
+    parser.add_argument('--power-levels', type=int, dest='power_levels', default=None,
+                        help='Round the laser power to this many levels between the minimum and maximum, so that '
+                             'neighbouring pixels of similar grey share a move')
+    parser.add_argument('--min-run-length', type=int, dest='min_run_length', default=1,
+                        help='Merge runs of the same power shorter than this many pixels into the run before them')
+    parser.add_argument('--power-hysteresis', type=int, dest='power_hysteresis', default=0,
+                        help='Keep the laser power the same until a pixel needs a change of more than this')
+    parser.add_argument('--dither', type=str, dest='dither', default=None, choices=DitherMode.ALL,
+                        help='With --colour-mode-bw, dither the image rather than using the threshold, to keep its '
+                             'shading. Requires numpy')
+    parser.add_argument('--command-density', dest='command_density', default=False, action="store_true",
+                        help='Report how many commands there are for each mm lased, before and after the power levels, '
+                             'run merging and dithering. The image is converted twice to do this. Requires numpy')
+    parser.add_argument('--verify', dest='verify', default=False, action="store_true",
+                        help='Draw what the program burns and check it against the image, pixel by pixel. Exits with '
+                             'status 1 if any pixel is lased at the wrong power. Requires numpy')
+    parser.add_argument('--preview', type=str, dest='preview', default=None,
+                        help='Save a picture of what the program burns to this file, at the resolution of the image. '
+                             'Requires numpy')
+    parser.add_argument('--compress-modal-state', dest='compress_modal_state', default=False, action="store_true",
+                        help='Leave out words and lines that repeat what the machine already has set')
+    parser.add_argument('--tool-power-tolerance', type=float, dest='tool_power_tolerance', default=0,
+                        help='With --compress-modal-state, leave out changes in laser power no bigger than this')
+    parser.add_argument('--stream', dest='stream', default=False, action="store_true",
+                        help='Read, convert and write the image a strip of rows at a time, so that very large images '
+                             'fit in memory. Best with uncompressed images such as PGM or BMP, which are read a strip '
+                             'at a time too')
+    parser.add_argument('--strip-rows', type=int, dest='strip_rows', default=DEFAULT_STRIP_ROWS,
+                        help='With --stream, how many rows of the image are converted at a time')
+    parser.add_argument('--cache-dir', type=str, dest='cache_dir', default=None,
+                        help='Keep the generated moves in this directory, and reuse them when the same image is '
+                             'converted with the same settings. Offsets and output options can still be changed')
+    parser.add_argument('--cache-size', type=float, dest='cache_size', default=DEFAULT_MAX_BYTES / (1024 * 1024),
+                        help='With --cache-dir, the most space (in MB) the cache can take up')
+    parser.add_argument('--estimate', dest='estimate', default=False, action="store_true",
+                        help='Estimate how long the job will take on the machine')
+    parser.add_argument('--optimise-travel', dest='optimise_travel', default=False, action="store_true",
+                        help='Reorder the separate parts of the image, and the direction each is engraved in, to cut '
+                             'down the travel between them. Requires numpy')
+    parser.add_argument('--chunk-dir', type=str, dest='chunk_dir', default=None,
+                        help='Write the program to this directory as chunk files that can each be run on their own, '
+                             'named after --out, with a JSON manifest of their lines, bounding boxes and checksums. '
+                             'Requires numpy')
+    parser.add_argument('--chunk-lines', type=int, dest='chunk_lines', default=None,
+                        help='With --chunk-dir, the most lines in a chunk, give or take a line of the program')
+    parser.add_argument('--chunk-size', type=float, dest='chunk_size', default=4,
+                        help='With --chunk-dir, the most space (in MB) a chunk takes up before it is compressed')
+    parser.add_argument('--chunk-compression', type=str, dest='chunk_compression', default=None,
+                        choices=["gzip", "bz2"], help='With --chunk-dir, compress each chunk')
+    parser.add_argument('--profile', type=str, dest='profile', nargs='?', const='-', default=None,
+                        help='Write a JSON report of the time, lines, pixels and memory of each stage to this file, '
+                             'or to stderr if no file is given')
+    parser.add_argument('--cprofile', type=str, dest='cprofile', default=None,
+                        help='Profile the whole run with cProfile, and save the stats to this file. Use - to print the '
+                             'slowest functions to stderr')
+    parser.add_argument('--batch', type=str, dest='batch', default=None,
+                        help='Convert every image in this directory, or every job in this JSON manifest, instead of '
+                             '--src. A manifest is a list of objects with the same keys as --json-config, or an object '
+                             'with such a list as "jobs" and options for all of them as "defaults". Other options '
+                             'given here apply to every job. With --workers, that many images are converted at once')
+    parser.add_argument('--out-dir', type=str, dest='out_dir', default=None,
+                        help='With --batch, write the programs of jobs without an output_file of their own to this '
+                             'directory, named after their images')
+    parser.add_argument('--summary', type=str, dest='summary', default=None,
+                        help='With --batch, save a JSON summary of the time, bounding box and any error of every job '
+                             'to this file')
+    parser.add_argument('--json-config', type=str, dest='json_config', default=None,
+                        help='Supply configuration as a JSON encoded object. Each argument is represented by a key')
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Run bitmap-to-laser.py with the given command line arguments, or those of the script if there aren't any. The
+    G-Code goes to the output file or stdout, and everything else to stderr. Returns the exit status.
+    """
+    parser = build_parser()
+
+    # Parse command line arguments
+    args = parser.parse_args(argv)
+    args_as_dict = vars(args)
+    output_file = args_as_dict.pop("output_file", None)
+    json_config_str = args_as_dict.pop("json_config", None)
+
+    if json_config_str is not None:
+        json_args = json.loads(json_config_str)
+        try:
+            check_config(parser, json_args)
+        except ValueError as error:
+            parser.error(str(error))
+        args_as_dict.update(json_args)
+
+    batch_path = args_as_dict.pop("batch", None)
+    out_dir = args_as_dict.pop("out_dir", None)
+    summary_destination = args_as_dict.pop("summary", None)
+
+    if batch_path is not None:
+        return convert_batch(batch_path, out_dir, summary_destination, args_as_dict)
+
+    return convert(parser, args_as_dict, output_file)
+
+
+def check_config(parser, config):
+    """
+    Check the keys and values of a --json-config object against the options of the parser they stand for. Raises
+    ValueError for the first that isn't an option, or has a value of the wrong type or that isn't one of its choices.
+    """
+    actions = dict((action.dest, action) for action in parser._actions if action.dest != "help")
+
+    for key, value in sorted(config.items()):
+        action = actions.get(key)
+        if action is None:
+            raise ValueError("Unknown option: {}".format(key))
+
+        if value is None and action.default is None:
+            continue
+
+        if action.nargs == 0:
+            # A flag
+            valid = isinstance(value, bool)
+        elif action.type in (int, float):
+            valid = isinstance(value, (int, long, float)) and not isinstance(value, bool)
+        else:
+            valid = isinstance(value, basestring)
+
+        if not valid:
+            raise ValueError("Invalid value for {}: {}".format(key, json.dumps(value)))
+
+        if action.choices is not None and value not in action.choices:
+            raise ValueError("{} must be one of {}, not {}".format(key, ", ".join(action.choices), json.dumps(value)))
+
+
+def convert_batch(batch_path, out_dir, summary_destination, args_as_dict):
+    # Convert each image of a directory or job of a manifest, with the other options for every job
+    from raster.batch import find_images, load_manifest, plan_jobs, run_batch, batch_summary
+
+    batch_start_time = time.time()
+
+    # Everything else is an option for each job, apart from what is only for a single conversion
+    for option in ["source_image", "estimate", "profile", "cprofile", "command_density", "verify", "preview"]:
+        args_as_dict.pop(option, None)
+    batch_workers = args_as_dict.pop("workers", 1)
+
+    if os.path.isdir(batch_path):
+        jobs = [{"source_image": path} for path in find_images(batch_path)]
+    else:
+        jobs = load_manifest(batch_path)
+
+    if out_dir is not None and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    jobs = plan_jobs(jobs, out_dir, args_as_dict)
+
+    results = []
+    for result in run_batch(jobs, batch_workers):
+        results.append(result)
+        if result.succeeded:
+            print >> sys.stderr, "[{}/{}] {} -> {} in {:.3f}s".format(len(results), len(jobs), result.source_image,
+                                                                    result.output_file, result.seconds)
+        else:
+            print >> sys.stderr, "[{}/{}] {} failed: {}".format(len(results), len(jobs), result.source_image,
+                                                              result.error)
+
+    summary = batch_summary(results, time.time() - batch_start_time)
+    print >> sys.stderr, "Converted {} of {} images in {:.3f}s".format(summary["succeeded"], summary["jobs"],
+                                                                      summary["seconds"])
+
+    if summary_destination is not None:
+        with open(summary_destination, "w") as summary_file:
+            json.dump(summary, summary_file, indent=2, sort_keys=True)
+
+    return 1 if summary["failed"] else 0
+
+
+def convert(parser, args_as_dict, output_file):
+    # Convert a single image, with the parsed options
+    machine_instance = marlin.Marlin()
+    machine_instance = machine.BaseMachine()
+
+    # These are for the output of the program rather than generating it
+    machine_instance.set_output_property("compress_modal_state", args_as_dict.pop("compress_modal_state", False))
+    machine_instance.set_output_property("tool_power_tolerance", args_as_dict.pop("tool_power_tolerance", 0))
+    estimate = args_as_dict.pop("estimate", False)
+    profile_destination = args_as_dict.pop("profile", None)
+    cprofile_destination = args_as_dict.pop("cprofile", None)
+    stream = args_as_dict.pop("stream", False)
+    cache_dir = args_as_dict.pop("cache_dir", None)
+    cache_size = args_as_dict.pop("cache_size", DEFAULT_MAX_BYTES / (1024 * 1024))
+    strip_rows = args_as_dict.pop("strip_rows", DEFAULT_STRIP_ROWS)
+    command_density = args_as_dict.pop("command_density", False)
+    verify = args_as_dict.pop("verify", False)
+    preview_destination = args_as_dict.pop("preview", None)
+    optimise_travel = args_as_dict.pop("optimise_travel", False)
+    chunk_dir = args_as_dict.pop("chunk_dir", None)
+    chunk_lines = args_as_dict.pop("chunk_lines", None)
+    chunk_size = args_as_dict.pop("chunk_size", 4)
+    chunk_compression = args_as_dict.pop("chunk_compression", None)
+
+    if stream:
+        # The whole program is never held at once, so can't be estimated, and strips are converted one after another
+        if estimate:
+            parser.error("--estimate can't be used with --stream")
+        if args_as_dict.pop("workers", 1) > 1:
+            parser.error("--workers can't be used with --stream")
+        if cache_dir is not None:
+            parser.error("--cache-dir can't be used with --stream")
+        if command_density:
+            parser.error("--command-density can't be used with --stream")
+        if verify or preview_destination is not None:
+            parser.error("--verify and --preview can't be used with --stream")
+        if optimise_travel:
+            parser.error("--optimise-travel can't be used with --stream")
+        if chunk_dir is not None:
+            parser.error("--chunk-dir can't be used with --stream")
+
+    # Everything other than the G-Code goes to stderr, so that the program can be piped straight from stdout
+    import pprint
+    print >> sys.stderr, pprint.pformat(args_as_dict)
+
+    script_start_time = time.time()
+    status = 0
+
+    # Record each stage of the conversion as it finishes
+    stage_timer = stages.StageTimer()
+    stages.add_hook(stage_timer)
+    try:
+        if cprofile_destination is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        if stream:
+            source_path = args_as_dict.pop("source_image")
+
+            if output_file is not None:
+                with open(output_file, "w+") as output:
+                    bounding_box = stream_bitmap_to_laser(source_path, output, machine_instance, strip_rows,
+                                                          **args_as_dict)
+            else:
+                bounding_box = stream_bitmap_to_laser(source_path, sys.stdout, machine_instance, strip_rows,
+                                                      **args_as_dict)
+
+            print >> sys.stderr, bounding_box
+        else:
+            with stages.stage("load_image") as stage:
+                src_image = Image.open(args_as_dict["source_image"]).convert('LA')
+                stage.pixels = src_image.size[0] * src_image.size[1]
+
+            # TODO: min / max laser power
+
+            args_as_dict["source_image"] = src_image
+
+            if cache_dir is not None:
+                args_as_dict["cache"] = RasterCache(cache_dir, int(cache_size * 1024 * 1024))
+
+            resultant_gcode = bitmap_to_laser(**args_as_dict)
+
+            if optimise_travel:
+                print >> sys.stderr, resultant_gcode.optimise_travel()
+
+            print >> sys.stderr, resultant_gcode.bounding_box
+
+            if command_density:
+                _print_command_density(args_as_dict, resultant_gcode, machine_instance)
+
+            # Stream the program straight to its destination rather than building it up as one string first
+            if chunk_dir is not None:
+                name = os.path.splitext(os.path.basename(output_file or "program"))[0]
+                manifest = resultant_gcode.write_chunks(chunk_dir, machine_instance, name, chunk_lines,
+                                                        int(chunk_size * 1024 * 1024), chunk_compression)
+                print >> sys.stderr, "Wrote {} chunks to {}".format(len(manifest.chunks), chunk_dir)
+            elif output_file is not None:
+                with open(output_file, "w+") as output:
+                    resultant_gcode.write_to(output, machine_instance)
+            else:
+                resultant_gcode.write_to(sys.stdout, machine_instance)
+
+            if verify or preview_destination is not None:
+                from raster.verify import compare_to_source
+                comparison = compare_to_source(resultant_gcode, **args_as_dict)
+
+                if verify:
+                    print >> sys.stderr, "Verify: {}".format(comparison)
+                    if not comparison.matches:
+                        status = 1
+
+                if preview_destination is not None:
+                    comparison.rendering.to_image(args_as_dict.get("laser_power_max", 255)).save(preview_destination)
+
+        if estimate:
+            print >> sys.stderr, resultant_gcode.estimate(machine_instance)
+
+        if cprofile_destination is not None:
+            profiler.disable()
+            if cprofile_destination == "-":
+                import pstats
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+            else:
+                profiler.dump_stats(cprofile_destination)
+    finally:
+        stages.remove_hook(stage_timer)
+
+    for stage in stage_timer.stages:
+        print >> sys.stderr, "{} took: {:.3f}s".format(stage.name, stage.seconds)
+    print >> sys.stderr, "Script took: {:.3f}s".format(time.time() - script_start_time)
+
+    if profile_destination is not None:
+        report = json.dumps(stage_timer.report(), indent=2, sort_keys=True)
+        if profile_destination == "-":
+            print >> sys.stderr, report
+        else:
+            with open(profile_destination, "w") as profile_file:
+                profile_file.write(report)
+
+    return status
+
+
+def _print_command_density(args_as_dict, resultant_gcode, machine_instance):
+    from gcode.estimate import command_density as count_command_density
+
+    # Before is the same image converted without power levels, run merging or dithering
+    plain_args = dict(args_as_dict, power_levels=None, min_run_length=1, power_hysteresis=0, dither=None,
+                      cache=None)
+    commands_before, density_before = count_command_density(bitmap_to_laser(**plain_args), machine_instance)
+    commands_after, density_after = count_command_density(resultant_gcode, machine_instance)
+
+    def format_density(density):
+        return "-" if density is None else "{:.2f}".format(density)
+
+    print >> sys.stderr, "Commands per mm lased: {} before, {} after ({} commands before, {} after)".format(
+        format_density(density_before), format_density(density_after), commands_before, commands_after)
@@ -0,0 +1,283 @@
+__author__ = 'Richard'
+
+# A long running local service that converts images with the same options as bitmap-to-laser.py, so that each
+# conversion doesn't have to start Python and import PIL and the rest first. Conversions run in a pool of worker
+# processes that are started once, with everything already imported. It speaks HTTP, over localhost or a unix socket:
+#
+#   POST /convert   An object with the same keys as --json-config. Responds with the G-Code, or the log of the
+#                   conversion if it failed
+#   GET /metrics    Latency and queue depth, as JSON
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from cStringIO import StringIO
+
+from raster import cli
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# How many of the latest conversions the latency figures are worked out from
+LATENCY_HISTORY = 1000
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Options that say where the output goes, which is always back to the client, the profilers, which would write
+# their reports on the daemon's side, and workers, as the daemon's own workers can't start processes of their own
+REFUSED_OPTIONS = ["output_file", "batch", "out_dir", "summary", "preview", "chunk_dir", "profile", "cprofile",
+                   "workers"]
+
+
+class DaemonMetrics(object):
+    """
+    How the daemon is doing. Latency is from a conversion being asked for to its G-Code being ready to send, and
+    is split into the time it waits for a worker and the time it takes to convert, all in seconds. Queue depth is how
+    many conversions are waiting for a worker.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.start_time = time.time()
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.queue_seconds = collections.deque(maxlen=LATENCY_HISTORY)
+        self.convert_seconds = collections.deque(maxlen=LATENCY_HISTORY)
+
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        return max(self.in_flight - self.workers, 0)
+
+    def job_started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def job_finished(self, succeeded, latency, queue_seconds, convert_seconds):
+        with self._lock:
+            self.in_flight -= 1
+            if not succeeded:
+                self.failures += 1
+
+            self.latencies.append(latency)
+            self.queue_seconds.append(queue_seconds)
+            self.convert_seconds.append(convert_seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "uptime_seconds": time.time() - self.start_time,
+                "workers": self.workers,
+                "requests": self.requests,
+                "failures": self.failures,
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "latency_median": _percentile(self.latencies, 0.5),
+                "latency_95": _percentile(self.latencies, 0.95),
+                "latency_max": _percentile(self.latencies, 1.0),
+                "queue_seconds_median": _percentile(self.queue_seconds, 0.5),
+                "queue_seconds_95": _percentile(self.queue_seconds, 0.95),
+                "convert_seconds_median": _percentile(self.convert_seconds, 0.5),
+                "convert_seconds_95": _percentile(self.convert_seconds, 0.95)
+            }
+
+
+class JobRunner(object):
+    """
+    The pool of workers that conversions run in, and the directory their G-Code is written to until it is sent.
+    """
+
+    def __init__(self, workers=None, spool_directory=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        self.workers = workers
+        self.metrics = DaemonMetrics(workers)
+
+        self._own_spool_directory = spool_directory is None
+        if spool_directory is None:
+            spool_directory = tempfile.mkdtemp(prefix="bitmap-to-laser-")
+        self.spool_directory = spool_directory
+
+        self._pool = multiprocessing.Pool(workers, _initialise_worker)
+
+    def convert(self, options):
+        """
+        Convert an image with the options of bitmap-to-laser.py. Returns the exit status, the log of the conversion
+        and the path of the file holding its G-Code, which the caller removes once it has been sent.
+        """
+        file_descriptor, output_path = tempfile.mkstemp(suffix=".gcode", dir=self.spool_directory)
+        os.close(file_descriptor)
+
+        request_time = time.time()
+        self.metrics.job_started()
+        status = 1
+        queue_seconds = convert_seconds = 0.0
+
+        try:
+            status, log, queue_seconds, convert_seconds = self._pool.apply(_run_job,
+                                                                           ((options, output_path, request_time),))
+        except:
+            os.remove(output_path)
+            raise
+        finally:
+            self.metrics.job_finished(status == 0, time.time() - request_time, queue_seconds, convert_seconds)
+
+        return status, log, output_path
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        if self._own_spool_directory:
+            shutil.rmtree(self.spool_directory, ignore_errors=True)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Handles the requests of one connection. The server has the JobRunner as job_runner
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self._send_text(404, "Not found\n")
+            return
+
+        self._send_text(200, json.dumps(self.server.job_runner.metrics.as_dict(), indent=2, sort_keys=True) + "\n",
+                        "application/json")
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != "/convert":
+            self._send_text(404, "Not found\n")
+            return
+
+        try:
+            options = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+        except ValueError as error:
+            self._send_text(400, "The job isn't valid JSON: {}\n".format(error))
+            return
+
+        if not isinstance(options, dict):
+            self._send_text(400, "A job is an object with the same keys as --json-config\n")
+            return
+
+        refused = [option for option in REFUSED_OPTIONS if option in options]
+        if refused:
+            self._send_text(400, "These options can't be used with the daemon: {}\n".format(", ".join(refused)))
+            return
+
+        # Turn down options the command line wouldn't take here, rather than have a worker fail on them
+        try:
+            cli.check_config(cli.build_parser(), options)
+        except ValueError as error:
+            self._send_text(400, "{}\n".format(error))
+            return
+
+        status, log, output_path = self.server.job_runner.convert(options)
+        try:
+            if status != 0:
+                # Exit status 2 is argparse turning the options down
+                self._send_text(400 if status == 2 else 500, log)
+                return
+
+            # Send the program a block at a time, rather than reading it all in first
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(os.path.getsize(output_path)))
+            self.end_headers()
+
+            with open(output_path, "rb") as output:
+                shutil.copyfileobj(output, self.wfile, COPY_BUFFER_SIZE)
+        finally:
+            os.remove(output_path)
+
+    def log_message(self, format, *args):
+        # Connections over a unix socket don't have an address
+        address = self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+        sys.stderr.write("%s - - [%s] %s\n" % (address, self.log_date_time_string(), format % args))
+
+    def _send_text(self, code, text, content_type="text/plain"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+def make_server(job_runner, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    """
+    Make the server for the daemon, listening on the unix socket at socket_path if given, or otherwise on host and
+    port. Call serve_forever to run it.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+
+    server.job_runner = job_runner
+    return server
+
+
+def _initialise_worker():
+    # The optional modules are imported before the first job, rather than during it
+    try:
+        import raster.vectorized
+        import raster.dither
+        import gcode.estimate
+    except ImportError:
+        pass
+
+
+def _run_job(job):
+    # Run bitmap-to-laser.py with the options in this worker, keeping what it says for the log
+    options, output_path, request_time = job
+    start_time = time.time()
+
+    log = StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = log
+    try:
+        status = cli.main(["--json-config", json.dumps(options), "--out", output_path])
+    except SystemExit as exit:
+        if exit.code is None:
+            status = 0
+        else:
+            status = exit.code if isinstance(exit.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    return status, log.getvalue(), start_time - request_time, time.time() - start_time
+
+
+def _percentile(values, fraction):
+    # The value that the given fraction of values are within
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
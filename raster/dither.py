@@ -0,0 +1,127 @@
+__author__ = 'Richard'
+
+# Turns the greys of an image into black and white by dithering, so that black and white engraving keeps the shading
+# of photos without a change of power in every pixel. Rows are dithered in the order they are engraved, from the
+# bottom of the image up, so an image gives the same result whether it is converted all at once or a strip at a time.
+
+import numpy
+from PIL import Image
+
+from raster.bitmap import DitherMode, LaserState
+
+# The size of the ordered dithering matrix. Bigger matrices give more shades, in a coarser pattern
+ORDERED_MATRIX_SIZE = 8
+
+# Floyd-Steinberg error diffusion, as the share of a pixel's error that goes to the next pixel in its row, and to
+# the pixels behind, below and ahead of it in the next row
+_ERROR_AHEAD = 7 / 16.0
+_ERROR_NEXT_BEHIND = 3 / 16.0
+_ERROR_NEXT_BELOW = 5 / 16.0
+_ERROR_NEXT_AHEAD = 1 / 16.0
+
+_BLACK = 0
+_WHITE = 255
+
+
+def bayer_matrix(size):
+    """
+    Bayer's ordered dithering matrix, size by size where size is a power of two. Each entry is the order the pixel
+    is turned on in as its block gets darker.
+    """
+    matrix = numpy.zeros((1, 1), dtype=numpy.int64)
+    while matrix.shape[0] < size:
+        matrix = numpy.vstack((numpy.hstack((4 * matrix, 4 * matrix + 2)),
+                               numpy.hstack((4 * matrix + 3, 4 * matrix + 1))))
+
+    return matrix
+
+
+class Ditherer(object):
+    """
+    Dithers an image a strip of rows at a time, starting with the strip at the bottom of the image and working up.
+    Each pixel of a dithered image is either black or white, as the laser would be off or on for it. Error diffusion
+    carries what is left over from the top row of each strip into the strip above it.
+    """
+
+    def __init__(self, dither, invert):
+        if dither not in DitherMode.ALL:
+            raise ValueError("Unknown dither mode: {}".format(dither))
+
+        self.dither = dither
+        self.invert = invert
+
+        # The laser state each pixel has to reach to be lased, in the middle of its step of the matrix
+        matrix = bayer_matrix(ORDERED_MATRIX_SIZE)
+        self._thresholds = (matrix + 0.5) * (LaserState.ON + 1) / matrix.size
+
+        # The error carried into the bottom row of the next strip
+        self._carried_error = None
+
+    def dither_strip(self, strip, first_row):
+        # The strip, which holds the image rows from first_row down, with the luminance of each pixel made black or
+        # white. Any other bands are kept
+        pixels = numpy.array(strip)
+        luminance = pixels[:, :, 0] if pixels.ndim == 3 else pixels
+
+        laser_states = luminance.astype(numpy.float64)
+        if not self.invert:
+            laser_states = LaserState.ON - laser_states
+
+        if self.dither == DitherMode.ORDERED:
+            lased = self._ordered(laser_states, first_row)
+        else:
+            lased = self._error_diffusion(laser_states)
+
+        # Lased pixels are black, unless the image is inverted
+        luminance[...] = numpy.where(lased != self.invert, _BLACK, _WHITE)
+
+        return Image.fromarray(pixels, strip.mode)
+
+    def _ordered(self, laser_states, first_row):
+        num_pixels_high, num_pixels_wide = laser_states.shape
+        size = self._thresholds.shape[0]
+
+        rows = (numpy.arange(first_row, first_row + num_pixels_high) % size)[:, numpy.newaxis]
+        columns = (numpy.arange(num_pixels_wide) % size)[numpy.newaxis, :]
+
+        return laser_states >= self._thresholds[rows, columns]
+
+    def _error_diffusion(self, laser_states):
+        # Floyd-Steinberg, from the bottom row up and left to right along each row. Each pixel only waits for the
+        # one before it in its row and the three nearest it in the row before, so every pixel on a line two columns
+        # back for each row along (a wavefront) can be done at once
+        num_pixels_high, num_pixels_wide = laser_states.shape
+        lased = numpy.zeros((num_pixels_high, num_pixels_wide), dtype=bool)
+        if num_pixels_high == 0 or num_pixels_wide == 0:
+            return lased
+
+        # Rows in the order they are dithered, with a column either side for the error that falls off the edges and
+        # a row after for the error carried into the next strip
+        values = numpy.zeros((num_pixels_high + 1, num_pixels_wide + 2))
+        values[:num_pixels_high, 1:-1] = laser_states[::-1]
+        if self._carried_error is not None:
+            values[0, 1:-1] += self._carried_error
+
+        threshold = (LaserState.ON + 1) / 2.0
+        lased_rows = lased[::-1]
+
+        for wavefront in range(num_pixels_wide + 2 * (num_pixels_high - 1)):
+            first = max(0, (wavefront - num_pixels_wide + 2) // 2)
+            last = min(num_pixels_high - 1, wavefront // 2)
+
+            rows = numpy.arange(first, last + 1)
+            columns = wavefront - 2 * rows + 1
+
+            old_values = values[rows, columns]
+            on = old_values >= threshold
+            lased_rows[rows, columns - 1] = on
+
+            error = old_values - numpy.where(on, LaserState.ON, LaserState.OFF)
+            values[rows, columns + 1] += error * _ERROR_AHEAD
+            values[rows + 1, columns - 1] += error * _ERROR_NEXT_BEHIND
+            values[rows + 1, columns] += error * _ERROR_NEXT_BELOW
+            values[rows + 1, columns + 1] += error * _ERROR_NEXT_AHEAD
+
+        self._carried_error = values[num_pixels_high, 1:-1]
+
+        return lased
@@ -0,0 +1,113 @@
+__author__ = 'Richard'
+
+import multiprocessing
+
+from gcode.file import File as GCodeFile
+from raster.bitmap import (get_raster_rows_function, get_row_extents_function, direction_before_pass, lased_edges,
+                           plan_trimmed_pass, PassDirection)
+
+# How many bands each worker gets on average. More bands balance the load better, but each one has some overhead
+BANDS_PER_WORKER = 4
+
+# Set in each worker process, so that the image is only sent to it once
+_worker_image = None
+
+
+def raster_rows_parallel(gcode_file, source_image, engine, workers, raster_settings):
+    """
+    Generate the rows of the image in a pool of worker processes, in horizontal bands, and add them to gcode_file in
+    order. The result is identical to generating all of the rows in one process.
+    """
+    # Rows are output from the bottom of the image up, so the first band is the one at the bottom
+    bands = list(reversed(split_bands(source_image.size[1], workers * BANDS_PER_WORKER)))
+
+    pool = multiprocessing.Pool(workers, _initialise_worker, (source_image,))
+    try:
+        if raster_settings["trim_passes"]:
+            band_states = _trimmed_band_states(pool, bands, engine, raster_settings)
+        else:
+            band_states = _band_states(bands, raster_settings)
+
+        jobs = [(engine, row_range, pass_direction, head_x, raster_settings)
+                for row_range, (pass_direction, head_x) in zip(bands, band_states)]
+
+        # imap returns the bands in order, as soon as each one is ready
+        for band_file in pool.imap(_raster_band, jobs):
+            gcode_file.append_file(band_file)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _band_states(bands, raster_settings):
+    # Each band needs to know how many passes came before it so that it can carry on the alternating pass direction
+    passes_per_pixel = raster_settings["passes_per_pixel"]
+
+    band_states = []
+    passes_before = 0
+    for row_range in bands:
+        band_states.append((direction_before_pass(passes_before), None))
+        passes_before += (row_range[1] - row_range[0]) * passes_per_pixel
+
+    return band_states
+
+
+def _trimmed_band_states(pool, bands, engine, raster_settings):
+    # Trimmed passes start from the end nearer to where the last one finished, so each band needs the direction and
+    # head position left by all of the passes before it. These only depend on the lased extent of each row, which is
+    # found first in the workers and then played through here
+    extents_jobs = [(engine, row_range, raster_settings) for row_range in bands]
+
+    mm_per_pixel = raster_settings["mm_per_pixel"]
+    overscan = raster_settings["overscan"]
+    pass_direction = PassDirection.RIGHT_TO_LEFT
+    head_x = 0
+
+    band_states = []
+    for band_extents in pool.imap(_band_extents, extents_jobs):
+        band_states.append((pass_direction, head_x))
+
+        for lased_extent in reversed(band_extents):
+            if lased_extent is None:
+                continue
+
+            left_x, right_x = lased_edges(mm_per_pixel, *lased_extent)
+            for laser_pass in range(raster_settings["passes_per_pixel"]):
+                pass_direction, _, _, _, head_x = plan_trimmed_pass(pass_direction, head_x, left_x, right_x,
+                                                                     overscan)
+
+    return band_states
+
+
+def split_bands(num_rows, num_bands):
+    # Split the rows into at most num_bands ranges of (start, end), as evenly as possible
+    num_bands = max(1, min(num_bands, num_rows))
+    bounds = [num_rows * band // num_bands for band in range(num_bands + 1)]
+    return [(bounds[band], bounds[band + 1]) for band in range(num_bands) if bounds[band] < bounds[band + 1]]
+
+
+def _initialise_worker(source_image):
+    global _worker_image
+    _worker_image = source_image
+
+
+def _band_extents(job):
+    engine, row_range, raster_settings = job
+
+    return get_row_extents_function(engine)(_worker_image, row_range, raster_settings["invert"],
+                                            raster_settings["colour_mode_bw"], raster_settings["bw_threshold"],
+                                            raster_settings["laser_power_min"], raster_settings["laser_power_max"],
+                                            raster_settings["power_levels"], raster_settings["min_run_length"],
+                                            raster_settings["power_hysteresis"])
+
+
+def _raster_band(job):
+    engine, row_range, pass_direction, head_x, raster_settings = job
+
+    band_file = GCodeFile()
+    get_raster_rows_function(engine)(band_file, _worker_image, row_range=row_range, pass_direction=pass_direction,
+                                     head_x=head_x, **raster_settings)
+    return band_file
@@ -0,0 +1,197 @@
+from __future__ import division
+
+__author__ = 'Richard'
+
+# Converts an image to G-Code a strip of rows at a time, writing each strip's lines out before the next strip is read,
+# so that memory use depends on the size of a strip rather than the size of the image
+
+from PIL import Image
+
+from gcode import stages
+from gcode.file import File as GCodeFile, FileOutput
+from raster.bitmap import get_raster_settings, get_raster_rows_function, start_gcode_file, RasterEngine
+
+# How many rows of the image are read and converted at a time
+DEFAULT_STRIP_ROWS = 256
+
+# The bits per pixel of the raw pixel formats that strips can be read straight out of the file for
+_RAW_BITS = {
+    "1": 1, "1;I": 1,
+    "L": 8, "P": 8,
+    "LA": 16, "I;16": 16, "I;16B": 16,
+    "RGB": 24, "BGR": 24,
+    "RGBA": 32, "RGBX": 32, "BGRX": 32
+}
+
+
+class StripReader(object):
+    """
+    Reads an image file a strip of rows at a time, converted to luminance and alpha. Images stored as raw pixels,
+    such as PGM, PPM and uncompressed BMP, only have the rows of each strip read from the file. Any other image has
+    to be decoded in full the first time a strip is read, so should be converted to one of those to be streamed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        image = Image.open(path)
+        self.size = image.size
+        self.mode = image.mode
+        self.raw_tile = _raw_tile(image)
+        self.image = None
+
+    @property
+    def streamable(self):
+        # Whether strips are read without decoding the whole image
+        return self.raw_tile is not None
+
+    def read_rows(self, start, end):
+        # The image rows from start up to (but not including) end, as an image of their own
+        num_pixels_wide, num_pixels_high = self.size
+
+        if self.raw_tile is None:
+            if self.image is None:
+                self.image = Image.open(self.path).convert('LA')
+            return self.image.crop((0, start, num_pixels_wide, end))
+
+        rawmode, stride, orientation, offset = self.raw_tile
+
+        # Rows stored bottom up, as BMP does, start with the last row of the strip
+        if orientation < 0:
+            offset += (num_pixels_high - end) * stride
+        else:
+            offset += start * stride
+
+        strip = Image.open(self.path)
+        strip.tile = [("raw", (0, 0, num_pixels_wide, end - start), offset, (rawmode, stride, orientation))]
+        _set_size(strip, (num_pixels_wide, end - start))
+
+        return strip.convert('LA')
+
+    def iter_strips(self, strip_rows=DEFAULT_STRIP_ROWS):
+        # Yields (start, end, strip) for strips of the image from the bottom up, the order its rows are output in
+        num_pixels_high = self.size[1]
+
+        for end in range(num_pixels_high, 0, -strip_rows):
+            start = max(end - strip_rows, 0)
+            yield start, end, self.read_rows(start, end)
+
+
+def stream_bitmap_to_laser(source_path, fileobj, machine, strip_rows=DEFAULT_STRIP_ROWS, mm_per_pass=0.1,
+                           feedrate_lase=1000, feedrate_rapid=None, invert=False,
+                           dimension_width=None, dimension_height=None, rapid_min_distance=20,
+                           laser_power_min=0, laser_power_max=255,
+                           colour_mode_bw=False, bw_threshold=125,
+                           offset_x=0, offset_y=0, offset_z=0,
+                           engine=None, trim_passes=False, overscan=0,
+                           power_levels=None, min_run_length=1, power_hysteresis=0, dither=None):
+    """
+    Convert the image at source_path and write the program for the machine to fileobj, with the same output as
+    bitmap_to_laser followed by write_to. Only a strip of strip_rows rows is held at a time, both of the image and of
+    its lines. With line numbers, the strips are converted twice, as the width of the line numbers depends on how many
+    lines there are in total. Returns the bounding box of the program.
+    """
+    if engine is None:
+        engine = RasterEngine.PYTHON
+
+    if strip_rows < 1:
+        raise ValueError("Strips need at least one row")
+
+    reader = StripReader(source_path)
+    num_pixels_wide, num_pixels_high = reader.size
+
+    raster_settings = get_raster_settings(num_pixels_wide, num_pixels_high, mm_per_pass, feedrate_lase,
+                                          feedrate_rapid, invert, dimension_width, dimension_height,
+                                          rapid_min_distance, laser_power_min, laser_power_max, colour_mode_bw,
+                                          bw_threshold, engine, trim_passes, overscan, power_levels, min_run_length,
+                                          power_hysteresis, dither)
+    raster_rows = get_raster_rows_function(engine)
+
+    header_file = start_gcode_file(raster_settings["feedrate_rapid"])
+    header_file.translate(offset_x, offset_y, offset_z)
+    header_file.set_output_properties(machine.get_output_properties())
+
+    def iter_strip_files():
+        # The lines of each strip in turn, in a file of their own that is shifted the same as the whole program
+        pass_direction = None
+        head_x = None
+
+        ditherer = None
+        if dither is not None:
+            from raster.dither import Ditherer
+            ditherer = Ditherer(dither, invert)
+
+        for start, end, strip in reader.iter_strips(strip_rows):
+            if ditherer is not None:
+                strip = ditherer.dither_strip(strip, start)
+
+            strip_file = GCodeFile()
+            pass_direction, head_x = raster_rows(strip_file, strip, row_range=(start, end), pass_direction=pass_direction,
+                                                 head_x=head_x, image_height=num_pixels_high, **raster_settings)
+            strip_file.translate(offset_x, offset_y, offset_z)
+
+            yield strip_file
+
+    total_lines = None
+    if header_file.get_output_property("line_numbers"):
+        with stages.stage("count") as stage:
+            total_lines = len(header_file.lines) + sum(len(strip_file.lines) for strip_file in iter_strip_files())
+            stage.lines = total_lines
+            stage.pixels = num_pixels_wide * num_pixels_high
+
+    with stages.stage("stream") as stage:
+        # Line numbers aren't output without a total, so any will do
+        file_output = FileOutput(header_file, machine, total_lines or len(header_file.lines))
+        file_output.write_file(fileobj, header_file)
+
+        bounding_box = header_file.bounding_box
+        for strip_file in iter_strip_files():
+            file_output.write_file(fileobj, strip_file)
+            bounding_box = _merge_bounding_boxes(bounding_box, strip_file.bounding_box)
+
+        stage.lines = file_output.line_index - 1
+        stage.pixels = num_pixels_wide * num_pixels_high
+
+    return bounding_box
+
+
+def _merge_bounding_boxes(first, second):
+    merged = {}
+    for axis in ["x", "y", "z"]:
+        bounding_min = "min_{}".format(axis)
+        bounding_max = "max_{}".format(axis)
+        merged[bounding_min] = min(first[bounding_min], second[bounding_min])
+        merged[bounding_max] = max(first[bounding_max], second[bounding_max])
+
+    return merged
+
+
+def _raw_tile(image):
+    # The raw mode, row stride, row order and file offset of an image stored as a single block of raw pixels, or
+    # None if its rows can't be read on their own
+    if len(image.tile) != 1:
+        return None
+
+    decoder, extents, offset, args = image.tile[0]
+    if decoder != "raw" or tuple(extents) != (0, 0) + image.size:
+        return None
+
+    if not isinstance(args, tuple):
+        args = (args,)
+    rawmode, stride, orientation = (args + (0, 1))[:3]
+
+    if stride <= 0:
+        bits = _RAW_BITS.get(rawmode)
+        if bits is None:
+            return None
+        stride = (image.size[0] * bits + 7) // 8
+
+    return rawmode, stride, orientation, offset
+
+
+def _set_size(image, size):
+    # Newer versions of PIL only have size as a property over _size
+    if hasattr(image, "_size"):
+        image._size = size
+    else:
+        image.size = size
@@ -0,0 +1,261 @@
+__author__ = 'Richard'
+
+import bisect
+
+import numpy
+
+from gcode.line import BlankLine, MoveRapid, MoveFeed, SetToolState, ToolState
+from raster.bitmap import (scale, quantize_power, merge_runs, runs_merged, PassDirection, LaserState, lased_edges,
+                           plan_trimmed_pass)
+
+
+def laser_state_table(invert, colour_mode_bw, bw_threshold, laser_power_min, laser_power_max, power_levels=None):
+    """
+    Build a lookup table mapping each 8-bit pixel value to the laser state the python engine would give it.
+    """
+    table = numpy.empty(256, dtype=numpy.int64)
+
+    for pixel_value in range(256):
+        laser_state = pixel_value
+
+        if not invert:
+            laser_state = LaserState.ON - laser_state
+
+        if colour_mode_bw:
+            if laser_state >= bw_threshold:
+                laser_state = laser_power_max
+            else:
+                laser_state = laser_power_min
+
+        laser_state = int(scale(laser_state, [0, 255], [laser_power_min, laser_power_max]))
+        if power_levels is not None:
+            laser_state = quantize_power(laser_state, power_levels, laser_power_min, laser_power_max)
+
+        table[pixel_value] = laser_state
+
+    return table
+
+
+def image_laser_states(source_image, invert, colour_mode_bw, bw_threshold, laser_power_min, laser_power_max,
+                       power_levels=None, min_run_length=1, power_hysteresis=0):
+    """
+    Convert the whole image into a 2D array of laser states in one go.
+    """
+    pixels = numpy.asarray(source_image)
+
+    # Only the first band (luminance) is used, the same as the python engine
+    if pixels.ndim == 3:
+        pixels = pixels[:, :, 0]
+
+    table = laser_state_table(invert, colour_mode_bw, bw_threshold, laser_power_min, laser_power_max, power_levels)
+    laser_states = table[pixels]
+
+    if runs_merged(min_run_length, power_hysteresis) and laser_states.shape[1]:
+        laser_states = merge_laser_states(laser_states, laser_power_min, min_run_length, power_hysteresis)
+
+    return laser_states
+
+
+def merge_laser_states(laser_states, laser_power_min, min_run_length, power_hysteresis):
+    """
+    Merge the runs of each row of laser states with merge_runs, the same as the python engine does.
+    """
+    merged = numpy.empty_like(laser_states)
+
+    for row, (starts, ends, states) in enumerate(row_runs(laser_states)):
+        starts, ends, states = merge_runs(starts, ends, states, laser_power_min, min_run_length, power_hysteresis)
+        merged[row] = numpy.repeat(states, numpy.subtract(ends, starts))
+
+    return merged
+
+
+def row_runs(laser_states):
+    """
+    Find the runs of equal laser state in each row.
+    Returns a list with one (starts, ends, states) tuple of python lists per row, columns ordered left to right.
+    """
+    num_pixels_high, num_pixels_wide = laser_states.shape
+
+    change_rows, change_cols = numpy.nonzero(laser_states[:, 1:] != laser_states[:, :-1])
+    # The run after a change starts on the following column
+    change_cols += 1
+
+    # Split the flat list of changes back up into rows
+    row_bounds = numpy.searchsorted(change_rows, numpy.arange(num_pixels_high + 1))
+    change_cols = change_cols.tolist()
+    row_bounds = row_bounds.tolist()
+
+    runs = []
+    for row in range(num_pixels_high):
+        row_changes = change_cols[row_bounds[row]:row_bounds[row + 1]]
+        starts = [0] + row_changes
+        ends = row_changes + [num_pixels_wide]
+        states = laser_states[row, starts].tolist()
+        runs.append((starts, ends, states))
+
+    return runs
+
+
+def lased_extents(laser_states, laser_power_min):
+    """
+    Find the first and last lased column of each row.
+    Returns a list with a (first, last) tuple per row, or None for rows with nothing to lase.
+    """
+    num_pixels_wide = laser_states.shape[1]
+
+    lased = laser_states != laser_power_min
+    any_lased = lased.any(axis=1).tolist()
+    first_cols = lased.argmax(axis=1).tolist()
+    last_cols = (num_pixels_wide - 1 - lased[:, ::-1].argmax(axis=1)).tolist()
+
+    return [(first_col, last_col) if row_lased else None
+            for first_col, last_col, row_lased in zip(first_cols, last_cols, any_lased)]
+
+
+def row_extents(source_image, row_range, invert, colour_mode_bw, bw_threshold, laser_power_min, laser_power_max,
+                power_levels=None, min_run_length=1, power_hysteresis=0):
+    # The lased extent of each row in row_range, the same as the python engine finds
+    num_pixels_wide = source_image.size[0]
+    source_image = source_image.crop((0, row_range[0], num_pixels_wide, row_range[1]))
+
+    laser_states = image_laser_states(source_image, invert, colour_mode_bw, bw_threshold,
+                                      laser_power_min, laser_power_max, power_levels, min_run_length,
+                                      power_hysteresis)
+    return lased_extents(laser_states, laser_power_min)
+
+
+def raster_rows(gcode_file, source_image, mm_per_pixel, passes_per_pixel, feedrate_lase, feedrate_rapid, invert,
+                rapid_min_distance, laser_power_min, laser_power_max, colour_mode_bw, bw_threshold,
+                trim_passes=False, overscan=0, power_levels=None, min_run_length=1, power_hysteresis=0,
+                row_range=None, pass_direction=None, head_x=None, image_height=None):
+    # row_range, pass_direction, head_x, image_height and what is returned are as for the python engine
+
+    num_pixels_wide, num_pixels_high = source_image.size
+
+    if row_range is None:
+        row_range = (0, num_pixels_high)
+
+    if pass_direction is None:
+        pass_direction = PassDirection.RIGHT_TO_LEFT
+
+    if head_x is None:
+        head_x = 0
+
+    # Only the rows being output are converted. A strip of the image already holds just those
+    first_row, end_row = row_range
+    if image_height is not None:
+        num_pixels_high = image_height
+    elif (first_row, end_row) != (0, num_pixels_high):
+        source_image = source_image.crop((0, first_row, num_pixels_wide, end_row))
+
+    laser_states = image_laser_states(source_image, invert, colour_mode_bw, bw_threshold,
+                                      laser_power_min, laser_power_max, power_levels, min_run_length,
+                                      power_hysteresis)
+
+    if num_pixels_wide == 0:
+        return pass_direction, head_x
+
+    runs = row_runs(laser_states)
+
+    if trim_passes:
+        extents = lased_extents(laser_states, laser_power_min)
+
+    output_width_mm = num_pixels_wide * mm_per_pixel
+
+    # Image rows go from top left, we want to go from bottom left
+    for row in reversed(range(first_row, end_row)):
+        starts, ends, states = runs[row - first_row]
+
+        if trim_passes:
+            # Rows with nothing to lase are skipped completely, and the others only cover their lased part
+            lased_extent = extents[row - first_row]
+            if lased_extent is None:
+                continue
+
+            first_col, last_col = lased_extent
+            left_x, right_x = lased_edges(mm_per_pixel, first_col, last_col)
+
+            # The lased part always starts and ends on a change between runs
+            first_run = bisect.bisect_left(starts, first_col)
+            end_run = bisect.bisect_left(ends, last_col + 1) + 1
+
+        gcode_file.add_line(BlankLine())
+        gcode_file.add_line(BlankLine())
+
+        row_y_pos = (num_pixels_high - (row + 1)) * mm_per_pixel
+
+        for laser_pass in range(passes_per_pixel):
+            pass_y_offset = (float(laser_pass) / passes_per_pixel) * mm_per_pixel
+            pass_y_pos = row_y_pos + pass_y_offset
+
+            if trim_passes:
+                pass_direction, pass_start_pos, laser_last_x_pos, pass_end_pos, pass_finish_pos = \
+                    plan_trimmed_pass(pass_direction, head_x, left_x, right_x, overscan)
+
+                if pass_direction == PassDirection.RIGHT_TO_LEFT:
+                    pass_runs = zip(reversed(ends[first_run:end_run]), reversed(states[first_run:end_run]))
+                else:
+                    pass_runs = zip(starts[first_run:end_run], states[first_run:end_run])
+
+                gcode_file.add_line(MoveRapid(pass_start_pos, pass_y_pos, None, feedrate_rapid))
+            else:
+                gcode_file.add_line(MoveRapid(None, pass_y_pos, None, feedrate_rapid))
+
+                if pass_direction == PassDirection.LEFT_TO_RIGHT:
+                    pass_direction = PassDirection.RIGHT_TO_LEFT
+                    laser_last_x_pos = output_width_mm
+                    # Moving leftwards, each run is entered at the right hand edge of its last pixel
+                    pass_runs = zip(reversed(ends), reversed(states))
+                    last_col = 0
+                else:
+                    pass_direction = PassDirection.LEFT_TO_RIGHT
+                    laser_last_x_pos = 0
+                    pass_runs = zip(starts, states)
+                    last_col = num_pixels_wide - 1
+
+            previous_laser_state = LaserState.OFF
+
+            for run_col, laser_state in pass_runs:
+                # Consecutive runs always differ, so only the very first run can match the initial state
+                if previous_laser_state == laser_state:
+                    continue
+
+                # Positions are calculated exactly as the python engine does, so the output is identical
+                if pass_direction == PassDirection.RIGHT_TO_LEFT:
+                    pixel_start_x_pos = mm_per_pixel * (run_col - 1)
+                    pixel_start_x_pos += mm_per_pixel
+                else:
+                    pixel_start_x_pos = mm_per_pixel * run_col
+
+                move_distance = abs(pixel_start_x_pos - laser_last_x_pos)
+                if previous_laser_state == laser_power_min and move_distance > rapid_min_distance:
+                    gcode_file.add_line(MoveRapid(pixel_start_x_pos, None, None, feedrate_rapid))
+                else:
+                    gcode_file.add_line(MoveFeed(pixel_start_x_pos, None, None, feedrate_lase))
+
+                laser_last_x_pos = pixel_start_x_pos
+
+                gcode_file.add_line(SetToolState(laser_state))
+
+                previous_laser_state = laser_state
+
+            if trim_passes:
+                gcode_file.add_line(MoveFeed(pass_end_pos, None, None, feedrate_lase))
+                gcode_file.add_line(SetToolState(ToolState.OFF))
+                if overscan:
+                    gcode_file.add_line(MoveFeed(pass_finish_pos, None, None, feedrate_lase))
+
+                head_x = pass_finish_pos
+                continue
+
+            # Turn off the tool at the end of each pass
+            if laser_state != laser_power_min:
+                if pass_direction == PassDirection.LEFT_TO_RIGHT:
+                    pass_end_pos = mm_per_pixel * last_col + mm_per_pixel
+                else:
+                    pass_end_pos = mm_per_pixel * last_col + mm_per_pixel - mm_per_pixel
+
+                gcode_file.add_line(MoveFeed(pass_end_pos, None, None, feedrate_lase))
+                gcode_file.add_line(SetToolState(ToolState.OFF))
+
+    return pass_direction, head_x
@@ -0,0 +1,86 @@
+from __future__ import division
+
+__author__ = 'Richard'
+
+# Checks a program against the image it was converted from, by drawing what the program burns at the resolution of the
+# image and comparing each pixel with the power the image asks for. Differences point to a raster engine going wrong,
+# so this is the oracle for changes to them. Requires numpy.
+
+import numpy
+
+from gcode.simulate import render
+from raster.bitmap import get_raster_settings, RasterEngine
+from raster.vectorized import image_laser_states
+
+
+class SourceComparison(object):
+    """
+    How a program compares with the image it was converted from. pixels is how many pixels the image has, and
+    mismatched how many of them the program burns, in any of their passes, at a power more than the tolerance away
+    from the one the image asks for, with max_difference the furthest away. Pixels at or below the minimum laser power
+    are the same whether they are lased at it or not at all. rendering is the Rendering of the program, and expected
+    the laser states of the image.
+    """
+
+    def __init__(self, rendering, expected, differences, tolerance):
+        self.rendering = rendering
+        self.expected = expected
+        self.pixels = differences.size
+        self.mismatched = int(numpy.count_nonzero(differences > tolerance))
+        self.max_difference = float(differences.max()) if differences.size else 0.0
+
+    @property
+    def matches(self):
+        return self.mismatched == 0
+
+    def __str__(self):
+        return "{} of {} pixels mismatched, by up to {}".format(self.mismatched, self.pixels, self.max_difference)
+
+
+def compare_to_source(gcode_file, source_image=None, mm_per_pass=0.1, feedrate_lase=1000, feedrate_rapid=None,
+                      invert=False, dimension_width=None, dimension_height=None, rapid_min_distance=20,
+                      laser_power_min=0, laser_power_max=255, colour_mode_bw=False, bw_threshold=125,
+                      offset_x=0, offset_y=0, offset_z=0, engine=None, workers=1, trim_passes=False, overscan=0,
+                      cache=None, power_levels=None, min_run_length=1, power_hysteresis=0, dither=None,
+                      tolerance=0):
+    # Compare the file with the image it was converted from by bitmap_to_laser with the rest of the options. tolerance
+    # is how far the power of a pixel can be from the image's before it counts as mismatched, for programs whose power
+    # was rounded on the way out. Returns a SourceComparison
+
+    if engine is None:
+        engine = RasterEngine.PYTHON
+
+    num_pixels_wide = source_image.size[0]
+    num_pixels_high = source_image.size[1]
+
+    raster_settings = get_raster_settings(num_pixels_wide, num_pixels_high, mm_per_pass, feedrate_lase,
+                                          feedrate_rapid, invert, dimension_width, dimension_height,
+                                          rapid_min_distance, laser_power_min, laser_power_max, colour_mode_bw,
+                                          bw_threshold, engine, trim_passes, overscan, power_levels, min_run_length,
+                                          power_hysteresis, dither)
+
+    if dither is not None:
+        from raster.dither import Ditherer
+        source_image = Ditherer(dither, invert).dither_strip(source_image, 0)
+
+    expected = image_laser_states(source_image, raster_settings["invert"], raster_settings["colour_mode_bw"],
+                                  raster_settings["bw_threshold"], laser_power_min, laser_power_max, power_levels,
+                                  min_run_length, power_hysteresis).astype(numpy.float64)
+
+    # The passes of each row go up from its bottom edge, so the rows are drawn half a pass lower to have them all well
+    # inside, where rounding the positions on the way out can't move them into the next row
+    mm_per_pixel = raster_settings["mm_per_pixel"]
+    half_pass = mm_per_pixel / raster_settings["passes_per_pixel"] / 2
+    min_x = offset_x
+    min_y = offset_y - half_pass
+    rendering = render(gcode_file, mm_per_pixel, (min_x, min_y, min_x + num_pixels_wide * mm_per_pixel,
+                                                  min_y + num_pixels_high * mm_per_pixel), laser_power_min)
+
+    # Every pass over a pixel has to have its power, so both the highest and lowest of them are compared. Anything
+    # at or below the minimum power is left out of the rendering, and is the same as being at it
+    expected = numpy.maximum(expected, laser_power_min)
+    highest = numpy.maximum(rendering.powers, laser_power_min)
+    lowest = numpy.maximum(rendering.lowest_powers, laser_power_min)
+    differences = numpy.maximum(numpy.abs(highest - expected), numpy.abs(lowest - expected))
+
+    return SourceComparison(rendering, expected, differences, tolerance)
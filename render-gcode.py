@@ -0,0 +1,38 @@
+# Script to draw what a G-Code file burns into an image, to look it over before running it
+
+__author__ = 'Richard'
+
+import sys
+import argparse
+import time
+
+from gcode.parser import read_file
+from gcode.simulate import render, DEFAULT_MM_PER_PIXEL
+
+# Setup command line parameters
+parser = argparse.ArgumentParser(description='Draw what a G-Code file burns, as seen from above. Requires numpy.')
+parser.add_argument('gcode_file', type=str, help='The G-Code file to draw')
+parser.add_argument('image_file', type=str, help='The image to save the drawing to, such as preview.png')
+parser.add_argument('--mm-per-pixel', type=float, dest='mm_per_pixel', default=DEFAULT_MM_PER_PIXEL,
+                    help='The size of each pixel of the drawing')
+parser.add_argument('--power-min', type=float, dest='power_min', default=0,
+                    help='Moves made at or below this power are drawn as if the laser was off')
+parser.add_argument('--power-max', type=float, dest='power_max', default=None,
+                    help='The power drawn as black. Defaults to the highest power in the file')
+
+args = parser.parse_args()
+
+start_time = time.time()
+gcode_file = read_file(args.gcode_file)
+read_time = time.time()
+
+try:
+    rendering = render(gcode_file, args.mm_per_pixel, min_power=args.power_min)
+except ValueError as error:
+    parser.error(str(error))
+
+rendering.to_image(args.power_max).save(args.image_file)
+
+print >> sys.stderr, rendering
+print >> sys.stderr, "Reading {} lines took: {:.3f}s".format(len(gcode_file.lines), read_time - start_time)
+print >> sys.stderr, "Drawing took: {:.3f}s".format(time.time() - read_time)
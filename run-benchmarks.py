@@ -0,0 +1,57 @@
+# Script to benchmark generating and outputting G-Code, and compare the results with a saved baseline
+
+__author__ = 'Richard'
+
+import sys
+import argparse
+
+from benchmarks.images import SIZES, IMAGES
+from benchmarks.suite import MACHINES, run_suite, compare, save_results, load_results
+from raster.bitmap import RasterEngine
+
+# Setup command line parameters
+parser = argparse.ArgumentParser(description='Benchmark G-Code generation and output over synthetic images.')
+parser.add_argument('--images', type=str, dest='images', nargs='+', default=None, choices=sorted(IMAGES.keys()),
+                    help='The images to use. Defaults to all of them')
+parser.add_argument('--sizes', type=str, dest='sizes', nargs='+', default=None, choices=sorted(SIZES.keys()),
+                    help='The image sizes to use. Defaults to small and medium')
+parser.add_argument('--engines', type=str, dest='engines', nargs='+', default=None, choices=RasterEngine.ALL,
+                    help='The raster engines to use. Defaults to all of them')
+parser.add_argument('--machines', type=str, dest='machines', nargs='+', default=None, choices=sorted(MACHINES.keys()),
+                    help='The machines to output for. Defaults to all of them')
+parser.add_argument('--repeat', type=int, dest='repeat', default=3,
+                    help='How many times to run each measurement. The best time is kept')
+parser.add_argument('--out', type=str, dest='output_file', default=None,
+                    help='Save the results to this JSON file')
+parser.add_argument('--baseline', type=str, dest='baseline_file', default=None,
+                    help='Compare the results with those saved in this JSON file')
+parser.add_argument('--tolerance', type=float, dest='tolerance', default=0.2,
+                    help='How much worse than the baseline (as a fraction) a result can be before it is a regression')
+
+args = parser.parse_args()
+
+results = run_suite(args.images, args.sizes, args.engines, args.machines, args.repeat)
+
+print "{:<40} {:>10} {:>12} {:>10} {:>12} {:>10}".format("Case", "Generate", "Lines/sec", "Lines", "Bytes",
+                                                         "Memory")
+for result in results["results"]:
+    case = "/".join((result["image"], result["size"], result["engine"], result["machine"]))
+    print "{:<40} {:>9.3f}s {:>12.0f} {:>10} {:>12} {:>8.1f}MB".format(case, result["generation_seconds"],
+                                                                      result["lines_per_second"], result["lines"],
+                                                                      result["output_bytes"],
+                                                                      result["peak_memory_mb"])
+
+if args.output_file is not None:
+    save_results(results, args.output_file)
+
+if args.baseline_file is not None:
+    comparisons = compare(results, load_results(args.baseline_file), args.tolerance)
+    regressions = [comparison for comparison in comparisons if comparison[4]]
+
+    print
+    print "Compared {} measurements with {}".format(len(comparisons), args.baseline_file)
+    for case, metric, baseline_value, value, regressed in regressions:
+        print "REGRESSION {} {}: {} -> {}".format(case, metric, baseline_value, value)
+
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,58 @@
+# Script to stream a G-Code file to a Marlin controller over a serial port
+
+__author__ = 'Richard'
+
+import sys
+import argparse
+
+from machines.serial_stream import (StreamError, stream_commands, program_commands, DEFAULT_BAUD_RATE,
+                                    DEFAULT_RX_BUFFER_SIZE, DEFAULT_TIMEOUT)
+from machines.fake_marlin import FakeMarlin
+
+# Setup command line parameters
+parser = argparse.ArgumentParser(description='Stream G-Code to a Marlin controller, keeping its receive buffer full.')
+parser.add_argument('gcode_file', type=str, help='The G-Code file to send')
+parser.add_argument('port', type=str, nargs='?', default=None,
+                    help='The serial port of the controller, such as /dev/ttyUSB0')
+parser.add_argument('--baud', type=int, dest='baud_rate', default=DEFAULT_BAUD_RATE, help='The baud rate of the port')
+parser.add_argument('--rx-buffer', type=int, dest='rx_buffer_size', default=DEFAULT_RX_BUFFER_SIZE,
+                    help='How many characters can be waiting in the controller at once. Use 1 to wait for each line '
+                         'to be acknowledged before sending the next')
+parser.add_argument('--timeout', type=float, dest='timeout', default=DEFAULT_TIMEOUT,
+                    help='How long (in seconds) to wait for the controller before giving up')
+parser.add_argument('--fake', action='store_true', dest='fake', default=False,
+                    help='Send to a pretend controller instead of a real one, to try out the settings')
+parser.add_argument('--fake-error-rate', type=float, dest='fake_error_rate', default=0.0,
+                    help='The chance of each line being garbled on its way into the pretend controller')
+parser.add_argument('-v', action='store_true', dest='verbose', default=False,
+                    help='Show what the controller says')
+
+args = parser.parse_args()
+
+if args.port is None and not args.fake:
+    parser.error("A port is needed unless --fake is used")
+
+with open(args.gcode_file, "r") as gcode_file:
+    commands = list(program_commands(gcode_file))
+
+log = None
+if args.verbose:
+    log = lambda message: sys.stderr.write(message + "\n")
+
+fake = None
+port = args.port
+if args.fake:
+    fake = FakeMarlin(error_rate=args.fake_error_rate).start()
+    port = fake.port
+
+try:
+    stats = stream_commands(commands, port, args.baud_rate, rx_buffer_size=args.rx_buffer_size,
+                            timeout=args.timeout, log=log)
+except StreamError as error:
+    sys.stderr.write("Streaming failed: {}\n".format(error))
+    sys.exit(1)
+finally:
+    if fake is not None:
+        fake.stop()
+
+sys.stderr.write(str(stats) + "\n")